@@ -0,0 +1,92 @@
+"""Benchmark of the client ip address resolution over realistic header sets.
+
+Resolves the client ip address of API Gateway REST (payload 1.0), HTTP API (payload 2.0,
+lowercased headers), Application Load Balancer and direct requests, and reports the time
+per request, from the raw headers and including building the header index. The header sets of the payloads cycle over a number of distinct clients, as
+the requests a warm container serves do.
+
+Usage:
+    python benchmarks/client_ip.py [--clients 50] [--iterations 20000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MOESIF_LAZY_INIT', 'true')
+
+from moesif_aws_lambda.client_ip import ClientIp  # noqa: E402
+from moesif_aws_lambda.headers import HeaderIndex  # noqa: E402
+
+
+def header_sets(client):
+    client_ip = '203.0.%d.%d' % (client // 250, client % 250 + 1)
+    return {
+        'rest api': {
+            'Accept': 'application/json',
+            'CloudFront-Forwarded-Proto': 'https',
+            'CloudFront-Viewer-Country': 'US',
+            'Host': 'abc123.execute-api.us-east-1.amazonaws.com',
+            'User-Agent': 'python-requests/2.31.0',
+            'Via': '1.1 2f1f1b1e3c.cloudfront.net (CloudFront)',
+            'X-Amz-Cf-Id': 'nBsWBOrSHMgnaROZJK1wGCZ9PcRcSpq_oSXZNQwQ10OTZL4cimZo3g==',
+            'X-Amzn-Trace-Id': 'Root=1-5e66d96f-7491f09xmpl79d18acf3d050',
+            'X-Forwarded-For': client_ip + ', 130.176.96.44',
+            'X-Forwarded-Port': '443',
+            'X-Forwarded-Proto': 'https',
+        },
+        'http api': {
+            'accept': 'application/json',
+            'content-length': '0',
+            'host': 'abc123.execute-api.us-east-1.amazonaws.com',
+            'user-agent': 'python-requests/2.31.0',
+            'x-amzn-trace-id': 'Root=1-5e66d96f-7491f09xmpl79d18acf3d050',
+            'x-forwarded-for': client_ip,
+            'x-forwarded-port': '443',
+            'x-forwarded-proto': 'https',
+        },
+        'load balancer': {
+            'accept': '*/*',
+            'host': 'lambda-alb-123578498.us-east-1.elb.amazonaws.com',
+            'user-agent': 'curl/7.79.1',
+            'x-amzn-trace-id': 'Root=1-5c536348-3d683b8b04734faae651f476',
+            'x-forwarded-for': 'unknown, ' + client_ip + ':51234',
+            'x-forwarded-port': '80',
+            'x-forwarded-proto': 'http',
+        },
+        'direct': {
+            'accept': '*/*',
+            'host': 'abc123.lambda-url.us-east-1.on.aws',
+            'user-agent': 'curl/7.79.1',
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    client_ip = ClientIp()
+    clients = [header_sets(client) for client in range(args.clients)]
+    for name in clients[0]:
+        headers = [client[name] for client in clients]
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            client_ip.get_client_address(headers[i % args.clients], '192.0.2.1')
+        elapsed_us = (time.perf_counter() - start) / args.iterations * 1e6
+
+        # As in the middleware, where the header index is shared with the uri and the hooks
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            client_ip.get_client_address(HeaderIndex(headers[i % args.clients]), '192.0.2.1')
+        indexed_us = (time.perf_counter() - start) / args.iterations * 1e6
+
+        print('%-14s %6.2f us per request, %6.2f us including the header index, resolved %s' % (
+            name, elapsed_us, indexed_us, client_ip.get_client_address(headers[0], '192.0.2.1')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Benchmark of the compression codecs used to send events to Moesif.
+
+Captures the events of the sample `eventV1.json` and `eventV2.json` payloads with the
+middleware, then serializes and compresses batches of them with each codec and level, and
+reports the bytes on the wire and the CPU time per event.
+
+Usage:
+    python benchmarks/compression.py [--batch-size 25] [--iterations 200] [--body-size 2000]
+
+The zstd codec is skipped when `zstandard` is not installed.
+"""
+import argparse
+import time
+
+from sample_events import PAYLOAD_FILES, capture_events
+from moesif_aws_lambda.compression import Compressor, zstandard
+from moesif_aws_lambda.serializer import serialize_event
+
+CODECS = [('identity', None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+if zstandard is not None:
+    CODECS += [('zstd', 1), ('zstd', 3), ('zstd', 9)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=25)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--body-size', type=int, default=2000,
+                        help='approximate size of the response body of the sample handler')
+    args = parser.parse_args()
+
+    for payload_file in PAYLOAD_FILES:
+        event_models = capture_events(payload_file, args.body_size, args.batch_size)
+
+        start = time.process_time()
+        for _ in range(args.iterations):
+            payloads = [serialize_event(event_model) for event_model in event_models]
+        serialize_us = (time.process_time() - start) / args.iterations / args.batch_size * 1e6
+        batch = b'[' + b','.join(payloads) + b']'
+
+        print('%s: %.0f bytes per event, serialization %.1f us per event, batches of %d events'
+              % (payload_file, len(batch) / float(args.batch_size), serialize_us, args.batch_size))
+        print('  %-10s %5s %14s %8s %18s' % ('codec', 'level', 'bytes/event', 'ratio', 'compress us/event'))
+        for codec, level in CODECS:
+            compressor = Compressor(codec, level=level, min_size=0)
+            start = time.process_time()
+            for _ in range(args.iterations):
+                body, _ = compressor.compress(batch)
+            cpu_us = (time.process_time() - start) / args.iterations / args.batch_size * 1e6
+            print('  %-10s %5s %14.1f %8.2f %18.1f' % (codec, level if level is not None else '-',
+                                                       len(body) / float(args.batch_size),
+                                                       len(batch) / float(len(body)), cpu_us))
+
+
+if __name__ == '__main__':
+    main()
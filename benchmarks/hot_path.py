@@ -0,0 +1,222 @@
+"""Benchmark of what the middleware costs per invocation, on the capture hot path.
+
+Drives `MoesifLogger` around a minimal handler with API Gateway REST (payload 1.0), HTTP API
+(payload 2.0) and Application Load Balancer events, for each body size and number of request
+headers. The HTTP client of the API client is replaced by a local stub, so the events are
+serialized, compressed and sent without leaving the process. Reports per scenario the overhead
+per invocation over the bare handler, the peak and retained memory per invocation traced with
+tracemalloc, and the throughput.
+
+Usage:
+    python benchmarks/hot_path.py [--iterations 2000] [--body-sizes 0,1000,32000] [--header-counts 10,40]
+                                  [--batching] [--save results.json] [--compare baseline.json] [--threshold 0.2]
+
+With --compare, exits with status 1 when the p50 overhead of a scenario regressed by more than
+--threshold over the baseline, which is saved by an earlier run with --save.
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MOESIF_APPLICATION_ID', 'benchmark')
+os.environ.setdefault('MOESIF_LAZY_INIT', 'true')
+
+from moesifapi.http.http_response import HttpResponse  # noqa: E402
+from moesif_aws_lambda import global_variable as gv  # noqa: E402
+from moesif_aws_lambda.middleware import MoesifLogger  # noqa: E402
+from moesif_aws_lambda import pooled_http_client  # noqa: E402
+
+
+class StubHttpClient(pooled_http_client.MoesifHttpClient):
+    """HTTP client answering the calls to Moesif in process, as the collector would"""
+
+    def send(self, request):
+        if request.query_url.endswith('/v1/config'):
+            return HttpResponse(200, {'X-Moesif-Config-ETag': 'benchmark'}, '{"sample_rate": 100}')
+        return HttpResponse(201, {'X-Moesif-Config-ETag': 'benchmark'}, '')
+
+
+class Context:
+    function_name = 'benchmark'
+    function_version = '$LATEST'
+    aws_request_id = 'c6af9ac6-7b61-11e6-9a41-93e812345678'
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+def build_body(body_size):
+    return json.dumps({'items': ['x' * 30] * (body_size // 35)}) if body_size else None
+
+
+def build_headers(header_count, lowercase):
+    headers = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'Host': 'abc123.execute-api.us-east-1.amazonaws.com',
+        'User-Agent': 'benchmark/1.0',
+        'X-Forwarded-For': '203.0.113.7, 10.0.0.1',
+        'X-Forwarded-Proto': 'https',
+    }
+    for index in range(len(headers), header_count):
+        headers['X-Custom-Header-%d' % index] = 'value-%d' % index
+    return dict((name.lower(), value) for name, value in headers.items()) if lowercase else headers
+
+
+def build_event(kind, body_size, header_count):
+    """Function to build an event of the kind, from the sample payloads for API Gateway"""
+    body = build_body(body_size)
+    if kind == 'alb':
+        return {
+            'requestContext': {'elb': {'targetGroupArn': 'arn:aws:elasticloadbalancing:us-east-1:123456789012:'
+                                                         'targetgroup/benchmark/6d0ecf831eec9f09'}},
+            'httpMethod': 'POST',
+            'path': '/items',
+            'queryStringParameters': {'page': '1'},
+            'headers': build_headers(header_count, lowercase=True),
+            'body': body or '',
+            'isBase64Encoded': False,
+        }
+
+    with open(os.path.join(ROOT, 'eventV1.json' if kind == 'rest' else 'eventV2.json')) as f:
+        event = json.load(f)
+    event['headers'] = build_headers(header_count, lowercase=kind == 'http')
+    event.pop('multiValueHeaders', None)
+    event['body'] = body
+    event['isBase64Encoded'] = False
+    return event
+
+
+def build_handler(body_size):
+    response = {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': build_body(body_size) or '',
+    }
+
+    def handler(event, context):
+        return copy.copy(response)
+    return handler
+
+
+def time_invocations(function, event, context, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function(event, context)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def measure(options, kind, body_size, header_count, iterations):
+    handler = build_handler(body_size)
+    middleware = MoesifLogger(options)(handler)
+    event = build_event(kind, body_size, header_count)
+    context = Context()
+
+    # Warm up, such as the caches of the client ip and the connection pool
+    time_invocations(middleware, event, context, min(iterations, 100))
+    bare = time_invocations(handler, event, context, iterations)
+    wrapped = time_invocations(middleware, event, context, iterations)
+    bare_us = statistics.median(bare) * 1e6
+    overheads = sorted(duration * 1e6 - bare_us for duration in wrapped)
+
+    # Tracing slows down the invocations, so the memory is measured on separate ones
+    count = max(iterations // 10, 10)
+    tracemalloc.start()
+    middleware(event, context)
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    peaks = []
+    for _ in range(count):
+        # The peak can only be reset from Python 3.9
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            before_bytes, _ = tracemalloc.get_traced_memory()
+            middleware(event, context)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before_bytes)
+        else:
+            middleware(event, context)
+    end_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'mean_us': statistics.mean(overheads),
+        'p50_us': overheads[len(overheads) // 2],
+        'p99_us': overheads[int(len(overheads) * 0.99)],
+        'peak_kb': statistics.median(peaks) / 1024.0 if peaks else None,
+        'retained_bytes': (end_bytes - start_bytes) / float(count),
+        'invocations_per_second': len(wrapped) / sum(wrapped),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Function to print the change of the p50 overhead of each scenario, returns the regressed scenarios"""
+    regressions = []
+    for scenario, result in sorted(results.items()):
+        base = baseline.get(scenario)
+        if base is None:
+            continue
+        change = (result['p50_us'] - base['p50_us']) / base['p50_us'] if base['p50_us'] > 0 else 0
+        print('%-28s p50 %8.1f us, baseline %8.1f us, %+6.1f%%%s' % (
+            scenario, result['p50_us'], base['p50_us'], change * 100, '  REGRESSION' if change > threshold else ''))
+        if change > threshold:
+            regressions.append(scenario)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--body-sizes', default='0,1000,32000',
+                        help='comma separated sizes of the request and response bodies')
+    parser.add_argument('--header-counts', default='10,40', help='comma separated numbers of request headers')
+    parser.add_argument('--kinds', default='rest,http,alb', help='comma separated kinds of events')
+    parser.add_argument('--batching', action='store_true', help='buffer the events with ENABLE_BATCHING')
+    parser.add_argument('--save', help='file to save the results to, as a baseline')
+    parser.add_argument('--compare', help='baseline file to compare the results with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative increase of the p50 overhead reported as a regression')
+    args = parser.parse_args()
+
+    # The calls to Moesif are answered by the stub, including the config fetched on init
+    pooled_http_client.MoesifHttpClient = StubHttpClient
+    gv.init()
+
+    options = {'LOG_BODY': True, 'ENABLE_BATCHING': args.batching}
+    results = {}
+    print('%-28s %10s %10s %10s %10s %12s %12s' % (
+        'scenario', 'mean us', 'p50 us', 'p99 us', 'peak KB', 'retained B', 'invocations/s'))
+    for kind in args.kinds.split(','):
+        for body_size in [int(size) for size in args.body_sizes.split(',')]:
+            for header_count in [int(count) for count in args.header_counts.split(',')]:
+                scenario = '%s/body=%d/headers=%d' % (kind, body_size, header_count)
+                result = measure(options, kind, body_size, header_count, args.iterations)
+                results[scenario] = result
+                print('%-28s %10.1f %10.1f %10.1f %10s %12.0f %12.0f' % (
+                    scenario, result['mean_us'], result['p50_us'], result['p99_us'],
+                    '%.1f' % result['peak_kb'] if result['peak_kb'] is not None else '-',
+                    result['retained_bytes'], result['invocations_per_second']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'batching': args.batching, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('')
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Startup benchmark of the middleware, based on `python -X importtime`.
+
+Imports `moesif_aws_lambda.middleware` in fresh interpreters, with and without
+MOESIF_LAZY_INIT, and reports the cumulative import time along with the modules
+with the highest self time. Both modes import the Moesif API SDK and requests,
+MOESIF_LAZY_INIT only defers the construction of the client.
+
+Usage:
+    python benchmarks/import_time.py [--runs 10] [--top 10] [--max-ms 200]
+
+Exits with status 1 when the median import time of a mode exceeds --max-ms.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE = 'moesif_aws_lambda.middleware'
+
+
+def parse_importtime(stderr):
+    """Returns a list of (module, self_us, cumulative_us) from the -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure(lazy):
+    env = dict(os.environ)
+    env.setdefault('MOESIF_APPLICATION_ID', 'benchmark')
+    env['MOESIF_LAZY_INIT'] = 'true' if lazy else ''
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + MODULE],
+                            env=env, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    rows = parse_importtime(result.stderr)
+    # The top level import of the module is the last line mentioning it
+    total_us = [cumulative for name, _, cumulative in rows if name == MODULE][-1]
+    return total_us, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    exceeded = False
+    for lazy in (False, True):
+        totals = []
+        rows = []
+        for _ in range(args.runs):
+            total_us, rows = measure(lazy)
+            totals.append(total_us / 1000.0)
+        median_ms = statistics.median(totals)
+        print('%s init: median %.1f ms, min %.1f ms, max %.1f ms over %d runs'
+              % ('lazy' if lazy else 'eager', median_ms, min(totals), max(totals), args.runs))
+        print('  highest self time:')
+        for name, self_us, _ in sorted(rows, key=lambda row: row[1], reverse=True)[:args.top]:
+            print('    %8.2f ms  %s' % (self_us / 1000.0, name))
+        if args.max_ms is not None and median_ms > args.max_ms:
+            print('  median exceeds --max-ms %.1f' % args.max_ms)
+            exceeded = True
+
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
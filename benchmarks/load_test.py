@@ -0,0 +1,160 @@
+"""End-to-end load test of the middleware against a local Moesif collector.
+
+Starts a `FakeCollector` with the injected latency and error rate, points the middleware at it
+with the BASE_URI option, and replays synthetic API Gateway invocations through the decorator,
+as a warm container serves them. The config of the collector changes periodically, which
+changes its etag, and user and company updates are sent along the way.
+
+Reports the invocations per second and the latency they got, then, once the buffered events are
+flushed, the events the collector received against the events captured, the requests and bytes
+it received, the injected failures and the config fetches.
+
+Usage:
+    python benchmarks/load_test.py [--invocations 5000] [--latency 0.005] [--error-rate 0.05]
+                                   [--batching] [--background] [--spool] [--compression gzip]
+                                   [--config-change-every 1000] [--profile-update-every 500]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MOESIF_APPLICATION_ID', 'load-test')
+# Nothing is sent before the middleware is pointed at the collector
+os.environ['MOESIF_LAZY_INIT'] = 'true'
+
+from moesif_aws_lambda import global_variable as gv  # noqa: E402
+from moesif_aws_lambda.fake_collector import FakeCollector  # noqa: E402
+from moesif_aws_lambda.middleware import MoesifLogger, update_company, update_user  # noqa: E402
+
+
+class Context:
+    function_name = 'load-test'
+    function_version = '$LATEST'
+
+    def __init__(self, index):
+        self.aws_request_id = 'request-%d' % index
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+def build_events(count, body_size, seed):
+    """Function to build distinct HTTP API events, with the users and clients cycling as in real traffic"""
+    rng = random.Random(seed)
+    with open(os.path.join(ROOT, 'eventV2.json')) as f:
+        template = json.load(f)
+    events = []
+    for index in range(count):
+        event = json.loads(json.dumps(template))
+        event['rawPath'] = '/items/%d' % rng.randint(1, 1000)
+        event['requestContext']['http']['path'] = event['rawPath']
+        event['headers']['x-user-id'] = 'user-%d' % rng.randint(1, 50)
+        event['headers']['x-forwarded-for'] = '203.0.113.%d' % rng.randint(1, 254)
+        event['body'] = json.dumps({'items': ['%x' % rng.getrandbits(64) for _ in range(body_size // 20)]})
+        event['isBase64Encoded'] = False
+        events.append(event)
+    return events
+
+
+def handler(event, context):
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'path': event['rawPath']}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invocations', type=int, default=5000)
+    parser.add_argument('--distinct-events', type=int, default=500, help='number of distinct events replayed')
+    parser.add_argument('--body-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.005, help='latency of the collector in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of the requests answered with an error')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--batching', action='store_true', help='buffer the events with ENABLE_BATCHING')
+    parser.add_argument('--background', action='store_true', help='send the events with SEND_IN_BACKGROUND')
+    parser.add_argument('--spool', action='store_true', help='spool the failed batches with ENABLE_SPOOL')
+    parser.add_argument('--compression', default='gzip')
+    parser.add_argument('--config-change-every', type=int, default=1000,
+                        help='number of invocations between the config changes, 0 to not change it')
+    parser.add_argument('--profile-update-every', type=int, default=500,
+                        help='number of invocations between the user and company updates, 0 to not send them')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    events = build_events(args.distinct_events, args.body_size, args.seed)
+    spool_directory = tempfile.mkdtemp()
+    with FakeCollector(latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+                       seed=args.seed) as collector:
+        options = {
+            'BASE_URI': collector.base_uri,
+            'LOG_BODY': True,
+            'IDENTIFY_USER': lambda event, context: event['headers'].get('x-user-id'),
+            'ENABLE_BATCHING': args.batching,
+            'SEND_IN_BACKGROUND': args.background,
+            'ENABLE_SPOOL': args.spool,
+            'SPOOL_PATH': os.path.join(spool_directory, 'events.spool'),
+            'COMPRESSION': args.compression,
+            # The config etag is checked on every response, so that the config changes are seen
+            'CONFIG_MAX_STALENESS_SECONDS': 1,
+        }
+        middleware = MoesifLogger(options)(handler)
+        gv.init()
+        gv.refresh_config_time_seconds = 0
+
+        durations = []
+        start = time.perf_counter()
+        for index in range(args.invocations):
+            if args.config_change_every and index and index % args.config_change_every == 0:
+                collector.set_config({'sample_rate': 100, 'version': index})
+            if args.profile_update_every and index % args.profile_update_every == 0:
+                update_user({'user_id': 'user-%d' % index, 'metadata': {'plan': 'load-test'}}, options)
+                update_company({'company_id': 'company-%d' % index}, options)
+            invocation_start = time.perf_counter()
+            middleware(events[index % len(events)], Context(index))
+            durations.append(time.perf_counter() - invocation_start)
+        elapsed = time.perf_counter() - start
+
+        # Deliver what is still buffered, as the extension does after the response, a spool retry stops at the first failure
+        middleware.flush_after_response()
+        for _ in range(5):
+            if gv.spool is None or gv.spool.is_empty():
+                break
+            middleware.retry_spooled_events(force=True)
+        collector.wait_for_events(args.invocations, timeout=10)
+        durations.sort()
+
+        paths = {}
+        for method, path, _, _ in collector.requests:
+            paths[method + ' ' + path] = paths.get(method + ' ' + path, 0) + 1
+        print('invocations:        %d in %.2f s, %.0f per second' % (args.invocations, elapsed,
+                                                                     args.invocations / elapsed))
+        print('invocation latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms, mean %.2f ms' % (
+            durations[len(durations) // 2] * 1000, durations[int(len(durations) * 0.99)] * 1000,
+            durations[-1] * 1000, statistics.mean(durations) * 1000))
+        print('events received:    %d of %d (%.1f%%)' % (len(collector.events), args.invocations,
+                                                         100.0 * len(collector.events) / args.invocations))
+        print('profiles received:  %d users, %d companies' % (len(collector.users), len(collector.companies)))
+        print('requests received:  %d, %.1f KB' % (len(collector.requests), collector.received_bytes / 1024.0))
+        for name, count in sorted(paths.items()):
+            print('    %-24s %d' % (name, count))
+        print('failures injected:  %d' % collector.failed_count)
+        print('config versions:    %d' % collector.config_version)
+        if gv.event_sender is not None:
+            print('dropped by sender:  %d oldest, %d newest, %d failed to send' % (
+                gv.event_sender.dropped_oldest_count, gv.event_sender.dropped_newest_count,
+                gv.event_sender.failed_count))
+        if gv.spool is not None:
+            print('left in the spool:  %d batches, %d evicted' % (len(gv.spool.peek()), gv.spool.evicted_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Events captured by the middleware from the sample `eventV1.json` and `eventV2.json` payloads, shared by the
+benchmarks."""
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MOESIF_APPLICATION_ID', 'benchmark')
+os.environ.setdefault('MOESIF_LAZY_INIT', 'true')
+
+from moesif_aws_lambda.middleware import MoesifLogger  # noqa: E402
+
+PAYLOAD_FILES = ('eventV1.json', 'eventV2.json')
+
+
+def capture_events(payload_file, body_size, count):
+    """Function to capture the event models of a sample payload, without sending them"""
+    def handler(event, context):
+        # Distinct bodies, so that the batches don't compress better than real traffic
+        items = [{'id': random.randint(0, 10 ** 9), 'name': 'item %x' % random.getrandbits(32)}
+                 for _ in range(body_size // 40)]
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'items': items}),
+        }
+
+    captured = []
+    middleware = MoesifLogger({'LOG_BODY': True})(handler)
+    middleware.send_event = captured.append
+    middleware.sample_request = lambda event, request_verb: True
+    with open(os.path.join(ROOT, payload_file)) as f:
+        event = json.load(f)
+    for _ in range(count):
+        middleware(event, None)
+    return captured
@@ -0,0 +1,59 @@
+"""Microbenchmark of the serialization of the events captured by the middleware.
+
+Compares, per event, building the moesifapi models and serializing them with
+`APIHelper.json_serialize` (before), with building the `__slots__` records and serializing
+them with `serialize_event` (after), on the events of the sample `eventV1.json` and
+`eventV2.json` payloads.
+
+Usage:
+    python benchmarks/serialization.py [--events 25] [--iterations 200] [--body-size 2000]
+"""
+import argparse
+import time
+
+from sample_events import PAYLOAD_FILES, capture_events
+from moesifapi.api_helper import APIHelper
+from moesifapi.models import EventModel, EventRequestModel, EventResponseModel
+from moesif_aws_lambda.serializer import (EventRecord, EventRequestRecord, EventResponseRecord, REQUEST_FIELDS,
+                                          RESPONSE_FIELDS, EVENT_FIELDS, orjson, serialize_event)
+
+
+def build(event_model, event_class, request_class, response_class):
+    """Function to build an event of the given classes with the fields of the captured event"""
+    fields = dict((name, getattr(event_model, name)) for name in EVENT_FIELDS)
+    return event_class(
+        request=request_class(**dict((name, getattr(event_model.request, name)) for name in REQUEST_FIELDS)),
+        response=response_class(**dict((name, getattr(event_model.response, name)) for name in RESPONSE_FIELDS)),
+        **fields)
+
+
+def measure(event_models, iterations, build_and_serialize):
+    start = time.process_time()
+    for _ in range(iterations):
+        for event_model in event_models:
+            build_and_serialize(event_model)
+    return (time.process_time() - start) / iterations / len(event_models) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=25)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--body-size', type=int, default=2000,
+                        help='approximate size of the response body of the sample handler')
+    args = parser.parse_args()
+
+    print('JSON library: %s' % ('orjson' if orjson is not None else 'json'))
+    for payload_file in PAYLOAD_FILES:
+        event_models = capture_events(payload_file, args.body_size, args.events)
+
+        before_us = measure(event_models, args.iterations, lambda event_model: APIHelper.json_serialize(
+            build(event_model, EventModel, EventRequestModel, EventResponseModel)))
+        after_us = measure(event_models, args.iterations, lambda event_model: serialize_event(
+            build(event_model, EventRecord, EventRequestRecord, EventResponseRecord)))
+        print('%s: models + APIHelper.json_serialize %.1f us per event, records + serialize_event %.1f us '
+              'per event (%.1fx)' % (payload_file, before_us, after_us, before_us / after_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+from moesifapi.api_helper import APIHelper
+from moesifapi.configuration import Configuration
+from moesifapi.exceptions.api_exception import APIException
+from moesifapi.http.http_context import HttpContext
+from moesifapi.http.http_response import HttpResponse
+from .circuit_breaker import CircuitOpenError
+from .overhead_budget import DeadlineExceededError
+from .compression import default_compressor
+from .event_queue import join_batch, send_events_batch
+from .batch_triggers import chunk_payloads
+from .serializer import serialize_event
+from .middleware import MoesifLogger
+from . import global_variable as gv
+import asyncio
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def call_with_deadline(deadline, function, *args):
+    """Function to call `function` from an executor thread, with its requests bounded by the deadline of the invocation"""
+    gv.http_client.set_deadline(deadline)
+    try:
+        return function(*args)
+    finally:
+        gv.http_client.set_deadline(None)
+
+
+def get_deadline():
+    return gv.overhead_budget.deadline if gv.overhead_budget is not None else None
+
+
+class AsyncHttpClient:
+    """Sends batches of serialized events without blocking the event loop.
+
+    Uses a pooled aiohttp session when aiohttp is installed, otherwise the batch is sent with the
+    synchronous API client from the default executor. Either way, the calls go through the circuit
+    breaker of the shared HTTP client.
+    """
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self.session = None
+        self.loop = None
+
+    def close_session(self):
+        """Function to close the session of a previous event loop, which can't be awaited once that loop is done"""
+        session, self.session = self.session, None
+        if session is None or session.closed:
+            return
+        connector = session.connector
+        # Closing the connector releases its connections without the loop
+        close_connector = getattr(connector, '_close', None)
+        if close_connector is not None and not connector.closed:
+            close_connector()
+        session.detach()
+
+    def get_session(self):
+        loop = asyncio.get_event_loop()
+        # Sessions are bound to their event loop, which adapters may create per invocation
+        if self.session is None or self.loop is not loop or self.session.closed:
+            self.close_session()
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+            self.loop = loop
+        return self.session
+
+    async def send_events_batch(self, payloads):
+        """Function to send a list of serialized events to /v1/events/batch, returns the response headers"""
+        if aiohttp is None:
+            return await asyncio.get_event_loop().run_in_executor(None, call_with_deadline, get_deadline(),
+                                                                  send_events_batch, gv.get_api_client(), payloads,
+                                                                  gv.compressor)
+
+        headers = {
+            'content-type': 'application/json; charset=utf-8',
+            'X-Moesif-Application-Id': Configuration.application_id,
+            'User-Agent': Configuration.version,
+        }
+        body, content_encoding = (gv.compressor or default_compressor).compress(join_batch(payloads))
+        if content_encoding is not None:
+            headers['Content-Encoding'] = content_encoding
+        url = APIHelper.clean_url(Configuration.BASE_URI + '/v1/events/batch')
+        # Bounded by what is left of the overhead budget of the invocation
+        remaining_seconds = gv.overhead_budget.remaining_seconds() if gv.overhead_budget is not None else None
+        options = {}
+        if remaining_seconds is not None:
+            options['timeout'] = aiohttp.ClientTimeout(total=max(remaining_seconds, 0.001))
+        circuit_breaker = gv.http_client.circuit_breaker if gv.http_client is not None else None
+        if circuit_breaker is not None and not circuit_breaker.allow_request():
+            raise CircuitOpenError('Not calling Moesif while the circuit breaker is open')
+        start = time.time()
+        try:
+            async with self.get_session().post(url, data=body, headers=headers, **options) as response:
+                raw_body = await response.text()
+        except Exception as ex:
+            # The only timeout is the deadline, which tells nothing of Moesif
+            if isinstance(ex, asyncio.TimeoutError) and 'timeout' in options:
+                if circuit_breaker is not None:
+                    circuit_breaker.record_abandoned()
+                raise DeadlineExceededError('The request to Moesif timed out on the deadline of the invocation')
+            if circuit_breaker is not None:
+                circuit_breaker.record_failure()
+            raise
+        if circuit_breaker is not None:
+            circuit_breaker.record_result(response.status, time.time() - start)
+        if response.status < 200 or response.status > 208:
+            raise APIException('HTTP response not OK.',
+                               HttpContext(None, HttpResponse(response.status, response.headers, raw_body)))
+        return response.headers
+
+
+def MoesifAsyncLogger(moesif_options):
+    """Decorator for async Lambda handlers, such as apps run through an ASGI adapter.
+
+    The event is captured with the same logic as `MoesifLogger`, the hooks are awaited around the
+    handler and the events are delivered without blocking the event loop.
+    """
+    log_data = MoesifLogger(moesif_options)
+
+    class async_log_data(log_data):
+        def __init__(self, handler):
+            log_data.__init__(self, handler)
+            self.start_pending(collect=False)
+            self.http_client = AsyncHttpClient(self.moesif_options.get('HTTP_POOL_SIZE', 10))
+
+        async def __call__(self, event, context):
+            try:
+                gv.init()
+                event, context = await self.before(event, context)
+                return await self.after(await self.handler(event, context))
+            except Exception as exception:
+                return await self.on_exception_async(exception)
+            finally:
+                self.finish_invocation()
+
+        async def before(self, event, context):
+            """This coroutine runs before the handler is awaited, is passed the event & context and must return an event & context too."""
+            return log_data.before(self, event, context)
+
+        async def after(self, retval):
+            """This coroutine runs after the handler is awaited, is passed the response and must return an response too."""
+            # The events are sent within the overhead budget of `after`
+            start_ns = self.start_after()
+            self.start_pending()
+            try:
+                retval = self.capture_response(retval)
+                await self.send_pending()
+            finally:
+                self.start_pending(collect=False)
+                self.finish_after(start_ns)
+            return retval
+
+        async def on_exception_async(self, exception):
+            """This coroutine captures the records of a batch trigger as failed when the handler raises, then raises"""
+            self.start_pending()
+            try:
+                log_data.on_exception(self, exception)
+            finally:
+                await self.send_pending()
+                self.start_pending(collect=False)
+
+        def start_pending(self, collect=True):
+            """Function to start collecting the events and profile updates to send, or to stop collecting them"""
+            self.pending_events = []
+            self.pending_payloads = [] if collect else None
+            self.pending_profile_updates = False
+
+        async def send_pending(self):
+            """Coroutine to send the events and profile updates collected by the synchronous processing"""
+            events, self.pending_events = self.pending_events, []
+            payloads, self.pending_payloads = self.pending_payloads, []
+            send_profile_updates, self.pending_profile_updates = self.pending_profile_updates, False
+            for event_model in events:
+                await self.send_event_async(event_model)
+            if payloads:
+                await self.send_payloads_async(payloads)
+            if send_profile_updates:
+                await asyncio.get_event_loop().run_in_executor(None, call_with_deadline, get_deadline(),
+                                                               log_data.send_profile_updates, self)
+
+        def send_event(self, event_model):
+            # Events are collected while the synchronous processing runs, and sent by `send_pending`
+            if self.pending_payloads is None:
+                return log_data.send_event(self, event_model)
+            self.pending_events.append(event_model)
+
+        def send_payloads(self, payloads):
+            if self.pending_payloads is None:
+                return log_data.send_payloads(self, payloads)
+            self.pending_payloads.extend(payloads)
+
+        def send_profile_updates(self):
+            if self.pending_payloads is None:
+                return log_data.send_profile_updates(self)
+            self.pending_profile_updates = True
+
+        async def send_batch_async(self, batch):
+            """Coroutine to send a batch of serialized events to Moesif, returns True on success"""
+            if gv.overhead_budget is not None and gv.overhead_budget.remaining_seconds() == 0:
+                self.defer_payloads(batch)
+                return False
+            try:
+                check_config = self.is_config_refresh_due()
+                response_headers = await self.http_client.send_events_batch(batch)
+                if check_config:
+                    self.update_config(response_headers)
+                if self.DEBUG:
+                    print('[moesif] Sent batch of ' + str(len(batch)) + ' events to Moesif')
+            except DeadlineExceededError:
+                self.defer_payloads(batch)
+                return False
+            except APIException as inst:
+                if 401 <= inst.response_code <= 403:
+                    print("Unauthorized access sending event to Moesif. Please check your Appplication Id.")
+                if self.DEBUG:
+                    print("Error while sending events batch, with status code:")
+                    print(inst.response_code)
+                self.spool_batch(batch, inst)
+                return False
+            except Exception as ex:
+                print("[moesif] Error while sending events batch to Moesif", ex)
+                self.spool_batch(batch, ex)
+                return False
+            if gv.spool is not None and gv.spool.is_retry_due() and not gv.spool.is_empty():
+                await asyncio.get_event_loop().run_in_executor(None, call_with_deadline, get_deadline(),
+                                                               self.retry_spooled_events)
+            return True
+
+        async def send_event_async(self, event_model):
+            """Coroutine to send the event to Moesif, or buffer it when batching is enabled"""
+            await self.send_payloads_async([serialize_event(event_model)])
+
+        async def send_payloads_async(self, payloads):
+            """Coroutine to send serialized events to Moesif in batches, or buffer them when batching is enabled"""
+            if gv.event_sender is not None:
+                for payload in payloads:
+                    gv.event_sender.put(payload)
+                return
+
+            if gv.event_queue is not None:
+                for payload in payloads:
+                    gv.event_queue.add_payload(payload)
+                if (gv.extension is not None and gv.extension.is_running) or not gv.event_queue.should_flush():
+                    return
+                batches = gv.event_queue.drain()
+            elif gv.deferred_queue is not None and len(gv.deferred_queue):
+                # The events deferred by earlier invocations are sent along with these
+                for payload in payloads:
+                    gv.deferred_queue.add_payload(payload)
+                batches = gv.deferred_queue.drain()
+            else:
+                batches = chunk_payloads(payloads, max_bytes=self.moesif_options.get('BATCH_MAX_BYTES', 200000))
+
+            for batch in batches:
+                await self.send_batch_async(batch)
+
+    return async_log_data
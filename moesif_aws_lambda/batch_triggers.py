@@ -0,0 +1,231 @@
+from datetime import datetime
+import base64
+import json
+import uuid
+from .serializer import EventRecord, EventRequestRecord, EventResponseRecord
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+# Batch triggers, by the event source of their records
+BATCH_SOURCES = {'aws:sqs': 'sqs', 'aws:kinesis': 'kinesis', 'aws:sns': 'sns'}
+
+# Bounds of the requests the events of a batch are sent in, a Kinesis batch holds up to 10000 records
+MAX_EVENTS_PER_REQUEST = 1000
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def get_batch_source(event):
+    """Function to get the batch trigger of the event: sqs, kinesis, sns or eventbridge, None for other triggers"""
+    if not isinstance(event, dict):
+        return None
+    records = event.get('Records')
+    if isinstance(records, list) and records and isinstance(records[0], dict):
+        return BATCH_SOURCES.get(records[0].get('eventSource') or records[0].get('EventSource'))
+    if 'detail-type' in event and 'source' in event and 'detail' in event:
+        return 'eventbridge'
+    return None
+
+
+def arn_to_uri(arn):
+    """Function to map the ARN of a queue, stream or topic to the URI of its service endpoint"""
+    parts = (arn or '').split(':', 5)
+    if len(parts) < 6:
+        return 'https://' + quote(arn or 'unknown', safe='')
+    return 'https://%s.%s.amazonaws.com/%s/%s' % (parts[2], parts[3], parts[4], quote(parts[5], safe='/'))
+
+
+def format_time_iso(value):
+    """Function to format an ISO 8601 UTC time such as 2019-01-02T12:45:07.000Z as an event time"""
+    return value[:23] if value else datetime.utcnow().strftime(TIME_FORMAT + '.%f')[:-3]
+
+
+class BatchTrigger:
+    """Records of an invocation by a batch trigger, such as SQS messages or Kinesis records.
+
+    The records are read in place, one at a time, into tuples of (record id, time, uri, body, metadata).
+    The bodies are sent base64 encoded, so the Kinesis data is used as is. The uris and the times to
+    the second are cached across the records, which mostly share them.
+    """
+
+    def __init__(self, source, event):
+        self.source = source
+        self.event = event
+        self.records = event['Records'] if source != 'eventbridge' else [event]
+        self.read_record = getattr(self, 'read_' + source + '_record')
+        self.uris = {}
+        self.seconds = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_uri(self, arn):
+        uri = self.uris.get(arn)
+        if uri is None:
+            uri = self.uris[arn] = arn_to_uri(arn)
+        return uri
+
+    def format_epoch(self, epoch_seconds):
+        """Function to format an epoch time as an event time, the formatting is cached by second"""
+        second, millisecond = divmod(int(round(epoch_seconds * 1000)), 1000)
+        prefix = self.seconds.get(second)
+        if prefix is None:
+            prefix = self.seconds[second] = datetime.utcfromtimestamp(second).strftime(TIME_FORMAT)
+        return '%s.%03d' % (prefix, millisecond)
+
+    @staticmethod
+    def encode_body(body, log_body, max_body_size):
+        if not log_body or body is None or len(body) > max_body_size:
+            return None
+        return base64.b64encode(body.encode('utf-8')).decode('ascii')
+
+    def read_sqs_record(self, record, log_body, max_body_size):
+        attributes = record.get('attributes') or {}
+        sent_timestamp = attributes.get('SentTimestamp')
+        time = self.format_epoch(int(sent_timestamp) / 1000.0) if sent_timestamp else format_time_iso(None)
+        metadata = {'receive_count': attributes.get('ApproximateReceiveCount')}
+        return (record.get('messageId'), time, self.get_uri(record.get('eventSourceARN')),
+                self.encode_body(record.get('body'), log_body, max_body_size), metadata)
+
+    def read_kinesis_record(self, record, log_body, max_body_size):
+        kinesis = record.get('kinesis') or {}
+        arrival = kinesis.get('approximateArrivalTimestamp')
+        time = self.format_epoch(float(arrival)) if arrival is not None else format_time_iso(None)
+        data = kinesis.get('data')
+        # Already base64 encoded
+        if not log_body or data is None or len(data) > max_body_size:
+            data = None
+        metadata = {'partition_key': kinesis.get('partitionKey')}
+        return (kinesis.get('sequenceNumber'), time, self.get_uri(record.get('eventSourceARN')), data, metadata)
+
+    def read_sns_record(self, record, log_body, max_body_size):
+        sns = record.get('Sns') or {}
+        metadata = {'subject': sns.get('Subject')} if sns.get('Subject') else None
+        return (sns.get('MessageId'), format_time_iso(sns.get('Timestamp')), self.get_uri(sns.get('TopicArn')),
+                self.encode_body(sns.get('Message'), log_body, max_body_size), metadata)
+
+    def read_eventbridge_record(self, record, log_body, max_body_size):
+        uri = 'https://events.%s.amazonaws.com/%s/%s/%s' % (record.get('region'), record.get('account'),
+                                                            quote(str(record.get('source')), safe=''),
+                                                            quote(str(record.get('detail-type')), safe=''))
+        body = json.dumps(record.get('detail'), separators=(',', ':')) if log_body else None
+        return (record.get('id'), format_time_iso(record.get('time')), uri,
+                self.encode_body(body, log_body, max_body_size), None)
+
+    def iter_records(self, log_body=True, max_body_size=1000000):
+        """Function to read the records one at a time, without copying the batch"""
+        read_record = self.read_record
+        for record in self.records:
+            yield read_record(record, log_body, max_body_size)
+
+    def get_failed_ids(self, retval):
+        """Function to get the ids of the records reported as failed by a partial batch response, all of them with None"""
+        if not isinstance(retval, dict) or not isinstance(retval.get('batchItemFailures'), list):
+            return set()
+        failed_ids = set()
+        for failure in retval['batchItemFailures']:
+            item_identifier = failure.get('itemIdentifier') if isinstance(failure, dict) else None
+            # Lambda retries the whole batch when an identifier is missing
+            if not item_identifier:
+                return None
+            failed_ids.add(item_identifier)
+        return failed_ids
+
+
+# JSON of the event of a record, with the fields of the record, then the fields shared by the batch
+RECORD_EVENT_TEMPLATE = '{"request":{"time":%s,"uri":%s,"verb":"POST"%s},"response":{"time":%s,"status":%d},' \
+                        '"direction":"Incoming","weight":%d,"transaction_id":"%s%012x","metadata":{"record_id":%s%s,%s}'
+
+encode_string = json.encoder.encode_basestring_ascii
+
+
+def encode_value(value):
+    return encode_string(value) if isinstance(value, str) else json.dumps(value)
+
+
+class RecordSerializer:
+    """Serializes the events of the records of a batch, from JSON fragments shared by the whole batch.
+
+    Builds the same JSON as `serialize_event` would for the `EventRecord` of `build_event`, without
+    constructing a model per record. The transaction ids share a random prefix for the batch and end
+    with the index of the record, rather than drawing a uuid per record.
+    """
+
+    def __init__(self, source, response_time, metadata):
+        self.response_time = encode_string(response_time)
+        # The metadata shared by the records, appended to the record id and fields of each
+        self.metadata_suffix = json.dumps(dict(metadata, trigger=source), separators=(',', ':'))[1:]
+        self.transaction_prefix = str(uuid.uuid4())[:24]
+        self.uris = {}
+        self.count = 0
+
+    def serialize(self, fields, status, weight):
+        record_id, time, uri, body, metadata = fields
+        encoded_uri = self.uris.get(uri)
+        if encoded_uri is None:
+            encoded_uri = self.uris[uri] = encode_value(uri)
+        record_metadata = ''
+        if metadata:
+            for name, value in metadata.items():
+                if value is not None:
+                    record_metadata += ',' + encode_string(name) + ':' + encode_value(value)
+        self.count += 1
+        return (RECORD_EVENT_TEMPLATE % (
+            encode_string(time), encoded_uri,
+            ',"body":"' + body + '","transfer_encoding":"base64"' if body is not None else '',
+            self.response_time, status, weight, self.transaction_prefix, self.count,
+            encode_value(record_id), record_metadata, self.metadata_suffix)).encode('utf-8')
+
+
+def chunk_payloads(payloads, max_events=MAX_EVENTS_PER_REQUEST, max_bytes=200000):
+    """Function to split serialized events into batches within the bounds, as they are serialized"""
+    batch = []
+    batch_bytes = 0
+    for payload in payloads:
+        if batch and (len(batch) >= max_events or batch_bytes + len(payload) > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(payload)
+        batch_bytes += len(payload)
+    if batch:
+        yield batch
+
+
+def build_event(source, fields, response_time, status, weight, metadata):
+    """Function to build the event record of a record of a batch, such as for the MASK_EVENT_MODEL function"""
+    record_id, time, uri, body, record_metadata = fields
+    event_metadata = {'record_id': record_id}
+    for name, value in (record_metadata or {}).items():
+        if value is not None:
+            event_metadata[name] = value
+    event_metadata.update(metadata)
+    event_metadata['trigger'] = source
+    return EventRecord(request=EventRequestRecord(time=time, uri=uri, verb='POST', body=body,
+                                                  transfer_encoding='base64' if body is not None else None),
+                       response=EventResponseRecord(time=response_time, status=status),
+                       direction='Incoming', weight=weight, metadata=event_metadata)
+
+
+def build_summary_event(source, batch, failed_ids, response_time, metadata):
+    """Function to build the event summarizing a batch, with the counts of its records and of the failed ones"""
+    first_fields = None
+    record_count = 0
+    failed_count = 0
+    for fields in batch.iter_records(log_body=False):
+        if first_fields is None:
+            first_fields = fields
+        record_count += 1
+        if failed_ids is None or fields[0] in failed_ids:
+            failed_count += 1
+    event_metadata = dict(metadata, trigger=source, record_count=record_count, failed_count=failed_count)
+    if first_fields is not None:
+        event_metadata['first_record_id'] = first_fields[0]
+    status = 200 if not failed_count else (500 if failed_count == record_count else 207)
+    return EventRecord(request=EventRequestRecord(time=first_fields[1] if first_fields else response_time,
+                                                  uri=first_fields[2] if first_fields else None, verb='POST'),
+                       response=EventResponseRecord(time=response_time, status=status),
+                       direction='Incoming', weight=1, metadata=event_metadata)
@@ -0,0 +1,68 @@
+import base64
+
+# Bodies of these content types are captured as base64 without attempting to parse them
+BINARY_CONTENT_TYPES = (
+    'application/octet-stream',
+    'application/pdf',
+    'application/zip',
+    'application/gzip',
+    'application/x-protobuf',
+    'application/grpc',
+    'image/',
+    'audio/',
+    'video/',
+    'font/',
+)
+
+# First characters of a JSON document, checked before attempting to parse a body
+JSON_START_CHARS = frozenset('{["-0123456789tfn')
+JSON_START_BYTES = frozenset(b'{["-0123456789tfn')
+
+TRUNCATION_MARKER = '...[moesif: body truncated, original length {}]'
+
+
+def get_content_type(headers):
+    """Function to get the content type from the headers, whatever the case of the header name"""
+    if not isinstance(headers, dict):
+        return None
+    for name, value in headers.items():
+        if isinstance(name, str) and name.lower() == 'content-type':
+            return value if isinstance(value, str) else None
+    return None
+
+
+def is_binary_content_type(content_type):
+    """Function to check if the body of the content type is binary"""
+    if not content_type:
+        return False
+    return content_type.strip().lower().startswith(BINARY_CONTENT_TYPES)
+
+
+def looks_like_json(body):
+    """Function to check cheaply if the str or bytes body may be JSON, from its first character"""
+    if isinstance(body, bytes):
+        start = body[:64].lstrip()
+        return bool(start) and start[0] in JSON_START_BYTES
+    start = body[:64].lstrip()
+    return bool(start) and start[0] in JSON_START_CHARS
+
+
+def exceeds(body, max_size):
+    """Function to check if the str or bytes body is larger than max_size"""
+    return max_size is not None and isinstance(body, (str, bytes)) and len(body) > max_size
+
+
+def truncate(body, max_size):
+    """Function to cut the str or bytes body to max_size, followed by a truncation marker"""
+    marker = TRUNCATION_MARKER.format(len(body))
+    if isinstance(body, bytes):
+        return body[:max_size] + marker.encode('utf-8')
+    return body[:max_size] + marker
+
+
+def truncate_base64(body, max_size):
+    """Function to cut the base64 encoded body to at most max_size characters of the original, followed by a
+    truncation marker. Only the kept part of the body is decoded."""
+    kept = body[:max_size - max_size % 4]
+    decoded = base64.b64decode(kept) + TRUNCATION_MARKER.format(len(body)).encode('utf-8')
+    return base64.b64encode(decoded).decode('ascii')
@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+from .event_queue import join_batch, send_payload
+from .profile_queue import to_profile_dict
+
+
+def read_json_lines(source):
+    """Function to read the profiles of a JSON Lines file, from its path or a file object, one JSON string per line"""
+    if isinstance(source, (str, bytes)):
+        with open(source) as f:
+            for line in f:
+                if line.strip():
+                    yield line
+    else:
+        for line in source:
+            if line.strip():
+                yield line
+
+
+class ChunkResult:
+    """Outcome of the upload of a chunk, the profiles are kept when it failed so that it can be uploaded again"""
+
+    def __init__(self, index, first_profile_index, count, size_bytes):
+        self.index = index
+        self.first_profile_index = first_profile_index
+        self.count = count
+        self.size_bytes = size_bytes
+        self.success = False
+        self.status_code = None
+        self.error = None
+        self.profiles = None
+
+    def __repr__(self):
+        return 'ChunkResult(index=%d, count=%d, success=%s, status_code=%s, error=%r)' % (
+            self.index, self.count, self.success, self.status_code, self.error)
+
+
+class BulkUploadResult:
+    """Outcome of a bulk upload, the results of the chunks in order and the rejected profiles as (index, reason)"""
+
+    def __init__(self, chunks, invalid):
+        self.chunks = chunks
+        self.invalid = invalid
+
+    @property
+    def sent_count(self):
+        return sum(chunk.count for chunk in self.chunks if chunk.success)
+
+    @property
+    def failed_count(self):
+        return sum(chunk.count for chunk in self.chunks if not chunk.success)
+
+    @property
+    def failed_chunks(self):
+        return [chunk for chunk in self.chunks if not chunk.success]
+
+    @property
+    def succeeded(self):
+        return not self.invalid and all(chunk.success for chunk in self.chunks)
+
+
+class BulkUploader:
+    """Uploads a large number of user or company profiles to a batch endpoint, in chunks sent concurrently.
+
+    The profiles are read once from any iterable, such as a generator or the lines of a JSON Lines
+    file, and may be dicts, models or JSON strings. Each is validated and serialized as it is read,
+    and appended to the current chunk, which is submitted to the thread pool once it holds
+    `chunk_size` profiles or `max_chunk_bytes` of JSON. At most `max_in_flight` chunks are pending
+    at a time, so that reading the profiles waits on the uploads instead of buffering them all.
+    """
+
+    def __init__(self, api_client, id_field, path, chunk_size=1000, max_chunk_bytes=1000000, max_workers=4,
+                 max_in_flight=None, compressor=None, debug=False):
+        self.api_client = api_client
+        self.id_field = id_field
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or max_workers * 2
+        self.compressor = compressor
+        self.debug = debug
+
+    def iter_chunks(self, profiles, invalid):
+        """Function to validate and serialize the profiles in a single pass, yields the chunks as (result, profiles, payloads)"""
+        chunk_index = 0
+        first_profile_index = 0
+        chunk = []
+        payloads = []
+        chunk_bytes = 0
+        for profile_index, profile in enumerate(profiles):
+            try:
+                profile = to_profile_dict(profile)
+            except Exception:
+                invalid.append((profile_index, 'the profile is not valid JSON'))
+                continue
+            if not isinstance(profile, dict) or profile.get(self.id_field) is None:
+                invalid.append((profile_index, 'the profile has no ' + self.id_field + ' field'))
+                continue
+            try:
+                payload = json.dumps(profile, separators=(',', ':')).encode('utf-8')
+            except (TypeError, ValueError):
+                invalid.append((profile_index, 'the profile has values which can not be serialized to JSON'))
+                continue
+
+            if chunk and (len(chunk) >= self.chunk_size or chunk_bytes + len(payload) > self.max_chunk_bytes):
+                yield ChunkResult(chunk_index, first_profile_index, len(chunk), chunk_bytes), chunk, payloads
+                chunk_index += 1
+                chunk = []
+                payloads = []
+                chunk_bytes = 0
+            if not chunk:
+                first_profile_index = profile_index
+            chunk.append(profile)
+            payloads.append(payload)
+            chunk_bytes += len(payload)
+        if chunk:
+            yield ChunkResult(chunk_index, first_profile_index, len(chunk), chunk_bytes), chunk, payloads
+
+    def send_chunk(self, result, profiles, payloads):
+        try:
+            send_payload(self.api_client, self.path, join_batch(payloads), self.compressor)
+            result.success = True
+            if self.debug:
+                print('[moesif] Uploaded chunk ' + str(result.index) + ' of ' + str(result.count) + ' profiles')
+        except Exception as ex:
+            result.status_code = getattr(ex, 'response_code', None)
+            result.error = ex
+            result.profiles = profiles
+            if result.status_code is not None and 401 <= result.status_code <= 403:
+                print("Unauthorized access sending event to Moesif. Please check your Appplication Id.")
+            print('[moesif] Error while uploading chunk ' + str(result.index) + ' of ' + str(result.count) +
+                  ' profiles to Moesif', ex)
+        return result
+
+    def upload(self, profiles):
+        """Function to upload the profiles of an iterable, or of a JSON Lines file given by its path, returns a BulkUploadResult"""
+        if isinstance(profiles, (str, bytes)):
+            profiles = read_json_lines(profiles)
+        invalid = []
+        results = []
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for result, chunk, payloads in self.iter_chunks(profiles, invalid):
+                in_flight.acquire()
+                future = executor.submit(self.send_chunk, result, chunk, payloads)
+                future.add_done_callback(lambda _: in_flight.release())
+                results.append(result)
+        for profile_index, reason in invalid[:10]:
+            print('[moesif] Skipped profile ' + str(profile_index) + ' of the bulk upload, ' + reason)
+        if len(invalid) > 10:
+            print('[moesif] Skipped ' + str(len(invalid)) + ' profiles of the bulk upload in total')
+        return BulkUploadResult(results, invalid)
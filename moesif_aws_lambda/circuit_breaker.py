@@ -0,0 +1,98 @@
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Moesif while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calling Moesif while it is failing, so that an outage doesn't slow down every invocation.
+
+    The circuit opens after `failure_threshold` consecutive failures, which are errors, 429 and 5xx
+    responses, and calls slower than `slow_call_seconds`. While it is open, calls are rejected
+    without being sent. After `reset_seconds`, the circuit half-opens and lets `probe_count` calls
+    through: it closes if they succeed, and opens again if one fails.
+    """
+
+    def __init__(self, failure_threshold=5, slow_call_seconds=5, reset_seconds=30, probe_count=1):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.probe_count = probe_count
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self.probe_started_at = None
+        self.lock = threading.Lock()
+
+        # Counters
+        self.opened_count = 0
+        self.rejected_count = 0
+
+    def allow_request(self):
+        """Function to check if a call may be sent, returns False while the circuit is open"""
+        with self.lock:
+            now = time.time()
+            if self.state == OPEN:
+                if now - self.opened_at < self.reset_seconds:
+                    self.rejected_count += 1
+                    return False
+                self.state = HALF_OPEN
+                self.probes_in_flight = 0
+            if self.state == HALF_OPEN:
+                # Probes which never completed don't keep the circuit half-open forever
+                if self.probes_in_flight >= self.probe_count and now - self.probe_started_at < self.reset_seconds:
+                    self.rejected_count += 1
+                    return False
+                if self.probes_in_flight >= self.probe_count:
+                    self.probes_in_flight = 0
+                self.probes_in_flight += 1
+                self.probe_started_at = now
+            return True
+
+    def record_result(self, status_code, elapsed_seconds):
+        """Function to record the outcome of a call which got a response"""
+        if status_code == 429 or status_code >= 500 or \
+                (self.slow_call_seconds is not None and elapsed_seconds > self.slow_call_seconds):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self.probes_in_flight = 0
+                print('[moesif] Moesif API recovered, closed the circuit breaker')
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self.consecutive_failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.time()
+                self.opened_count += 1
+                print('[moesif] Moesif API is failing, opened the circuit breaker for ' + str(self.reset_seconds) +
+                      ' seconds after ' + str(self.consecutive_failures) + ' consecutive failures')
+
+    def record_abandoned(self):
+        """Function to record a call given up by the caller, such as on its deadline, which tells nothing of Moesif"""
+        with self.lock:
+            if self.state == HALF_OPEN and self.probes_in_flight > 0:
+                self.probes_in_flight -= 1
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'opened_count': self.opened_count,
+            'rejected_count': self.rejected_count,
+        }
@@ -1,100 +1,106 @@
-import re
+from .headers import HeaderIndex
+from functools import lru_cache
+import ipaddress
+
+# Headers carrying the client ip address, lowercased, in the order they are checked
+IP_HEADERS = (
+    # Standard headers used by Amazon EC2, Heroku, and others.
+    'x-client-ip',
+    # Load-balancers (AWS ELB) or proxies.
+    'x-forwarded-for',
+    # Cloudflare.
+    # @see https://support.cloudflare.com/hc/en-us/articles/200170986-How-does-Cloudflare-handle-HTTP-Request-headers-
+    # CF-Connecting-IP - applied to every request to the origin.
+    'cf-connecting-ip',
+    # Akamai and Cloudflare: True-Client-IP.
+    'true-client-ip',
+    # Default nginx proxy/fcgi; alternative to x-forwarded-for, used by some proxies.
+    'x-real-ip',
+    # (Rackspace LB and Riverbed's Stingray)
+    # http://www.rackspace.com/knowledge_center/article/controlling-access-to-linux-cloud-sites-based-on-the-client-ip-address
+    # https://splash.riverbed.com/docs/DOC-1926
+    'x-cluster-client-ip',
+    'x-forwarded',
+    'forwarded-for',
+    'forwarded',
+)
+IP_HEADER_NAMES = frozenset(IP_HEADERS)
+
+
+@lru_cache(maxsize=1024)
+def is_ip_address(value):
+    """Function to check if the string is an IPv4 or IPv6 address"""
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+@lru_cache(maxsize=256)
+def resolve_forwarded_for(value):
+    """Function to get the client ip address from a x-forwarded-for chain, None if there is none.
+
+    The chains of a container's clients repeat across invocations, so the recently resolved ones are cached.
+    """
+    # x-forwarded-for may return multiple IP addresses in the format:
+    # "client IP, proxy 1 IP, proxy 2 IP"
+    # Therefore, the right-most IP address is the IP address of the most recent proxy
+    # and the left-most IP address is the IP address of the originating client.
+    # source: http://docs.aws.amazon.com/elasticloadbalancing/latest/classic/x-forwarded-headers.html
+    # Azure Web App's also adds a port for some reason, so we'll only use the first part (the IP)
+    for e in value.split(','):
+        ip = e.strip()
+        if ':' in ip:
+            splitted = ip.split(':')
+            if len(splitted) == 2 and is_ip_address(splitted[0]):
+                return splitted[0]
+        # Sometimes IP addresses in this header can be 'unknown' (http://stackoverflow.com/a/11285650).
+        # Therefore taking the left-most IP address that is not unknown
+        # A Squid configuration directive can also set the value to "unknown" (http://www.squid-cache.org/Doc/config/forwarded_for/)
+        if is_ip_address(ip):
+            return ip
+    return None
+
 
 class ClientIp:
 
     def is_ip(self, value):
-        if not value is None:
-            ipv4 = r"^(?:(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])\.){3}(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])$"
-            ipv6 = r"^((?=.*::)(?!.*::.+::)(::)?([\dA-F]{1,4}:(:|\b)|){5}|([\dA-F]{1,4}:){6})((([\dA-F]{1,4}((?!\3)::|:\b|$))|(?!\2\3)){2}|(((2[0-4]|1\d|[1-9])?\d|25[0-5])\.?\b){4})$/i"
-            return re.match(ipv4, value) or re.match(ipv6, value)
+        return isinstance(value, str) and is_ip_address(value)
 
     def getClientIpFromXForwardedFor(self, value):
-        try:
-
-            if not value or value is None:
-                return None
+        if not value:
+            return None
 
-            if not isinstance(value, str):
-                print("Expected a string, got -" + str(type(value)))
-            else:
-                # x-forwarded-for may return multiple IP addresses in the format:
-                # "client IP, proxy 1 IP, proxy 2 IP"
-                # Therefore, the right-most IP address is the IP address of the most recent proxy
-                # and the left-most IP address is the IP address of the originating client.
-                # source: http://docs.aws.amazon.com/elasticloadbalancing/latest/classic/x-forwarded-headers.html
-                # Azure Web App's also adds a port for some reason, so we'll only use the first part (the IP)
-                forwardedIps = []
+        if not isinstance(value, str):
+            print("Expected a string, got -" + str(type(value)))
+            return None
 
-                for e in value.split(','):
-                    ip = e.strip()
-                    if ':' in ip:
-                        splitted = ip.split(':')
-                        if (len(splitted) == 2):
-                            forwardedIps.append(splitted[0])
-                    forwardedIps.append(ip)
+        forwarded_ip = resolve_forwarded_for(value)
+        return forwarded_ip if forwarded_ip is not None else value.encode('utf-8')
 
-                # Sometimes IP addresses in this header can be 'unknown' (http://stackoverflow.com/a/11285650).
-                # Therefore taking the left-most IP address that is not unknown
-                # A Squid configuration directive can also set the value to "unknown" (http://www.squid-cache.org/Doc/config/forwarded_for/)
-                return next(item for item in forwardedIps if self.is_ip(item))
-        except StopIteration:
-            return value.encode('utf-8')
+    def get_ip_headers(self, headers):
+        """Function to get the headers carrying the client ip address, by lowercased name, in a single pass over the headers"""
+        ip_headers = {}
+        for name, value in headers.items():
+            name = name.lower()
+            if name in IP_HEADER_NAMES and value:
+                ip_headers[name] = value
+        return ip_headers
 
     def get_client_address(self, headers, default_source_ip):
         try:
-            # Standard headers used by Amazon EC2, Heroku, and others.
-            if 'X-Client-Ip' in headers:
-                if self.is_ip(headers['X-Client-Ip']):
-                    return headers['X-Client-Ip']
-
-            # Load-balancers (AWS ELB) or proxies.
-            if 'X-Forwarded-For' in headers:
-                xForwardedFor = self.getClientIpFromXForwardedFor(headers['X-Forwarded-For'])
-                if self.is_ip(xForwardedFor):
-                    return xForwardedFor
-
-            # Cloudflare.
-            # @see https://support.cloudflare.com/hc/en-us/articles/200170986-How-does-Cloudflare-handle-HTTP-Request-headers-
-            # CF-Connecting-IP - applied to every request to the origin.
-            if 'Cf-Connecting-Ip' in headers:
-                if self.is_ip(headers['Cf-Connecting-Ip']):
-                    return headers['Cf-Connecting-Ip']
-
-            # Akamai and Cloudflare: True-Client-IP.
-            if 'True-Client-Ip' in headers:
-                if self.is_ip(headers['True-Client-Ip']):
-                    return headers['True-Client-Ip']
-
-            # Default nginx proxy/fcgi; alternative to x-forwarded-for, used by some proxies.
-            if 'X-Real-Ip' in headers:
-                if self.is_ip(headers['X-Real-Ip']):
-                    return headers['X-Real-Ip']
-
-            # (Rackspace LB and Riverbed's Stingray)
-            # http://www.rackspace.com/knowledge_center/article/controlling-access-to-linux-cloud-sites-based-on-the-client-ip-address
-            # https://splash.riverbed.com/docs/DOC-1926
-            if 'X-Cluster-Client-Ip' in headers:
-                if self.is_ip(headers['X-Cluster-Client-Ip']):
-                    return headers['X-Cluster-Client-Ip']
-
-            if 'X-Forwarded' in headers:
-                if self.is_ip(headers['X-Forwarded']):
-                    return headers['X-Forwarded']
-
-            if 'Forwarded-For' in headers:
-                if self.is_ip(headers['Forwarded-For']):
-                    return headers['Forwarded-For']
-
-            if 'Forwarded' in headers:
-                if self.is_ip(headers['Forwarded']):
-                    return headers['Forwarded']
-
-            if default_source_ip:
-                return default_source_ip
-            else:
-                return None
+            if headers:
+                # A header index is looked up directly, other headers are indexed first
+                ip_headers = headers if isinstance(headers, HeaderIndex) else self.get_ip_headers(headers)
+                for name in IP_HEADERS:
+                    value = ip_headers.get(name)
+                    if not value:
+                        continue
+                    if name == 'x-forwarded-for':
+                        value = self.getClientIpFromXForwardedFor(value)
+                    if self.is_ip(value):
+                        return value
         except Exception:
-            if default_source_ip:
-                return default_source_ip
-            else:
-                return None
+            pass
+        return default_source_ip or None
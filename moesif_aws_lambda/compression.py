@@ -0,0 +1,49 @@
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+IDENTITY = 'identity'
+
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3, IDENTITY: None}
+
+
+class Compressor:
+    """Compresses the bodies sent to Moesif with the configured codec.
+
+    Bodies smaller than `min_size` bytes are sent uncompressed, since compressing them costs more
+    CPU than it saves on the wire. The `zstd` codec requires the `zstandard` package, gzip is used
+    when it is not installed.
+    """
+
+    def __init__(self, codec=GZIP, level=None, min_size=1024):
+        codec = (codec or IDENTITY).lower()
+        if codec == 'none':
+            codec = IDENTITY
+        if codec not in DEFAULT_LEVELS:
+            print('[moesif] Unsupported COMPRESSION ' + codec + ', compressing with gzip instead')
+            codec = GZIP
+            level = None
+        if codec == ZSTD and zstandard is None:
+            print('[moesif] zstandard is not installed, compressing with gzip instead')
+            codec = GZIP
+            level = None
+        self.codec = codec
+        self.level = level if level is not None else DEFAULT_LEVELS[codec]
+        self.min_size = min_size or 0
+
+    def compress(self, body):
+        """Function to compress the body, returns the body and its content encoding, None if it is not compressed"""
+        if self.codec == IDENTITY or len(body) < self.min_size:
+            return body, None
+        if self.codec == ZSTD:
+            # Compressor objects can't be shared across threads, and are cheap to create
+            return zstandard.ZstdCompressor(level=self.level).compress(body), ZSTD
+        return gzip.compress(body, compresslevel=self.level), GZIP
+
+
+default_compressor = Compressor()
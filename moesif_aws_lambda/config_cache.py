@@ -0,0 +1,116 @@
+from .sampling_rules import SamplingRules
+import threading
+import time
+
+
+class ConfigCache:
+    """Serves the last known app config immediately and refreshes it in a background thread.
+
+    A refresh is started when the config etag changes, or when the config is older than
+    `max_staleness_seconds`, so no invocation waits on fetching the config. A refresh requested while
+    a fetch is running is made once it is done. The sampling rules are parsed once per config etag,
+    when the config is fetched.
+    """
+
+    def __init__(self, app_config, max_staleness_seconds=300, on_update=None):
+        self.app_config = app_config
+        self.max_staleness_seconds = max_staleness_seconds
+        self.on_update = on_update
+        self.config = None
+        self.config_etag = None
+        self.sampling_rules = SamplingRules()
+        self.fetched_at = None
+        # Config etag of the event responses the config was last fetched for
+        self.response_etag = None
+        self.refresh_thread = None
+        self.refreshing = False
+        self.fetching_etag = None
+        self.pending_refresh = None
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at > self.max_staleness_seconds
+
+    def is_refreshing(self):
+        return self.refreshing
+
+    def is_outdated(self, response_etag):
+        """Function to check if the config etag of an event response is newer than the config"""
+        return response_etag != self.response_etag
+
+    def get(self, api_client=None, debug=False):
+        """Function to return the last known config, a refresh is started if it is stale"""
+        if api_client is not None and self.is_stale() and not self.refreshing:
+            self.refresh(api_client, debug)
+        return self.config
+
+    def get_sampling_rules(self, api_client=None, debug=False):
+        """Function to return the sampling rules of the last known config, a refresh is started if it is stale"""
+        self.get(api_client, debug)
+        return self.sampling_rules
+
+    def refresh(self, api_client, debug=False, response_etag=None):
+        """Function to fetch the config in a background thread, or once the running fetch is done.
+
+        `response_etag` is the config etag of the event response which prompted the refresh, if any.
+        """
+        with self.lock:
+            if self.refreshing:
+                # A fetch started since the etag changed already gets it, other changes such as of the
+                # BASE_URI need another fetch
+                if response_etag is None or response_etag != self.fetching_etag:
+                    self.pending_refresh = (api_client, debug, response_etag)
+                return
+            self.refreshing = True
+            self.refresh_thread = threading.Thread(target=self.run_refreshes, args=(api_client, debug, response_etag),
+                                                   name='moesif-config-refresh')
+            self.refresh_thread.daemon = True
+            self.refresh_thread.start()
+
+    def run_refreshes(self, api_client, debug, response_etag):
+        """Function to fetch the config, then again for each refresh requested meanwhile"""
+        while True:
+            self.fetching_etag = response_etag
+            try:
+                self.fetch(api_client, debug, response_etag)
+            finally:
+                with self.lock:
+                    pending = self.pending_refresh
+                    self.pending_refresh = None
+                    if pending is None:
+                        self.refreshing = False
+                        self.fetching_etag = None
+            if pending is None:
+                return
+            api_client, debug, response_etag = pending
+
+    def fetch(self, api_client, debug=False, response_etag=None):
+        """Function to fetch the config, the last known config is kept if the fetch fails"""
+        try:
+            config = self.app_config.get_config(api_client, debug)
+        except Exception as e:
+            print('[moesif] Error while fetching the app config, using the last known config', e)
+            config = None
+        # Retry on the next staleness check rather than on every invocation
+        self.fetched_at = time.time()
+        if config is not None:
+            config_etag = self.get_etag(config)
+            if config_etag is None or config_etag != self.config_etag:
+                self.sampling_rules = SamplingRules.from_config(config)
+                self.config_etag = config_etag
+            # Only once it is fetched, so that a failed fetch is made again on the next response
+            if response_etag is not None:
+                self.response_etag = response_etag
+            self.config = config
+            if self.on_update is not None:
+                self.on_update(config)
+        if debug:
+            print('[moesif] App config refreshed')
+        return self.config
+
+    @classmethod
+    def get_etag(cls, config):
+        try:
+            return config.headers.get('X-Moesif-Config-ETag')
+        except AttributeError:
+            return None
@@ -0,0 +1,116 @@
+from moesifapi.api_helper import APIHelper
+from moesifapi.configuration import Configuration
+from moesifapi.http.http_context import HttpContext
+from .compression import default_compressor
+from .serializer import serialize_event
+import threading
+import time
+
+
+def send_payload(api_client, path, body, compressor=None):
+    """Function to POST a serialized JSON body to the Moesif API, compressed with the compressor, returns the response headers"""
+    _query_url = APIHelper.clean_url(Configuration.BASE_URI + path)
+
+    _headers = {
+        'content-type': 'application/json; charset=utf-8',
+        'X-Moesif-Application-Id': Configuration.application_id,
+        'User-Agent': Configuration.version,
+    }
+
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    _body, content_encoding = (compressor or default_compressor).compress(body)
+    if content_encoding is not None:
+        _headers['Content-Encoding'] = content_encoding
+
+    _request = api_client.http_client.post(_query_url, headers=_headers, parameters=_body)
+    if api_client.http_call_back is not None:
+        api_client.http_call_back.on_before_request(_request)
+
+    _response = api_client.http_client.execute_as_string(_request)
+    _context = HttpContext(_request, _response)
+    if api_client.http_call_back is not None:
+        api_client.http_call_back.on_after_response(_context)
+
+    api_client.validate_response(_context)
+    return _response.headers
+
+
+def send_event(api_client, payload, compressor=None):
+    """Function to send a serialized event to /v1/events, returns the response headers"""
+    return send_payload(api_client, '/v1/events', payload, compressor)
+
+
+def send_events_batch(api_client, payloads, compressor=None):
+    """Function to send a list of serialized events to /v1/events/batch, returns the response headers"""
+    return send_payload(api_client, '/v1/events/batch', join_batch(payloads), compressor)
+
+
+def join_batch(payloads):
+    """Function to build the JSON array of a batch of serialized events"""
+    # The events are already serialized, so the batch body is built by joining them
+    return b'[' + b','.join(payload if isinstance(payload, bytes) else payload.encode('utf-8')
+                            for payload in payloads) + b']'
+
+
+class EventQueue:
+    """Buffers serialized events across warm invocations until a batch is due.
+
+    A batch is due once it holds `batch_size` events, `max_batch_bytes` of serialized
+    events, or when its oldest event has waited more than `max_age_seconds`.
+    """
+
+    def __init__(self, batch_size=25, max_batch_bytes=200000, max_age_seconds=5):
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_age_seconds = max_age_seconds
+        self.events = []
+        self.size_bytes = 0
+        self.oldest_event_time = None
+        # The queue may be drained by the Lambda extension thread
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event_model):
+        """Function to serialize and buffer an event"""
+        self.add_payload(serialize_event(event_model))
+
+    def add_payload(self, payload):
+        """Function to buffer a serialized event"""
+        with self.lock:
+            if not self.events:
+                self.oldest_event_time = time.time()
+            self.events.append(payload)
+            self.size_bytes += len(payload)
+
+    def should_flush(self):
+        """Function to check if any of the batch bounds is reached"""
+        if not self.events:
+            return False
+        return len(self.events) >= self.batch_size \
+            or self.size_bytes >= self.max_batch_bytes \
+            or time.time() - self.oldest_event_time >= self.max_age_seconds
+
+    def drain(self):
+        """Function to empty the queue, returns the buffered events split into batches within the bounds"""
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.size_bytes = 0
+            self.oldest_event_time = None
+
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for payload in events:
+            if batch and (len(batch) >= self.batch_size or batch_bytes + len(payload) > self.max_batch_bytes):
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(payload)
+            batch_bytes += len(payload)
+        if batch:
+            batches.append(batch)
+        return batches
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+EXTENSION_API_VERSION = '2020-01-01'
+
+
+class LambdaExtension:
+    """Internal Lambda extension which flushes the buffered events after the response is returned.
+
+    Lambda only freezes the execution environment once the runtime and every registered extension
+    asked for the next event, so flushing between receiving an INVOKE event and asking for the next
+    one runs after the handler's response was sent back to the caller.
+    See https://docs.aws.amazon.com/lambda/latest/dg/runtimes-extensions-api.html
+    """
+
+    def __init__(self, flush, runtime_api=None, name='moesif-flusher', events=('INVOKE',), debug=False):
+        self.flush = flush
+        self.runtime_api = runtime_api or os.environ.get('AWS_LAMBDA_RUNTIME_API')
+        self.name = name
+        self.events = list(events)
+        self.debug = debug
+        self.extension_id = None
+        self.is_running = False
+        # Set during the last flush, before the execution environment shuts down
+        self.invocation_done = threading.Event()
+        self.thread = None
+
+    def build_url(self, path):
+        return 'http://' + self.runtime_api + '/' + EXTENSION_API_VERSION + '/extension/' + path
+
+    def register(self):
+        """Function to register the extension with the Extensions API"""
+        request = Request(self.build_url('register'),
+                          data=json.dumps({'events': self.events}).encode('utf-8'),
+                          headers={'Lambda-Extension-Name': self.name})
+        response = urlopen(request)
+        self.extension_id = response.headers.get('Lambda-Extension-Identifier')
+        response.read()
+
+    def next_event(self):
+        """Function to block until Lambda sends the next lifecycle event"""
+        request = Request(self.build_url('event/next'),
+                          headers={'Lambda-Extension-Identifier': self.extension_id})
+        response = urlopen(request)
+        return json.loads(response.read())
+
+    def start(self):
+        """Function to register the extension and start the event loop thread, returns True on success"""
+        if self.is_running:
+            return True
+        if not self.runtime_api:
+            if self.debug:
+                print('[moesif] AWS_LAMBDA_RUNTIME_API is not set, cannot register the Lambda extension')
+            return False
+        try:
+            self.register()
+        except Exception as e:
+            print('[moesif] Error while registering the Lambda extension', e)
+            return False
+
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def invocation_finished(self):
+        """Function to signal that the handler returned and its events are buffered"""
+        self.invocation_done.set()
+
+    def run(self):
+        """Function to process lifecycle events until SHUTDOWN"""
+        try:
+            while True:
+                event = self.next_event()
+                event_type = event.get('eventType')
+                if event_type == 'INVOKE':
+                    # Wait for the handler, but never past the invocation deadline
+                    deadline_ms = event.get('deadlineMs')
+                    timeout = None if deadline_ms is None else max(deadline_ms / 1000.0 - time.time(), 0)
+                    self.invocation_done.wait(timeout)
+                    self.invocation_done.clear()
+                    self.safe_flush()
+                elif event_type == 'SHUTDOWN':
+                    if self.debug:
+                        print('[moesif] Draining events on SHUTDOWN, reason: ' + str(event.get('shutdownReason')))
+                    self.safe_flush()
+                    break
+        except Exception as e:
+            print('[moesif] Lambda extension stopped, events will be sent inline', e)
+        finally:
+            self.is_running = False
+
+    def safe_flush(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print('[moesif] Error while flushing events from the Lambda extension', e)
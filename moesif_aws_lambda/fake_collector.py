@@ -0,0 +1,188 @@
+"""Local stand-in for the Moesif API, to test event delivery against errors and latency without the collector."""
+from .fake_extensions_api import ThreadingHTTPServer
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+# Endpoints which receive events, users or companies
+RECORD_PATHS = frozenset(('/v1/events', '/v1/events/batch', '/v1/users', '/v1/users/batch', '/v1/companies',
+                          '/v1/companies/batch'))
+
+
+class FakeCollector:
+    """Serves the event, user, company and config endpoints of the Moesif API on a local port.
+
+    The received events, users and companies are kept in `events`, `users` and `companies`, and every
+    request in `requests` as (method, path, content encoding, number of records). Errors are injected
+    with `fail()` or at random with `error_rate`, latency with `latency`, and config changes, which
+    change the config etag, with `set_config()`.
+
+    Usage::
+
+        with FakeCollector() as collector:
+            moesif_options['BASE_URI'] = collector.base_uri
+            collector.fail(count=3, status=503)
+            ...
+            collector.wait_for_events(1)
+    """
+
+    def __init__(self, config=None, latency=0, error_rate=0, error_status=503, seed=None):
+        self.config = config if config is not None else {'sample_rate': 100}
+        self.config_version = 1
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.requests = []
+        self.events = []
+        self.users = []
+        self.companies = []
+        self.received_bytes = 0
+        self.failures = []
+        self.failed_count = 0
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.build_handler())
+        self.thread = None
+
+    @property
+    def config_etag(self):
+        # Derived from the config as by Moesif, so collectors serving different configs don't share etags
+        return hashlib.md5(json.dumps(self.config, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @property
+    def base_uri(self):
+        return 'http://127.0.0.1:' + str(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def fail(self, count=1, status=503):
+        """Respond to the next `count` requests with `status`, a status of None closes the connection instead"""
+        with self.condition:
+            self.failures = [status] * count
+
+    def set_config(self, config):
+        """Function to change the config, the responses then carry a new config etag"""
+        with self.condition:
+            self.config = config
+            self.config_version += 1
+
+    def next_failure(self):
+        with self.condition:
+            if self.failures:
+                self.failed_count += 1
+                return True, self.failures.pop(0)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.failed_count += 1
+                return True, self.error_status
+            return False, None
+
+    def record(self, method, path, content_encoding, records, size=0):
+        with self.condition:
+            self.requests.append((method, path, content_encoding, len(records)))
+            self.received_bytes += size
+            if path.startswith('/v1/events'):
+                self.events.extend(records)
+            elif path.startswith('/v1/users'):
+                self.users.extend(records)
+            elif path.startswith('/v1/companies'):
+                self.companies.extend(records)
+            self.condition.notify_all()
+
+    def wait_for_events(self, count, timeout=5):
+        """Block until `count` events were received, returns False on timeout"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while len(self.events) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def build_handler(self):
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length) if length else b''
+                self.body_size = len(data)
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    data = gzip.decompress(data)
+                return json.loads(data) if data else None
+
+            def send_json(self, body, status=201, headers=None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-Moesif-Config-ETag', collector.config_etag)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def respond(self, handle):
+                if collector.latency:
+                    time.sleep(collector.latency)
+                failed, status = collector.next_failure()
+                if failed:
+                    if status is None:
+                        self.close_connection = True
+                        self.connection.close()
+                    else:
+                        self.send_json({'error': 'injected failure'}, status)
+                    return
+                handle()
+
+            def do_POST(self):
+                # The body is read first, so that failures are responded once the request is received
+                body = self.read_body()
+
+                def handle():
+                    if self.path.split('?')[0] in RECORD_PATHS:
+                        records = body if isinstance(body, list) else [body]
+                    else:
+                        records = []
+                    collector.record('POST', self.path, self.headers.get('Content-Encoding'), records, self.body_size)
+                    self.send_json({})
+                self.respond(handle)
+
+            def do_GET(self):
+                def handle():
+                    if self.path.startswith('/v1/config'):
+                        collector.record('GET', self.path, None, [])
+                        self.send_json(collector.config, 200)
+                    elif self.path.startswith('/v1/rules'):
+                        collector.record('GET', self.path, None, [])
+                        self.send_json([], 200)
+                    else:
+                        self.send_error(404)
+                self.respond(handle)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,154 @@
+"""Local stand-in for the Lambda Extensions API, to test the extension lifecycle without AWS."""
+import json
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeExtensionsApi:
+    """Serves the register and event/next endpoints of the Extensions API on a local port.
+
+    Lifecycle events are queued with `invoke()` and `shutdown()`; `wait_for_next()` blocks until the
+    extension asks for the next event, which is when Lambda would freeze the execution environment.
+
+    Usage::
+
+        with FakeExtensionsApi() as api:
+            extension = LambdaExtension(flush, runtime_api=api.address)
+            extension.start()
+            api.invoke()
+            ...
+            api.wait_for_next()
+    """
+
+    def __init__(self, function_name='fake-function'):
+        self.function_name = function_name
+        self.registrations = []
+        self.errors = []
+        self.pending_events = []
+        self.waiting_count = 0
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.build_handler())
+        self.thread = None
+
+    @property
+    def address(self):
+        """Host and port, in the format of the AWS_LAMBDA_RUNTIME_API environment variable"""
+        return '127.0.0.1:' + str(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def invoke(self, request_id=None, timeout_ms=3000):
+        """Queue an INVOKE event"""
+        self.push_event({
+            'eventType': 'INVOKE',
+            'deadlineMs': int(time.time() * 1000) + timeout_ms,
+            'requestId': request_id or str(uuid.uuid4()),
+            'invokedFunctionArn': 'arn:aws:lambda:us-east-1:123456789012:function:' + self.function_name,
+            'tracing': {},
+        })
+
+    def shutdown(self, reason='spindown'):
+        """Queue a SHUTDOWN event"""
+        self.push_event({
+            'eventType': 'SHUTDOWN',
+            'shutdownReason': reason,
+            'deadlineMs': int(time.time() * 1000) + 2000,
+        })
+
+    def push_event(self, event):
+        with self.condition:
+            self.pending_events.append(event)
+            self.condition.notify_all()
+
+    def wait_for_next(self, timeout=5):
+        """Block until the extension processed every queued event and asked for the next one,
+        returns False on timeout"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.pending_events or self.waiting_count == 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def next_event(self):
+        with self.condition:
+            self.waiting_count += 1
+            self.condition.notify_all()
+            while not self.pending_events:
+                self.condition.wait()
+            self.waiting_count -= 1
+            self.condition.notify_all()
+            return self.pending_events.pop(0)
+
+    def build_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+            def send_json(self, body, headers=None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.read_body()
+                if self.path.endswith('/extension/register'):
+                    extension_id = str(uuid.uuid4())
+                    api.registrations.append({'name': self.headers.get('Lambda-Extension-Name'),
+                                              'events': body.get('events', []),
+                                              'id': extension_id})
+                    self.send_json({'functionName': api.function_name, 'functionVersion': '$LATEST',
+                                    'handler': 'lambda_function.lambda_handler'},
+                                   {'Lambda-Extension-Identifier': extension_id})
+                elif self.path.endswith('/error'):
+                    api.errors.append({'path': self.path, 'body': body})
+                    self.send_json({'status': 'OK'})
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                if self.path.endswith('/extension/event/next'):
+                    self.send_json(api.next_event())
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
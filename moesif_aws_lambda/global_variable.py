@@ -1,13 +1,20 @@
 """This module is to declare global objects."""
 from datetime import datetime
-from moesifapi.app_config.app_config import AppConfig
-from moesifapi.moesif_api_client import *
 import os
+import threading
 
 # MoesifAPI Client
 global api_client
 api_client = None
 
+# HTTP client with the connection pool shared by the calls made through the api client
+global http_client
+http_client = None
+
+# Compressor of the bodies sent to Moesif
+global compressor
+compressor = None
+
 # App Config class
 global app_config
 app_config = None
@@ -16,6 +23,10 @@ app_config = None
 global config
 config = None
 
+# Cache serving the last known App Config while it is refreshed in the background
+global config_cache
+config_cache = None
+
 # App Config sampling percentage
 global sampling_percentage
 sampling_percentage = 100
@@ -32,16 +43,142 @@ last_updated_time = datetime.utcnow()
 global refresh_config_time_seconds
 refresh_config_time_seconds = 2 * 60
 
-# initialize the config first time on cold start.
-print("[moesif] start init - config")
+# Events buffered across warm invocations, created when batching is enabled
+global event_queue
+event_queue = None
+
+# Background thread sending events, created when sending in background is enabled
+global event_sender
+event_sender = None
+
+# Queues of the user and company profile updates, by id field, created when the profile updates are batched
+global profile_queues
+profile_queues = {}
+
+# Spool in /tmp of the batches which failed to be delivered, created when spooling is enabled
+global spool
+spool = None
+
+# Events deferred once the overhead budget of their invocation was exceeded, when batching is disabled
+global deferred_queue
+deferred_queue = None
+
+# Bound of the time the middleware adds to each invocation
+global overhead_budget
+overhead_budget = None
+
+# Sampling decisions and rate limits of the events, kept across warm invocations
+global sampler
+sampler = None
+
+# Histograms of the time spent in each phase of the middleware
+global timings
+timings = None
+
+# Lambda extension flushing the event queue after the response is returned
+global extension
+extension = None
+
+# Options applied to the clients once they are initialized
+global options
+options = {}
+
+# Defer the initialization to the first use, see `init`
+global lazy_init
+lazy_init = os.environ.get("MOESIF_LAZY_INIT", "").lower() in ("1", "true", "yes")
+
+init_lock = threading.Lock()
+
+
+def set_config(new_config):
+    """Function to keep the App Config and its eTag in sync with the config cache"""
+    global config, config_etag
+    config = new_config
+    config_etag = config_cache.response_etag
+
+
+def apply_options():
+    global compressor
+    from .compression import Compressor
+    compressor = Compressor(options.get('COMPRESSION', 'gzip'),
+                            level=options.get('COMPRESSION_LEVEL'),
+                            min_size=options.get('COMPRESSION_MIN_BYTES', 1024))
+    config_cache.max_staleness_seconds = options.get('CONFIG_MAX_STALENESS_SECONDS', 300)
+    http_client.configure(pool_size=options.get('HTTP_POOL_SIZE'),
+                          connect_timeout=options.get('HTTP_CONNECT_TIMEOUT'),
+                          read_timeout=options.get('HTTP_READ_TIMEOUT'),
+                          max_retries=options.get('HTTP_MAX_RETRIES'))
+    http_client.configure_circuit_breaker(enabled=options.get('ENABLE_CIRCUIT_BREAKER', True),
+                                          failure_threshold=options.get('CIRCUIT_FAILURE_THRESHOLD', 5),
+                                          slow_call_seconds=options.get('CIRCUIT_SLOW_CALL_SECONDS', 5),
+                                          reset_seconds=options.get('CIRCUIT_RESET_SECONDS', 30))
+
+
+def set_base_uri(base_uri):
+    """Function to point the clients at another Moesif API, such as a local collector, returns True if it changed"""
+    from moesifapi.configuration import Configuration
+    if not base_uri or base_uri == Configuration.BASE_URI:
+        return False
+    Configuration.BASE_URI = base_uri
+    return True
+
+
+def configure(moesif_options):
+    """Function to apply the moesif options to the clients, now or once they are initialized"""
+    global options
+    options = moesif_options
+    base_uri_changed = set_base_uri(moesif_options.get('BASE_URI'))
+    if api_client is not None:
+        apply_options()
+        # The config was fetched from the previous Moesif API
+        if base_uri_changed:
+            config_cache.refresh(api_client)
+
+
+def init():
+    """Function to construct the api client and start fetching the config, only the first call does the work"""
+    global api_client, http_client, app_config, config_cache
+    if api_client is not None:
+        return
+    with init_lock:
+        if api_client is not None:
+            return
+
+        # initialize the config first time on cold start.
+        print("[moesif] start init - config")
+
+        from moesifapi.app_config.app_config import AppConfig
+        from moesifapi.moesif_api_client import MoesifAPIClient
+        from .config_cache import ConfigCache
+        from .pooled_http_client import MoesifHttpClient
+
+        # Initialize the client
+        set_base_uri(os.environ.get("MOESIF_BASE_URI") or options.get('BASE_URI'))
+        if os.environ.get("MOESIF_APPLICATION_ID"):
+            new_api_client = MoesifAPIClient(os.environ["MOESIF_APPLICATION_ID"]).api
+            http_client = MoesifHttpClient()
+            new_api_client.http_client = http_client
+        else:
+            raise Exception('Moesif Application ID is required in settings')
+
+        # The config is fetched in the background so that it doesn't block the cold start,
+        # sampling uses the default sample rate until it is fetched.
+        app_config = AppConfig()
+        config_cache = ConfigCache(app_config, on_update=set_config)
+        config_cache.refresh(new_api_client, True)
+
+        # Set last, the other objects are ready once the client is visible
+        api_client = new_api_client
+        apply_options()
+
+        print("[moesif] end init - config")
+
 
-# Initialize the client
-if os.environ.get("MOESIF_APPLICATION_ID"):
-    api_client = MoesifAPIClient(os.environ["MOESIF_APPLICATION_ID"]).api
-else:
-    raise Exception('Moesif Application ID is required in settings')
+def get_api_client():
+    """Function to return the api client, initializing it on first use"""
+    init()
+    return api_client
 
-app_config = AppConfig()
-config = app_config.get_config(api_client, True)
 
-print("[moesif] end init - config")
+if not lazy_init:
+    init()
@@ -0,0 +1,63 @@
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import json
+
+
+class HeaderIndex(Mapping):
+    """Case-insensitive read-only view of HTTP headers.
+
+    Each lookup is a single dict hit on the lowercased name, whatever the case of the headers in the
+    event, such as mixed case in REST API events and lowercase in HTTP API events. The headers are
+    not copied, `headers` is the original dict.
+    """
+    __slots__ = ('headers', 'names')
+
+    def __init__(self, headers=None):
+        self.headers = headers if isinstance(headers, dict) else {}
+        # The names of JSON objects are always strings
+        self.names = {name.lower(): name for name in self.headers}
+
+    def __getitem__(self, name):
+        return self.headers[self.names[name.lower()]]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name, default=None):
+        original_name = self.names.get(name.lower())
+        return default if original_name is None else self.headers[original_name]
+
+
+# Index of the event being processed, so that it is built once per event
+current_event = None
+current_index = None
+
+
+def get_headers(event, refresh=False):
+    """Function to get the case-insensitive view of the request headers of the Lambda event.
+
+    The view is built once per event, so it is cheap to call from the IDENTIFY_USER, IDENTIFY_COMPANY
+    and other functions, e.g. `get_headers(event).get('x-api-key')`. The middleware rebuilds it with
+    `refresh` for each invocation.
+    """
+    global current_event, current_index
+    if not refresh and event is current_event and current_index is not None:
+        return current_index
+
+    headers = event.get('headers') if isinstance(event, dict) else None
+    if isinstance(headers, str):
+        try:
+            headers = json.loads(headers)
+        except ValueError:
+            headers = None
+    current_index = HeaderIndex(headers)
+    current_event = event
+    return current_index
@@ -0,0 +1,29 @@
+from functools import update_wrapper
+
+
+class LambdaDecorator(object):
+    """Base class of the Lambda handler decorators, with the same interface as
+    `lambda_decorators.LambdaDecorator`.
+
+    `lambda_decorators` imports boto3 when it is imported, which is most of the
+    middleware's import time, so the base class is defined here instead.
+    """
+
+    def __init__(self, handler):
+        update_wrapper(self, handler)
+        self.handler = handler
+
+    def __call__(self, event, context):
+        try:
+            return self.after(self.handler(*self.before(event, context)))
+        except Exception as exception:
+            return self.on_exception(exception)
+
+    def before(self, event, context):
+        return event, context
+
+    def after(self, retval):
+        return retval
+
+    def on_exception(self, exception):
+        raise exception
@@ -1,5 +1,3 @@
-from lambda_decorators import LambdaDecorator
-from lambda_decorators import before, after, dump_json_body
 from moesifapi.moesif_api_client import *
 from moesifapi.api_helper import *
 from moesifapi.exceptions.api_exception import *
@@ -7,6 +5,22 @@ from moesifapi.models import *
 from .client_ip import ClientIp
 from .update_companies import Company
 from .update_users import User
+from .event_queue import EventQueue, join_batch, send_event, send_events_batch, send_payload
+from .extension import LambdaExtension
+from .sender import EventSender
+from .spool import Spool, is_retryable_error
+from .overhead_budget import DeadlineExceededError, OverheadBudget
+from .profile_queue import ProfileQueue, is_serializable, to_profile_dict
+from .bulk_upload import BulkUploader
+from .batch_triggers import BatchTrigger, RecordSerializer, build_event, build_summary_event, chunk_payloads, \
+    get_batch_source
+from .timings import Timings, perf_counter_ns
+from .lambda_decorator import LambdaDecorator
+from .sampling_rules import SamplingRules
+from .sampler import Sampler
+from . import body_capture
+from .headers import HeaderIndex, get_headers
+from .serializer import EventRecord, EventRequestRecord, EventResponseRecord, serialize_event
 from . import global_variable as gv
 
 from datetime import *
@@ -15,8 +29,6 @@ import json
 import os
 from pprint import pprint
 
-import random
-import math
 import binascii
 import re
 
@@ -24,12 +36,13 @@ try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode
-from moesifpythonrequest.start_capture.start_capture import StartCapture
 from datetime import datetime
 
 
-def get_time_took_in_ms(start_time, end_time):
-    return (end_time - start_time).total_seconds() * 1000
+BASE64_REGEX = re.compile("^[A-Za-z0-9+/]+={0,2}$")
+
+# Endpoints of the batched profile updates, by id field
+PROFILE_BATCH_PATHS = {'user_id': '/v1/users/batch', 'company_id': '/v1/companies/batch'}
 
 
 def start_capture_outgoing(moesif_options):
@@ -37,6 +50,9 @@ def start_capture_outgoing(moesif_options):
         if moesif_options.get('DEBUG', False):
             print('[moesif] Start capturing outgoing requests')
 
+        # Imported on use, it is not needed unless capturing outgoing requests
+        from moesifpythonrequest.start_capture.start_capture import StartCapture
+
         # Start capturing outgoing requests
         moesif_options['APPLICATION_ID'] = os.environ["MOESIF_APPLICATION_ID"]
         StartCapture().start_capture_outgoing(moesif_options)
@@ -49,27 +65,161 @@ def start_capture_outgoing(moesif_options):
     return
 
 
-# Initialized the client
-api_client = gv.api_client
+def call_profile_api(update, profiles, moesif_options):
+    """Function to update profiles through the API client, the updates which can't reach Moesif are logged and dropped.
+
+    Such as while the circuit breaker is open, the error is not raised to the handler.
+    """
+    try:
+        update(profiles, gv.get_api_client(), moesif_options)
+    except Exception as ex:
+        if not is_retryable_error(ex):
+            raise
+        print('[moesif] Error while updating profiles in Moesif, the update is dropped', ex)
 
 
 def update_user(user_profile, moesif_options):
-    User().update_user(user_profile, api_client, moesif_options)
+    if moesif_options.get('BATCH_PROFILE_UPDATES', False):
+        queue_profile_updates('user_id', [user_profile], moesif_options)
+        return
+    call_profile_api(User().update_user, user_profile, moesif_options)
 
 
 def update_users_batch(user_profiles, moesif_options):
-    User().update_users_batch(user_profiles, api_client, moesif_options)
+    if moesif_options.get('BATCH_PROFILE_UPDATES', False):
+        queue_profile_updates('user_id', user_profiles, moesif_options)
+        return
+    call_profile_api(User().update_users_batch, user_profiles, moesif_options)
 
 
 def update_company(company_profile, moesif_options):
-    Company().update_company(company_profile, api_client, moesif_options)
+    if moesif_options.get('BATCH_PROFILE_UPDATES', False):
+        queue_profile_updates('company_id', [company_profile], moesif_options)
+        return
+    call_profile_api(Company().update_company, company_profile, moesif_options)
 
 
 def update_companies_batch(companies_profiles, moesif_options):
-    Company().update_companies_batch(companies_profiles, api_client, moesif_options)
+    if moesif_options.get('BATCH_PROFILE_UPDATES', False):
+        queue_profile_updates('company_id', companies_profiles, moesif_options)
+        return
+    call_profile_api(Company().update_companies_batch, companies_profiles, moesif_options)
+
+
+def bulk_update_users(user_profiles, moesif_options):
+    """Function to upload a large number of users, from an iterable or the path of a JSON Lines file, returns a BulkUploadResult"""
+    return bulk_upload('user_id', '/v1/users/batch', user_profiles, moesif_options)
+
+
+def bulk_update_companies(companies_profiles, moesif_options):
+    """Function to upload a large number of companies, from an iterable or the path of a JSON Lines file, returns a BulkUploadResult"""
+    return bulk_upload('company_id', '/v1/companies/batch', companies_profiles, moesif_options)
+
+
+def bulk_upload(id_field, path, profiles, moesif_options):
+    uploader = BulkUploader(gv.get_api_client(), id_field, path,
+                            chunk_size=moesif_options.get('BULK_CHUNK_SIZE', 1000),
+                            max_chunk_bytes=moesif_options.get('BULK_MAX_CHUNK_BYTES', 1000000),
+                            max_workers=moesif_options.get('BULK_MAX_WORKERS', 4),
+                            max_in_flight=moesif_options.get('BULK_MAX_IN_FLIGHT'),
+                            compressor=gv.compressor,
+                            debug=moesif_options.get('DEBUG', False))
+    return uploader.upload(profiles)
+
+
+def queue_profile_updates(id_field, profiles, moesif_options):
+    """Function to buffer user or company profile updates, they are sent in batches once a batch is due"""
+    queue = gv.profile_queues.get(id_field)
+    if queue is None:
+        queue = gv.profile_queues[id_field] = ProfileQueue(
+            id_field, PROFILE_BATCH_PATHS[id_field],
+            batch_size=moesif_options.get('PROFILE_BATCH_SIZE', 100),
+            window_seconds=moesif_options.get('PROFILE_BATCH_WINDOW_SECONDS', 5),
+            dedupe_cache_size=moesif_options.get('PROFILE_DEDUPE_CACHE_SIZE', 10000))
+    for profile in profiles or []:
+        try:
+            profile = to_profile_dict(profile)
+        except Exception:
+            print('Error while deserializing the json, please make sure the json is valid')
+            continue
+        if not isinstance(profile, dict) or profile.get(id_field) is None:
+            print('To update a profile, a ' + id_field + ' field is required')
+        elif not is_serializable(profile):
+            # It would fail the whole batch it is sent in
+            print('[moesif] Skipped the update of the profile ' + str(profile[id_field]) +
+                  ', it has values which can not be serialized to JSON, such as dates or decimals')
+        else:
+            queue.add(profile)
+    # The extension sends them after the response instead
+    if queue.should_flush() and not (gv.extension is not None and gv.extension.is_running):
+        send_profile_updates(queue, moesif_options.get('DEBUG', False))
+
+
+def flush_profile_updates(force=True, debug=False):
+    """Function to send the buffered profile updates, or only the ones which are due without `force`"""
+    for queue in list(gv.profile_queues.values()):
+        if force or queue.should_flush():
+            send_profile_updates(queue, debug)
+
+
+def send_profile_updates(queue, debug=False):
+    """Function to send the buffered profile updates of a queue in batches, the failed batches are retried later"""
+    for batch in queue.drain():
+        try:
+            send_payload(gv.get_api_client(), queue.path, json.dumps(batch, separators=(',', ':')), gv.compressor)
+        except Exception as ex:
+            if isinstance(ex, APIException) and 401 <= ex.response_code <= 403:
+                print("Unauthorized access sending event to Moesif. Please check your Appplication Id.")
+            print('[moesif] Error while sending a batch of ' + str(len(batch)) + ' profile updates to Moesif', ex)
+            if is_retryable_error(ex):
+                queue.requeue(batch)
+            continue
+        queue.mark_sent(batch)
+        if debug:
+            print('[moesif] Sent batch of ' + str(len(batch)) + ' profile updates to Moesif')
 
 
 def MoesifLogger(moesif_options):
+    # Options of the shared clients, such as the connection pool reused across warm invocations
+    gv.configure(moesif_options)
+
+    # The queue lives in the module level state so buffered events outlive the invocation that captured them
+    send_after_response = moesif_options.get('SEND_AFTER_RESPONSE', False)
+    if (moesif_options.get('ENABLE_BATCHING', False) or send_after_response) and gv.event_queue is None:
+        gv.event_queue = EventQueue(batch_size=moesif_options.get('BATCH_SIZE', 25),
+                                    max_batch_bytes=moesif_options.get('BATCH_MAX_BYTES', 200000),
+                                    max_age_seconds=moesif_options.get('EVENT_BATCH_TIMEOUT', 5))
+
+    # Batches which failed to be delivered are spooled in /tmp, which outlives the invocation too
+    if moesif_options.get('ENABLE_SPOOL', False) and gv.spool is None:
+        gv.spool = Spool(path=moesif_options.get('SPOOL_PATH', '/tmp/moesif-events.spool'),
+                         max_bytes=moesif_options.get('SPOOL_MAX_BYTES', 10000000),
+                         backoff_seconds=moesif_options.get('RETRY_BACKOFF_SECONDS', 1),
+                         max_backoff_seconds=moesif_options.get('RETRY_BACKOFF_MAX_SECONDS', 300))
+
+    # Bound of the time the middleware adds to each invocation
+    if gv.overhead_budget is None:
+        gv.overhead_budget = OverheadBudget(max_overhead_ms=moesif_options.get('MAX_OVERHEAD_MS'),
+                                            remaining_time_fraction=moesif_options.get('MAX_OVERHEAD_FRACTION', 0.5),
+                                            min_send_ms=moesif_options.get('MIN_SEND_BUDGET_MS', 20))
+
+    # Sampling of the events, deterministic when keyed, with the rate limits and the tail rules
+    if gv.sampler is None:
+        gv.sampler = Sampler.from_options(moesif_options)
+
+    # Histograms of the time spent in each phase of the middleware
+    if gv.timings is None:
+        gv.timings = Timings(enabled=moesif_options.get('ENABLE_TIMINGS', False),
+                             callback=moesif_options.get('ON_TIMINGS'),
+                             emf=moesif_options.get('TIMINGS_EMF', True),
+                             interval_seconds=moesif_options.get('TIMINGS_INTERVAL_SECONDS', 60),
+                             namespace=moesif_options.get('TIMINGS_NAMESPACE', 'Moesif/Middleware'))
+        # The rates of the adaptive rate limit are published with the timings
+        if getattr(gv.sampler, 'adaptive_limiter', None) is not None:
+            for name in ('offered_events_per_second', 'sent_events_per_second', 'keep_fraction',
+                         'effective_sampling_percentage'):
+                gv.timings.add_gauge(name, lambda name=name: gv.sampler.stats().get(name))
+
     class log_data(LambdaDecorator):
         def __init__(self, handler):
         
@@ -82,13 +232,49 @@ def MoesifLogger(moesif_options):
             self.user_id = None
             self.company_id = None
             self.LOG_BODY = self.moesif_options.get('LOG_BODY', True)
+            self.MAX_BODY_SIZE = self.moesif_options.get('MAX_BODY_SIZE', 1000000)
             self.DEBUG = self.moesif_options.get('DEBUG', False)
+            self.BATCH_CAPTURE_MODE = self.moesif_options.get('BATCH_CAPTURE_MODE', None)
+            self.batch_trigger = None
             self.event = None
             self.context = None
             self.payload_version = None
 
-            # Set the client
-            self.api_client = api_client
+            # Start the thread which sends the events off the handler thread
+            if self.moesif_options.get('SEND_IN_BACKGROUND', False) and gv.event_sender is None:
+                gv.event_sender = EventSender(self.send_batch,
+                                              max_queue_size=self.moesif_options.get('EVENT_QUEUE_SIZE', 1000),
+                                              overflow_policy=self.moesif_options.get('QUEUE_OVERFLOW_POLICY', 'drop_oldest'),
+                                              block_timeout=self.moesif_options.get('QUEUE_BLOCK_TIMEOUT', 0.05),
+                                              batch_size=self.moesif_options.get('BATCH_SIZE', 25),
+                                              max_batch_bytes=self.moesif_options.get('BATCH_MAX_BYTES', 200000),
+                                              debug=self.DEBUG).start()
+
+            # Register the extension which sends the buffered events once the response is returned
+            if send_after_response and gv.extension is None:
+                gv.extension = LambdaExtension(self.flush_after_response, debug=self.DEBUG)
+                if not gv.extension.start():
+                    print('[moesif] Cannot send events after the response, sending them from the invocation instead')
+
+        @property
+        def api_client(self):
+            """The shared api client, initialized on first use when the initialization is deferred"""
+            return gv.get_api_client()
+
+        def __call__(self, event, context):
+            try:
+                gv.init()
+                return LambdaDecorator.__call__(self, event, context)
+            finally:
+                self.finish_invocation()
+
+        def finish_invocation(self):
+            """Function to run once the handler returned or raised, by the sync and async middleware"""
+            # The extension can flush while Lambda returns the response
+            if gv.extension is not None:
+                gv.extension.invocation_finished()
+            if gv.timings is not None:
+                gv.timings.emit_if_due()
 
         def clear_state(self):
             """Function to clear state of local variable"""
@@ -100,14 +286,29 @@ def MoesifLogger(moesif_options):
             self.session_token = None
             self.user_id = None
             self.company_id = None
+            self.uri = None
+            self.ip_address = None
+            self.sampling_percentage = None
+            self.request_headers = None
+            self.tail_event = None
+            self.handler_start_ns = None
+            self.keep_fraction = 1.0
+            self.batch_trigger = None
 
         def is_payload_format_version_1_0(cls, payload_format_version):
             """Function to check if the payload format version is 1.0 (old) or 2.0 (new) """
             return payload_format_version == "1.0"
 
+        def record_timing(self, phase, start_ns):
+            """Function to record the time spent in a phase of the middleware since `start_ns`"""
+            elapsed_ns = perf_counter_ns() - start_ns
+            gv.timings.record(phase, elapsed_ns)
+            if self.DEBUG:
+                print("[moesif] Time took in " + phase + " in millisecond - " + str(elapsed_ns / 1000000.0))
+
         def get_user_id(self, event, context):
             """Function to fetch UserId"""
-            start_time_get_user_id = datetime.utcnow()
+            start_ns = perf_counter_ns()
             username = None
             try:
                 identify_user = self.moesif_options.get("IDENTIFY_USER")
@@ -126,14 +327,12 @@ def MoesifLogger(moesif_options):
                 if self.DEBUG:
                     print("[moesif] cannot execute identify_user function, please check moesif settings.")
                     print(e)
-            end_time_get_user_id = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took in fetching user id in millisecond - " + str(get_time_took_in_ms(start_time_get_user_id, end_time_get_user_id)))
+            self.record_timing('identify_user', start_ns)
             return username
 
         def get_company_id(self, event, context):
             """Function to fetch CompanyId"""
-            start_time_get_company_id = datetime.utcnow()
+            start_ns = perf_counter_ns()
             company_id = None
             try:
                 identify_company = self.moesif_options.get("IDENTIFY_COMPANY")
@@ -143,16 +342,15 @@ def MoesifLogger(moesif_options):
                 if self.DEBUG:
                     print("[moesif] cannot execute identify_company function, please check moesif settings.")
                     print(e)
-            end_time_get_company_id = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took in fetching company id in millisecond - " + str(get_time_took_in_ms(start_time_get_company_id, end_time_get_company_id)))
+            self.record_timing('identify_company', start_ns)
             return company_id
 
         def build_uri(self, event, payload_format_version_1_0):
 
             uri = ''
             try: 
-                uri = event['headers'].get('X-Forwarded-Proto', event['headers'].get('x-forwarded-proto', 'http')) + '://' + event['headers'].get('Host', event['headers'].get('host', 'localhost'))
+                request_headers = get_headers(event)
+                uri = request_headers.get('x-forwarded-proto', 'http') + '://' + request_headers.get('host', 'localhost')
             except Exception as e:
                 if self.DEBUG:
                     print("[moesif] cannot read HTTP headers X-Forwarded-Proto or Host. Ensure event triggered via external URL")
@@ -176,10 +374,8 @@ def MoesifLogger(moesif_options):
                 return False
             if len(data) % 4 != 0:
                 return False
-            
-            b64_regex = re.compile("^[A-Za-z0-9+/]+={0,2}$")
 
-            if (not b64_regex.fullmatch(data)):
+            if (not BASE64_REGEX.fullmatch(data)):
                 return False
             
             try:
@@ -190,7 +386,9 @@ def MoesifLogger(moesif_options):
             
         def base64_body(cls, data):
             """Function to transfer body into base64 encoded"""
-            body = base64.b64encode(str(data).encode("utf-8"))
+            if body_capture.exceeds(data, cls.MAX_BODY_SIZE):
+                data = body_capture.truncate(data, cls.MAX_BODY_SIZE)
+            body = base64.b64encode(data if isinstance(data, bytes) else str(data).encode("utf-8"))
             if isinstance(body, str):
                 return str(body).encode("utf-8"), 'base64'
             elif isinstance(body, (bytes, bytearray)):
@@ -207,6 +405,11 @@ def MoesifLogger(moesif_options):
                     # If body is an instance of either a dictionary of list, 
                     # we can return it as is.
                     return body, "json"
+                elif isinstance(body, (str, bytes)) and (body_capture.exceeds(body, self.MAX_BODY_SIZE) or
+                                                         not body_capture.looks_like_json(body)):
+                    # A truncated body can't be parsed, and the parse is not attempted
+                    # when the body does not start like JSON
+                    return self.base64_body(body)
                 elif isinstance(body, bytes):
                     body_str = body.decode()
                     parsed_body = json.loads(body_str)
@@ -234,20 +437,418 @@ def MoesifLogger(moesif_options):
             transfer_encoding = None
 
             try:
-                if body_wrapper.get('isBase64Encoded', False) and self.is_base64_str(body_wrapper.get('body')):
-                        body = body_wrapper.get('body')
+                raw_body = body_wrapper.get('body')
+                if body_wrapper.get('isBase64Encoded', False) and isinstance(raw_body, str) and \
+                        body_capture.exceeds(raw_body, self.MAX_BODY_SIZE):
+                    # Only the captured part of the body is validated and decoded
+                    kept = raw_body[:self.MAX_BODY_SIZE - self.MAX_BODY_SIZE % 4]
+                    if self.is_base64_str(kept):
+                        return body_capture.truncate_base64(raw_body, self.MAX_BODY_SIZE), 'base64'
+                    return self.base64_body(raw_body)
+                if body_wrapper.get('isBase64Encoded', False) and self.is_base64_str(raw_body):
+                        body = raw_body
                         transfer_encoding = 'base64'
+                elif body_capture.is_binary_content_type(body_capture.get_content_type(body_wrapper.get('headers'))):
+                    body, transfer_encoding = self.base64_body(raw_body)
                 else:
-                    body, transfer_encoding = self.safe_json_parse(body_wrapper.get('body'))
+                    body, transfer_encoding = self.safe_json_parse(raw_body)
             except Exception as e:
                     return self.base64_body(body_wrapper['body'])
 
             return body, transfer_encoding
 
+        def update_config(self, response_headers):
+            """Function to refresh the app config if the config etag in the response headers changed"""
+            try:
+                # Check if we need to update config
+                new_config_etag = response_headers['x-moesif-config-etag']
+                if gv.config_cache.is_outdated(new_config_etag):
+                    gv.config_cache.refresh(self.api_client, self.DEBUG, new_config_etag)
+            except (KeyError, TypeError, ValueError) as ex:
+                # ignore the error because the response may not have the config etag header
+                pass
+            finally:
+                gv.last_updated_time = datetime.utcnow()
+
+        def is_config_refresh_due(self):
+            """Function to check if the config etag should be checked on the next response"""
+            return datetime.utcnow() > gv.last_updated_time + timedelta(seconds=gv.refresh_config_time_seconds)
+
+        def send_batch(self, batch):
+            """Function to send a batch of serialized events to Moesif, returns True on success"""
+            # The batches left once the deadline passed are sent by a later invocation
+            if gv.http_client.is_past_deadline():
+                self.defer_payloads(batch)
+                return False
+            try:
+                check_config = self.is_config_refresh_due()
+                response_headers = send_events_batch(self.api_client, batch, gv.compressor)
+                if check_config:
+                    self.update_config(response_headers)
+                if self.DEBUG:
+                    print('[moesif] Sent batch of ' + str(len(batch)) + ' events to Moesif')
+            except DeadlineExceededError:
+                self.defer_payloads(batch)
+                return False
+            except APIException as inst:
+                if 401 <= inst.response_code <= 403:
+                    print("Unauthorized access sending event to Moesif. Please check your Appplication Id.")
+                if self.DEBUG:
+                    print("Error while sending events batch, with status code:")
+                    print(inst.response_code)
+                self.spool_batch(batch, inst)
+                return False
+            except Exception as ex:
+                print("[moesif] Error while sending events batch to Moesif", ex)
+                self.spool_batch(batch, ex)
+                return False
+            self.retry_spooled_events()
+            return True
+
+        def spool_batch(self, batch, exception):
+            """Function to spool a batch which failed to be delivered, if the delivery may succeed later"""
+            if gv.spool is None or not is_retryable_error(exception):
+                return
+            gv.spool.append(join_batch(batch))
+            gv.spool.retry_failed()
+            if self.DEBUG:
+                print('[moesif] Spooled batch of ' + str(len(batch)) + ' events for retry')
+
+        def retry_spooled_events(self, force=False, all_batches=False):
+            """Function to resend the spooled batches once the retry backoff elapsed, or all of them right away when `force` is set.
+
+            Otherwise at most SPOOL_RETRY_BATCHES batches are sent per call, to bound the time spent retrying, unless
+            `all_batches` is set, such as when nothing waits on the retry.
+            """
+            spool = gv.spool
+            if spool is None or not (force or spool.is_retry_due()) or spool.is_empty():
+                return
+            # Resending is left to a later call once the invocation is out of its overhead budget
+            if not force and gv.http_client.is_past_deadline():
+                return
+            # Another thread is already resending the spooled batches, which is waited on only to send them all
+            if not spool.retry_lock.acquire(force):
+                return
+            try:
+                max_count = None if force or all_batches else self.moesif_options.get('SPOOL_RETRY_BATCHES', 5)
+                bodies = spool.peek(max_count)
+                done = 0
+                try:
+                    for body in bodies:
+                        try:
+                            send_payload(self.api_client, '/v1/events/batch', body, gv.compressor)
+                        except Exception as ex:
+                            if is_retryable_error(ex):
+                                raise
+                            # Such as a rejected batch, which would fail again
+                            print('[moesif] Dropped a spooled batch rejected by Moesif', ex)
+                        done += 1
+                except Exception as ex:
+                    print('[moesif] Error while resending the spooled events to Moesif', ex)
+                    # Not a failure of Moesif when the retry ran out of the overhead budget
+                    if not isinstance(ex, DeadlineExceededError):
+                        spool.retry_failed()
+                else:
+                    spool.retry_succeeded()
+                finally:
+                    spool.discard(bodies[:done])
+            finally:
+                spool.retry_lock.release()
+            if self.DEBUG and done:
+                print('[moesif] Resent ' + str(done) + ' spooled batches')
+
+        def flush_events(self, after_response=False):
+            """Function to send the buffered events to Moesif in batches"""
+            if gv.event_sender is not None:
+                gv.event_sender.flush()
+            if gv.event_queue is not None:
+                for batch in gv.event_queue.drain():
+                    self.send_batch(batch)
+            if gv.deferred_queue is not None:
+                for batch in gv.deferred_queue.drain():
+                    self.send_batch(batch)
+            # Nothing waits on the flush after the response, and the buffers and /tmp are lost with the execution
+            # environment, which an internal extension isn't told of, so the profile updates and the spool are sent in full
+            flush_profile_updates(force=after_response, debug=self.DEBUG)
+            self.retry_spooled_events(all_batches=after_response)
+
+        def flush_after_response(self):
+            """Function run by the Lambda extension once the response is returned"""
+            self.flush_events(after_response=True)
+
+        def send_profile_updates(self):
+            """Function to send the profile updates made by the handler which are due"""
+            flush_profile_updates(force=False, debug=self.DEBUG)
+
+        def send_event(self, event_model):
+            """Function to send the event to Moesif, or buffer it when batching is enabled"""
+            start_ns = perf_counter_ns()
+            payload = serialize_event(event_model)
+            self.record_timing('serialization', start_ns)
+
+            start_ns = perf_counter_ns()
+            try:
+                self.send_payload(payload)
+            finally:
+                self.record_timing('send', start_ns)
+
+        def send_payload(self, payload):
+            """Function to send a serialized event to Moesif, or buffer it when batching is enabled"""
+            if gv.event_sender is not None:
+                gv.event_sender.put(payload)
+                return
+
+            if gv.event_queue is not None:
+                gv.event_queue.add_payload(payload)
+                if gv.extension is not None and gv.extension.is_running:
+                    return
+                if gv.event_queue.should_flush():
+                    self.flush_events()
+                return
+
+            # The events deferred by earlier invocations are sent along with this one
+            if gv.deferred_queue is not None and len(gv.deferred_queue):
+                gv.deferred_queue.add_payload(payload)
+                for batch in gv.deferred_queue.drain():
+                    self.send_batch(batch)
+                return
+
+            try:
+                response_headers = send_event(self.api_client, payload, gv.compressor)
+            except DeadlineExceededError:
+                self.defer_payloads([payload])
+                return
+            except Exception as ex:
+                if gv.spool is None or not is_retryable_error(ex):
+                    raise
+                print("[moesif] Error while sending the event to Moesif, spooled it for retry", ex)
+                self.spool_batch([payload], ex)
+                return
+            if self.is_config_refresh_due():
+                self.update_config(response_headers)
+            self.retry_spooled_events()
+
+        def defer_event(self, event_model):
+            """Function to buffer the event instead of sending it, once the overhead budget is exceeded"""
+            self.defer_payloads([serialize_event(event_model)])
+
+        def defer_payloads(self, payloads):
+            """Function to buffer serialized events instead of sending them, when the overhead budget is exceeded or
+            their request timed out on its deadline.
+
+            The events are sent with the next batch, or with the event of a later invocation when batching is disabled.
+            """
+            gv.overhead_budget.deferred_count += len(payloads)
+            if gv.event_sender is not None:
+                for payload in payloads:
+                    gv.event_sender.put(payload)
+                return
+            if gv.event_queue is None and gv.deferred_queue is None:
+                gv.deferred_queue = EventQueue(batch_size=self.moesif_options.get('BATCH_SIZE', 25),
+                                               max_batch_bytes=self.moesif_options.get('BATCH_MAX_BYTES', 200000))
+            queue = gv.event_queue if gv.event_queue is not None else gv.deferred_queue
+            for payload in payloads:
+                queue.add_payload(payload)
+            if self.DEBUG:
+                print('[moesif] Overhead budget exceeded, deferred sending ' + str(len(payloads)) + ' events')
+
+        def on_exception(self, exception):
+            """Function to capture the records of a batch trigger as failed when the handler raises"""
+            if self.batch_trigger is not None:
+                try:
+                    self.capture_batch(None)
+                except Exception as ex:
+                    print("[moesif] Error while capturing the records of the batch", ex)
+            raise exception
+
+        def capture_batch(self, failed_ids):
+            """Function to capture the records of a batch trigger, as an event per record or an event summarizing the batch.
+
+            `failed_ids` are the ids of the records reported as failed, None if they all failed.
+            """
+            batch = self.batch_trigger
+            self.batch_trigger = None
+            start_ns = perf_counter_ns()
+
+            # Skip Event
+            try:
+                skip_event = self.moesif_options.get('SKIP', None)
+                if skip_event is not None and skip_event(batch.event, self.context):
+                    if self.DEBUG:
+                        print('[moesif] Skip sending the records of the batch to Moesif')
+                    return
+            except Exception as e:
+                if self.DEBUG:
+                    print("[moesif] Having difficulty executing skip_event function. Please check moesif settings.", e)
+
+            response_time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            metadata = {'batch_size': len(batch)}
+            if getattr(self.context, 'aws_request_id', None):
+                metadata['trace_id'] = str(self.context.aws_request_id)
+            if getattr(self.context, 'function_name', None):
+                metadata['function_name'] = self.context.function_name
+
+            if self.BATCH_CAPTURE_MODE == 'summary':
+                event_model = build_summary_event(batch.source, batch, failed_ids, response_time, metadata)
+                self.send_event(self.mask_event(event_model))
+            else:
+                log_body = self.LOG_BODY and gv.overhead_budget.allow_step('the record bodies', self.DEBUG)
+                self.send_payloads(self.serialize_records(batch, failed_ids, response_time, metadata, log_body))
+            self.record_timing('batch', start_ns)
+
+        def serialize_records(self, batch, failed_ids, response_time, metadata, log_body):
+            """Function to sample and serialize the events of the records of a batch, one record at a time"""
+            sampler = gv.sampler
+            sampling_rules = gv.config_cache.get_sampling_rules(self.api_client, self.DEBUG)
+            sampling_percentages = {}
+            serializer = RecordSerializer(batch.source, response_time, metadata)
+            mask_event_model = self.moesif_options.get('MASK_EVENT_MODEL', None)
+
+            for fields in batch.iter_records(log_body, self.MAX_BODY_SIZE):
+                record_id, uri = fields[0], fields[2]
+                status = 500 if failed_ids is None or record_id in failed_ids else 200
+
+                if sampler.has_tail_rules and sampler.keeps_response(status):
+                    weight = 1
+                else:
+                    sampling_percentage = sampling_percentages.get(uri)
+                    if sampling_percentage is None:
+                        sampling_percentage = sampling_rules.get_request_sampling_percentage(
+                            SamplingRules.prepare_request_mapping('POST', uri))
+                        if sampling_percentage is None:
+                            sampling_percentage = sampling_rules.default_sample_rate
+                        sampling_percentages[uri] = sampling_percentage
+                    if not sampler.is_sampled(sampling_percentage, record_id if sampler.key == 'request_id' else None):
+                        continue
+                    if not sampler.allow(record_id if sampler.rate_limit_key == 'request_id' else None):
+                        continue
+                    keep_fraction = sampler.admit(sampling_percentage)
+                    if keep_fraction is None:
+                        continue
+                    weight = sampler.get_weight(sampling_percentage, keep_fraction)
+
+                if mask_event_model is not None:
+                    event_model = self.mask_event(build_event(batch.source, fields, response_time, status, weight,
+                                                              metadata))
+                    if event_model is not None:
+                        yield serialize_event(event_model)
+                else:
+                    yield serializer.serialize(fields, status, weight)
+
+        def mask_event(self, event_model):
+            """Function to apply the MASK_EVENT_MODEL function to the event, returns None if the event is not to be sent.
+
+            An event the function failed on is dropped rather than sent unmasked.
+            """
+            mask_event_model = self.moesif_options.get('MASK_EVENT_MODEL', None)
+            if mask_event_model is None:
+                return event_model
+            try:
+                return mask_event_model(event_model)
+            except Exception as e:
+                print("[moesif] cannot execute MASK_EVENT_MODEL function, the event is not sent. Please check moesif settings.", e)
+                return None
+
+        def send_payloads(self, payloads):
+            """Function to send serialized events to Moesif in batches as they are serialized, or buffer them when batching is enabled"""
+            if gv.event_sender is not None:
+                for payload in payloads:
+                    gv.event_sender.put(payload)
+                return
+
+            if gv.event_queue is not None:
+                for payload in payloads:
+                    gv.event_queue.add_payload(payload)
+                if not (gv.extension is not None and gv.extension.is_running) and gv.event_queue.should_flush():
+                    self.flush_events()
+                return
+
+            for batch in chunk_payloads(payloads, max_bytes=self.moesif_options.get('BATCH_MAX_BYTES', 200000)):
+                self.send_batch(batch)
+
+        def get_response_status(self, retval):
+            """Function to get the status code of the response"""
+            return retval.get('statusCode', 599) if 'statusCode' in retval else 200
+
+        def get_ip_address(self, event):
+            """Function to get the client ip address of the request"""
+            if self.is_payload_format_version_1_0(self.payload_version):
+                ip_address = event.get('requestContext', {}).get('identity', {}).get('sourceIp', None)
+            else:
+                ip_address = event.get('requestContext', {}).get('http', {}).get('sourceIp', None)
+            return self.client_ip.get_client_address(get_headers(event), ip_address)
+
+        def sample_request(self, event, request_verb):
+            """Function to make the sampling decision before the event is built, returns False if the event is sampled out.
+
+            Only the request fields the sampling rules use are computed. The decision is deferred to `after`
+            when it depends on the response, the user or the company.
+            """
+            try:
+                sampling_rules = gv.config_cache.get_sampling_rules(self.api_client, self.DEBUG)
+                if 'request.route' in sampling_rules.request_paths:
+                    self.uri = self.build_uri(event, self.is_payload_format_version_1_0(self.payload_version))
+                if 'request.ip_address' in sampling_rules.request_paths:
+                    self.ip_address = self.get_ip_address(event)
+                sampling_percentage = sampling_rules.get_request_sampling_percentage(
+                    SamplingRules.prepare_request_mapping(request_verb, self.uri, self.ip_address))
+            except Exception as ex:
+                if self.DEBUG:
+                    print("[moesif] Error while sampling the request, deferring the sampling decision", ex)
+                return True
+
+            # The user and the company are not identified yet
+            if sampling_percentage is None or gv.sampler.key in ('user_id', 'company_id'):
+                return True
+
+            gv.sampling_percentage = sampling_percentage
+            if gv.sampler.is_sampled(sampling_percentage, self.get_sampling_key_value(gv.sampler.key, event)):
+                keep_fraction = gv.sampler.admit(sampling_percentage)
+                if keep_fraction is not None:
+                    self.sampling_percentage = sampling_percentage
+                    self.keep_fraction = keep_fraction
+                    return True
+                if self.DEBUG:
+                    print("[moesif] Skipped Event due to the adaptive rate limit")
+                return False
+
+            if self.DEBUG:
+                print("Skipped Event due to sampling percentage: " + str(sampling_percentage))
+            return False
+
+        def get_sampling_key_value(self, key, event=None):
+            """Function to get the value of the event the sampling or the rate limit is keyed on, None if not keyed"""
+            if key == 'user_id':
+                return self.user_id
+            if key == 'company_id':
+                return self.company_id
+            if key == 'request_id':
+                event = event if event is not None else self.event
+                request_id = (event or {}).get('requestContext', {}).get('requestId')
+                return request_id or getattr(self.context, 'aws_request_id', None)
+            return None
+
         def before(self, event, context):
             """This function runs before the handler is invoked, is passed the event & context and must return an event & context too."""
+            start_ns = perf_counter_ns()
+            budget = gv.overhead_budget
+            budget.start_invocation()
+            budget.start_phase(context)
+            gv.http_client.set_deadline(budget.deadline)
+            try:
+                return self.capture_request(event, context)
+            finally:
+                gv.http_client.set_deadline(None)
+                budget.end_phase()
+                self.record_timing('before', start_ns)
+                self.handler_start_ns = perf_counter_ns()
+
+        def capture_request(self, event, context, tail_kept=False):
+            """Function to capture the request of the event, within the overhead budget.
+
+            With `tail_kept`, the event was sampled out and is captured in `after` as a tail rule keeps it.
+            """
 
-            start_time_before_handler_function = datetime.utcnow()
             if self.DEBUG:
                 print('[moesif] : [before] Incoming Event:')
                 print(json.dumps(event))
@@ -269,21 +870,42 @@ def MoesifLogger(moesif_options):
             else:
                 request_verb = event.get('requestContext', {}).get('http', {}).get('method')
             if request_verb is None:
+                # The records of batch triggers are captured in `after`, once the failed ones are known
+                batch_source = get_batch_source(event) if self.BATCH_CAPTURE_MODE else None
+                if batch_source is not None:
+                    self.batch_trigger = BatchTrigger(batch_source, event)
+                    self.event = None
+                    self.payload_version = None
+                    return event, context
                 print('[moesif] : [before] AWS Lambda trigger must be a Load Balancer or API Gateway See https://docs.aws.amazon.com/lambda/latest/dg/services-alb.html or https://docs.aws.amazon.com/lambda/latest/dg/with-on-demand-https.html.')
                 self.event = None
                 self.context = None
                 self.payload_version = None
                 return event, context
 
+            # Case-insensitive view of the request headers, shared by the uri, the client ip and the hooks
+            start_ns = perf_counter_ns()
+            self.request_headers = get_headers(event, refresh=True)
+            self.record_timing('headers', start_ns)
+
+            # Sampling decision from the request alone, the event is not built if it is sampled out
+            start_ns = perf_counter_ns()
+            sampled = tail_kept or self.sample_request(event, request_verb)
+            self.record_timing('sampling', start_ns)
+            if not sampled:
+                # Captured in `after` if a tail rule keeps the response
+                if gv.sampler.has_tail_rules:
+                    self.tail_event = (event, context)
+                self.event = None
+                self.context = None
+                self.payload_version = None
+                return event, context
+
             # Request headers
             req_headers = event.get('headers', {})
-            try:
-                if isinstance(req_headers, str):
-                    req_headers = APIHelper.json_deserialize(req_headers)
-            except Exception as e:
-                if self.DEBUG:
-                    print('[moesif] Error while fetching request headers')
-                    print(e)
+            if isinstance(req_headers, str) and self.request_headers:
+                # Deserialized when the header index was built
+                req_headers = self.request_headers.headers
 
             # Request Time
             if self.is_payload_format_version_1_0(self.payload_version):
@@ -296,155 +918,202 @@ def MoesifLogger(moesif_options):
             else:
                 request_time = datetime.utcnow()
 
+            # The optional steps are skipped once the overhead budget is exceeded
+            budget = gv.overhead_budget
+
             # Request Body
-            req_body, req_transfer_encoding = self.process_body(event)
+            if budget.allow_step('the request body', self.DEBUG):
+                start_ns = perf_counter_ns()
+                req_body, req_transfer_encoding = self.process_body(event)
+                self.record_timing('request_body', start_ns)
+            else:
+                req_body, req_transfer_encoding = None, 'json'
 
             # Metadata
-            start_time_get_metadata = datetime.utcnow()
-            try:
-                get_meta = self.moesif_options.get("GET_METADATA")
-                if get_meta is not None:
-                    self.metadata = get_meta(event, context)
-                else:
-                    try:
-                        if context.aws_request_id and context.function_name and 'requestContext' in event:
-                            self.metadata = {
-                                'trace_id': str(context.aws_request_id),
-                                'function_name': context.function_name,
-                                'request_context': event['requestContext'],
-                                # Lambda context object - https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
-                                'context': {
-                                    'aws_request_id': str(getattr(context, 'aws_request_id', ''))
+            if budget.allow_step('the GET_METADATA function', self.DEBUG):
+                start_ns = perf_counter_ns()
+                try:
+                    get_meta = self.moesif_options.get("GET_METADATA")
+                    if get_meta is not None:
+                        self.metadata = get_meta(event, context)
+                    else:
+                        try:
+                            if context.aws_request_id and context.function_name and 'requestContext' in event:
+                                self.metadata = {
+                                    'trace_id': str(context.aws_request_id),
+                                    'function_name': context.function_name,
+                                    'request_context': event['requestContext'],
+                                    # Lambda context object - https://docs.aws.amazon.com/lambda/latest/dg/python-context.html
+                                    'context': {
+                                        'aws_request_id': str(getattr(context, 'aws_request_id', ''))
+                                    }
                                 }
-                            }
-                    except:
-                        if self.DEBUG:
-                            print("[moesif] cannot fetch default function_name and request_context from aws context, setting metadata to None.")
-            except Exception as e:
-                if self.DEBUG:
-                    print("[moesif] cannot execute GET_METADATA function, please check moesif settings.")
-                    print(e)
-            end_time_get_metadata = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took in fetching metadata in millisecond - " + str(get_time_took_in_ms(start_time_get_metadata, end_time_get_metadata)))
+                        except:
+                            if self.DEBUG:
+                                print("[moesif] cannot fetch default function_name and request_context from aws context, setting metadata to None.")
+                except Exception as e:
+                    if self.DEBUG:
+                        print("[moesif] cannot execute GET_METADATA function, please check moesif settings.")
+                        print(e)
+                self.record_timing('get_metadata', start_ns)
 
             # User Id
-            start_time_identify_user = datetime.utcnow()
-            self.user_id = self.get_user_id(event, context)
-            end_time_identify_user = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took in identifying the user in millisecond - " + str(get_time_took_in_ms(start_time_identify_user, end_time_identify_user)))
+            if budget.allow_step('the IDENTIFY_USER function', self.DEBUG):
+                self.user_id = self.get_user_id(event, context)
 
             # Company Id
-            start_time_identify_company = datetime.utcnow()
-            self.company_id = self.get_company_id(event, context)
-            end_time_identify_company = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took in identifying the company in millisecond - " + str(get_time_took_in_ms(start_time_identify_company, end_time_identify_company)))
+            if budget.allow_step('the IDENTIFY_COMPANY function', self.DEBUG):
+                self.company_id = self.get_company_id(event, context)
 
             # Session Token 
-            try:
-                get_token = self.moesif_options.get("GET_SESSION_TOKEN")
-                if get_token is not None:
-                    self.session_token = get_token(event, context)
-                else:
-                    try:
-                        if 'requestContext' in event and 'identity' in event['requestContext'] and 'apiKey' in event['requestContext']['identity'] and event['requestContext']['identity']['apiKey']:
-                            rc_api_key = event['requestContext']['identity']['apiKey']
-                            if rc_api_key:
-                                self.session_token = rc_api_key
-                    except KeyError:
-                        if self.DEBUG:
-                            print("[moesif] cannot fetch apiKey from aws event, setting session_token to None.")
-            except Exception as e:
-                if self.DEBUG:
-                    print("[moesif] cannot execute GET_SESSION_TOKEN function, please check moesif settings.")
-                    print(e)
+            if budget.allow_step('the GET_SESSION_TOKEN function', self.DEBUG):
+                start_ns = perf_counter_ns()
+                try:
+                    get_token = self.moesif_options.get("GET_SESSION_TOKEN")
+                    if get_token is not None:
+                        self.session_token = get_token(event, context)
+                    else:
+                        try:
+                            if 'requestContext' in event and 'identity' in event['requestContext'] and 'apiKey' in event['requestContext']['identity'] and event['requestContext']['identity']['apiKey']:
+                                rc_api_key = event['requestContext']['identity']['apiKey']
+                                if rc_api_key:
+                                    self.session_token = rc_api_key
+                        except KeyError:
+                            if self.DEBUG:
+                                print("[moesif] cannot fetch apiKey from aws event, setting session_token to None.")
+                except Exception as e:
+                    if self.DEBUG:
+                        print("[moesif] cannot execute GET_SESSION_TOKEN function, please check moesif settings.")
+                        print(e)
+                self.record_timing('get_session_token', start_ns)
 
             # Api Version
             api_version = None
-            try:
-                get_version = self.moesif_options.get("GET_API_VERSION")
-                if get_version is not None:
-                    api_version = get_version(event, context)
-                else:
-                    try:
-                        if context.function_version:
-                            api_version = context.function_version
-                    except KeyError:
-                        if self.DEBUG:
-                            print("[moesif] cannot fetch default function_version from aws context, setting api_version to None.")
-            except Exception as e:
-                if self.DEBUG:
-                    print("[moesif] cannot execute GET_API_VERSION function, please check moesif settings.")
-                    print(e)
-
-            # IpAddress
-            if self.is_payload_format_version_1_0(self.payload_version):
-                ip_address = event.get('requestContext', {}).get('identity', {}).get('sourceIp', None)
-            else:
-                ip_address = event.get('requestContext', {}).get('http', {}).get('sourceIp', None)
+            if budget.allow_step('the GET_API_VERSION function', self.DEBUG):
+                start_ns = perf_counter_ns()
+                try:
+                    get_version = self.moesif_options.get("GET_API_VERSION")
+                    if get_version is not None:
+                        api_version = get_version(event, context)
+                    else:
+                        try:
+                            if context.function_version:
+                                api_version = context.function_version
+                        except KeyError:
+                            if self.DEBUG:
+                                print("[moesif] cannot fetch default function_version from aws context, setting api_version to None.")
+                except Exception as e:
+                    if self.DEBUG:
+                        print("[moesif] cannot execute GET_API_VERSION function, please check moesif settings.")
+                        print(e)
+                self.record_timing('get_api_version', start_ns)
 
             # Event Request Object
-            self.event_req = EventRequestModel(time = request_time.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
-                uri = self.build_uri(event, self.is_payload_format_version_1_0(self.payload_version)),
+            start_ns = perf_counter_ns()
+            self.event_req = EventRequestRecord(time = request_time.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
+                uri = self.uri if self.uri is not None else self.build_uri(event, self.is_payload_format_version_1_0(self.payload_version)),
                 verb = request_verb,
                 api_version = api_version,
-                ip_address = self.client_ip.get_client_address(event['headers'], ip_address),
+                ip_address = self.ip_address if self.ip_address is not None else self.get_ip_address(event),
                 headers = req_headers,
                 body = req_body,
                 transfer_encoding = req_transfer_encoding)
+            self.record_timing('model', start_ns)
 
-            end_time_before_handler_function = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took before the handler is invoked in millisecond - " + str(get_time_took_in_ms(start_time_before_handler_function, end_time_before_handler_function)))
             # Return event, context
             return event, context
 
         def after(self, retval):
             """This function runs after the handler is invoked, is passed the response and must return an response too."""
-            
-            start_time_after_handler_function = datetime.utcnow()
-            event_send = None
+            start_ns = self.start_after()
+            try:
+                return self.capture_response(retval)
+            finally:
+                self.finish_after(start_ns)
+
+        def start_after(self):
+            """Function to start the overhead budget of `after` and bound the requests by it, returns the start time"""
+            start_ns = perf_counter_ns()
+            budget = gv.overhead_budget
+            budget.start_phase(self.context)
+            gv.http_client.set_deadline(budget.deadline)
+            return start_ns
+
+        def finish_after(self, start_ns):
+            """Function to end the overhead budget of `after` and record its timing"""
+            gv.http_client.set_deadline(None)
+            gv.overhead_budget.end_phase()
+            self.record_timing('after', start_ns)
+
+        def capture_response(self, retval):
+            """Function to capture the response and send the event to Moesif, within the overhead budget"""
+
+            if self.batch_trigger is not None:
+                self.capture_batch(self.batch_trigger.get_failed_ids(retval))
+                return retval
+
+            # Tail rules keep the responses such as the errors, whatever the sampling decision
+            kept_by_tail = False
+            if gv.sampler.has_tail_rules and (self.event is not None or self.tail_event is not None):
+                start_ns = perf_counter_ns()
+                duration_ms = (start_ns - self.handler_start_ns) / 1000000.0 if self.handler_start_ns else None
+                kept_by_tail = gv.sampler.keeps_response(self.get_response_status(retval), duration_ms)
+                if kept_by_tail and self.event is None:
+                    event, context = self.tail_event
+                    self.capture_request(event, context, tail_kept=True)
+                self.tail_event = None
+                self.record_timing('sampling', start_ns)
+
             if self.event is not None:
+                # The optional steps are skipped once the overhead budget is exceeded, masking and skipping are not
+                budget = gv.overhead_budget
+
                 # Response body
-                resp_body, resp_transfer_encoding = self.process_body(retval)
+                if budget.allow_step('the response body', self.DEBUG):
+                    start_ns = perf_counter_ns()
+                    resp_body, resp_transfer_encoding = self.process_body(retval)
+                    self.record_timing('response_body', start_ns)
+                else:
+                    resp_body, resp_transfer_encoding = None, 'json'
 
                 # Event Response object
-                event_rsp = EventResponseModel(time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
-                    status = retval.get('statusCode', 599) if 'statusCode' in retval else 200,
+                start_ns = perf_counter_ns()
+                event_rsp = EventResponseRecord(time = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
+                    status = self.get_response_status(retval),
                     headers = retval.get('headers', {}) if 'headers' in retval else {"content-type": "application/json" },
                     body = resp_body,
                     transfer_encoding = resp_transfer_encoding)
 
                 # Event object
-                event_model = EventModel(request = self.event_req,
+                event_model = EventRecord(request = self.event_req,
                     response = event_rsp,
                     user_id = self.user_id,
                     company_id = self.company_id,
                     session_token = self.session_token,
                     metadata = self.metadata)
+                self.record_timing('model', start_ns)
 
                 # Mask Event Model
-                try:
-                    mask_event_model = self.moesif_options.get('MASK_EVENT_MODEL', None)
-                    if mask_event_model is not None:
-                        event_model = mask_event_model(event_model)
-                except Exception as e:
-                    if self.DEBUG:
-                        print("[moesif] cannot execute MASK_EVENT_MODEL function. Please check moesif settings.", e)
+                start_ns = perf_counter_ns()
+                event_model = self.mask_event(event_model)
+                self.record_timing('mask_event_model', start_ns)
+                if event_model is None:
+                    return retval
 
                 # Skip Event
+                start_ns = perf_counter_ns()
                 try:
                     skip_event = self.moesif_options.get('SKIP', None)
                     if skip_event is not None:
                         if skip_event(self.event, self.context):
+                            self.record_timing('skip', start_ns)
                             if self.DEBUG:
                                 print('[moesif] Skip sending event to Moesif')
                             return retval
                 except Exception as e:
                     if self.DEBUG:
                         print("[moesif] Having difficulty executing skip_event function. Please check moesif settings.", e)
+                self.record_timing('skip', start_ns)
 
                 # Add direction field
                 event_model.direction = "Incoming"
@@ -456,45 +1125,61 @@ def MoesifLogger(moesif_options):
 
                 # Sampling Rate
                 try:
-                    random_percentage = random.random() * 100
-                    gv.sampling_percentage = gv.app_config.get_sampling_percentage(
-                        event_model,
-                        json.loads(gv.config.raw_body),
-                        self.user_id,
-                        self.company_id,
-                    )
-
-                    if gv.sampling_percentage >= random_percentage:
-                        event_model.weight = 1 if gv.sampling_percentage == 0 else math.floor(
-                            100 / gv.sampling_percentage)
-
-                        if datetime.utcnow() > gv.last_updated_time + timedelta(seconds=gv.refresh_config_time_seconds):
-                            event_send = self.api_client.create_event(event_model)
+                    start_ns = perf_counter_ns()
+                    sampler = gv.sampler
+                    if kept_by_tail:
+                        # Every response of the tail rules is kept, so the event stands for itself
+                        sampled = True
+                    else:
+                        if self.sampling_percentage is not None:
+                            # Sampled in by `before`
+                            sampled = True
+                            gv.sampling_percentage = self.sampling_percentage
                         else:
-                            self.api_client.create_event(event_model)
+                            sampling_rules = gv.config_cache.get_sampling_rules(self.api_client, self.DEBUG)
+                            gv.sampling_percentage = sampling_rules.get_sampling_percentage(
+                                event_model,
+                                self.user_id,
+                                self.company_id,
+                            )
+                            sampled = sampler.is_sampled(gv.sampling_percentage,
+                                                         self.get_sampling_key_value(sampler.key))
+                        if sampled and not sampler.allow(self.get_sampling_key_value(sampler.rate_limit_key)):
+                            sampled = False
+                            if self.DEBUG:
+                                print("[moesif] Skipped Event due to the sampling rate limit")
+                        # Admitted by `before` when it was sampled in there
+                        if sampled and self.sampling_percentage is None:
+                            keep_fraction = sampler.admit(gv.sampling_percentage)
+                            if keep_fraction is None:
+                                sampled = False
+                                if self.DEBUG:
+                                    print("[moesif] Skipped Event due to the adaptive rate limit")
+                            else:
+                                self.keep_fraction = keep_fraction
+                    self.record_timing('sampling', start_ns)
+
+                    if sampled:
+                        if kept_by_tail:
+                            event_model.weight = 1
+                        else:
+                            event_model.weight = sampler.get_weight(gv.sampling_percentage, self.keep_fraction)
 
-                        try:
-                            # Check if we need to update config
-                            new_config_etag = event_send['x-moesif-config-etag']
-                            if gv.config_etag is None or (gv.config_etag != new_config_etag):
-                                gv.config_etag = new_config_etag
-                                gv.config = gv.app_config.get_config(self.api_client, self.DEBUG)
-                        except (KeyError, TypeError, ValueError) as ex:
-                            # ignore the error because "event_send" is not set in non-blocking call
-                            pass
-                        finally:
-                            gv.last_updated_time = datetime.utcnow()
+                        if not budget.allow_send():
+                            self.defer_event(event_model)
+                        else:
+                            self.send_event(event_model)
 
                     else:
                         if self.DEBUG:
-                            print("Skipped Event due to sampling percentage: " + str(
-                                gv.sampling_percentage) + " and random percentage: " + str(random_percentage))
+                            print("Skipped Event due to sampling percentage: " + str(gv.sampling_percentage))
                 except Exception as ex:
                     print("[moesif] Error when fetching sampling rate from app config", ex)
 
-            end_time_after_handler_function = datetime.utcnow()
-            if self.DEBUG:
-                print("[moesif] Time took after the handler is invoked in millisecond - " + str(get_time_took_in_ms(start_time_after_handler_function, end_time_after_handler_function)))
+            # The profile updates made by the handler are sent once they are due, or by the extension
+            if gv.profile_queues and not (gv.extension is not None and gv.extension.is_running) and \
+                    gv.overhead_budget.allow_step('the profile updates', self.DEBUG):
+                self.send_profile_updates()
 
             # Send response
             return retval
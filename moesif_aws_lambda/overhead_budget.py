@@ -0,0 +1,100 @@
+import time
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a call to Moesif timed out on the deadline of the invocation, rather than on its own timeouts"""
+
+
+def get_remaining_time_ms(context):
+    """Function to get the time left before the invocation times out, None if the context doesn't tell"""
+    get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if get_remaining_time is None:
+        return None
+    try:
+        return get_remaining_time()
+    except Exception:
+        return None
+
+
+class OverheadBudget:
+    """Bounds the time the middleware adds to an invocation, so that capturing events never pushes a
+    function past its timeout.
+
+    The budget of an invocation is `max_overhead_ms`, spent across `before` and `after`, capped by
+    `remaining_time_fraction` of the time the Lambda context has left when each of them starts. Once
+    it is exceeded, the optional steps are skipped and the event is buffered to be sent by a later
+    invocation, as it is when less than `min_send_ms` are left to send it. A step which is already
+    running, such as a user function, is not interrupted: the budget is checked between the steps.
+    """
+
+    def __init__(self, max_overhead_ms=None, remaining_time_fraction=None, min_send_ms=20):
+        self.max_overhead_ms = max_overhead_ms
+        self.remaining_time_fraction = remaining_time_fraction
+        self.min_send_ms = min_send_ms
+        self.spent_seconds = 0
+        self.phase_start_time = None
+        self.deadline = None
+        self.exceeded = False
+
+        # Counters
+        self.invocation_count = 0
+        self.exceeded_count = 0
+        self.skipped_count = 0
+        self.deferred_count = 0
+
+    def start_invocation(self):
+        self.spent_seconds = 0
+        self.exceeded = False
+        self.invocation_count += 1
+
+    def start_phase(self, context):
+        """Function to compute the deadline of `before` or `after`, from what is left of the budget"""
+        now = time.time()
+        self.phase_start_time = now
+        limits = []
+        if self.max_overhead_ms is not None:
+            limits.append(self.max_overhead_ms / 1000.0 - self.spent_seconds)
+        remaining_time_ms = get_remaining_time_ms(context)
+        if self.remaining_time_fraction is not None and remaining_time_ms is not None:
+            limits.append(remaining_time_ms / 1000.0 * self.remaining_time_fraction)
+        self.deadline = now + min(limits) if limits else None
+
+    def end_phase(self):
+        if self.phase_start_time is not None:
+            self.spent_seconds += time.time() - self.phase_start_time
+            self.phase_start_time = None
+
+    def remaining_seconds(self):
+        """Function to get the time left in the budget, None when it is unbounded"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def is_exceeded(self):
+        if not self.exceeded and self.deadline is not None and time.time() >= self.deadline:
+            self.exceeded = True
+            self.exceeded_count += 1
+        return self.exceeded
+
+    def allow_step(self, step, debug=False):
+        """Function to check if an optional step may run, returns False once the budget is exceeded"""
+        if not self.is_exceeded():
+            return True
+        self.skipped_count += 1
+        if debug:
+            print('[moesif] Overhead budget exceeded, skipped ' + step)
+        return False
+
+    def allow_send(self):
+        """Function to check if the event may be sent, returns False once less than `min_send_ms` are left"""
+        if self.is_exceeded():
+            return False
+        return self.deadline is None or self.deadline - time.time() >= (self.min_send_ms or 0) / 1000.0
+
+    def stats(self):
+        return {
+            'invocation_count': self.invocation_count,
+            'exceeded_count': self.exceeded_count,
+            'skipped_count': self.skipped_count,
+            'deferred_count': self.deferred_count,
+        }
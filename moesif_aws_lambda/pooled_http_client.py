@@ -0,0 +1,162 @@
+from moesifapi.http.http_method_enum import HttpMethodEnum
+from moesifapi.http.requests_client import RequestsClient, refresh_session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .overhead_budget import DeadlineExceededError
+import requests
+import threading
+import time
+
+
+class MoesifHttpClient(RequestsClient):
+    """HTTP client with a keep-alive connection pool shared by every call made to Moesif.
+
+    The pool outlives invocations, so warm invocations reuse open connections instead of paying a
+    new TCP and TLS handshake. Unlike the default client, every request is bounded by timeouts, and
+    the requests go through a circuit breaker which stops calling Moesif while it is failing. A thread
+    may also set a deadline, which caps the timeouts of its requests.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=2, read_timeout=10, max_retries=2):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.circuit_breaker = CircuitBreaker()
+        # Deadlines are set by the invocation thread, and don't apply to the background threads
+        self.local = threading.local()
+        # Counters of the pools discarded when the connection pool was refreshed
+        self.discarded_requests = 0
+        self.discarded_connections = 0
+        RequestsClient.__init__(self)
+
+    def __create_connection_pool__(self):
+        retry_strategy = Retry(
+            total=self.max_retries,
+            backoff_factor=0.1,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(
+            max_retries=retry_strategy,
+            pool_connections=1,
+            pool_maxsize=self.pool_size
+        )
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def __refresh_connection_pool__(self):
+        self.discard_pools()
+        RequestsClient.__refresh_connection_pool__(self)
+
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None, max_retries=None):
+        """Function to apply the options, the connection pool is only recreated if its settings changed"""
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if (pool_size is not None and pool_size != self.pool_size) or \
+                (max_retries is not None and max_retries != self.max_retries):
+            self.pool_size = pool_size if pool_size is not None else self.pool_size
+            self.max_retries = max_retries if max_retries is not None else self.max_retries
+            self.discard_pools()
+            self.session.close()
+            self.__create_connection_pool__()
+
+    def configure_circuit_breaker(self, enabled=True, failure_threshold=5, slow_call_seconds=5, reset_seconds=30):
+        """Function to apply the circuit breaker options, its state is kept"""
+        if not enabled:
+            self.circuit_breaker = None
+            return
+        if self.circuit_breaker is None:
+            self.circuit_breaker = CircuitBreaker()
+        self.circuit_breaker.failure_threshold = failure_threshold
+        self.circuit_breaker.slow_call_seconds = slow_call_seconds
+        self.circuit_breaker.reset_seconds = reset_seconds
+
+    def set_deadline(self, deadline):
+        """Function to bound the requests of the current thread to end by `deadline`, a time.time() timestamp, or
+        None to remove the bound"""
+        self.local.deadline = deadline
+
+    def is_past_deadline(self):
+        deadline = getattr(self.local, 'deadline', None)
+        return deadline is not None and time.time() >= deadline
+
+    def get_timeout(self, http_method=None):
+        """Function to get the connect and read timeouts of a request, capped by the deadline of the current thread"""
+        deadline = getattr(self.local, 'deadline', None)
+        if deadline is None:
+            self.local.timeout_capped = False
+            return self.connect_timeout, self.read_timeout
+        remaining = max(deadline - time.time(), 0.001)
+        # Each attempt of the retry strategy gets an equal share of the time left, connection errors are retried
+        # for any method but read errors are not for POSTs
+        share = remaining / ((self.max_retries or 0) + 1)
+        connect_timeout = min(self.connect_timeout, share)
+        read_timeout = min(self.read_timeout, remaining if http_method == HttpMethodEnum.POST else share)
+        self.local.timeout_capped = connect_timeout < self.connect_timeout or read_timeout < self.read_timeout
+        return connect_timeout, read_timeout
+
+    def discard_pools(self):
+        stats = self.connection_stats()
+        self.discarded_requests = stats['requests']
+        self.discarded_connections = stats['new_connections']
+
+    def connection_stats(self):
+        """Function to count the requests sent over a new connection and over a reused connection"""
+        requests_count = self.discarded_requests
+        connections_count = self.discarded_connections
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
+        return {
+            'requests': requests_count,
+            'new_connections': connections_count,
+            'reused_connections': requests_count - connections_count,
+        }
+
+    def execute_as_string(self, request):
+        """Execute a given HttpRequest to get a string response back, raises CircuitOpenError while the circuit
+        breaker is open, and DeadlineExceededError when the request timed out on the deadline of the thread"""
+        circuit_breaker = self.circuit_breaker
+        if circuit_breaker is not None and not circuit_breaker.allow_request():
+            raise CircuitOpenError('Not calling Moesif while the circuit breaker is open')
+        start = time.time()
+        try:
+            response = self.send(request)
+        except Exception as ex:
+            # Cut short by the deadline rather than by Moesif, so it isn't counted as a failure of Moesif
+            if isinstance(ex, requests.exceptions.Timeout) and getattr(self.local, 'timeout_capped', False):
+                if circuit_breaker is not None:
+                    circuit_breaker.record_abandoned()
+                raise DeadlineExceededError('The request to Moesif timed out on the deadline of the invocation')
+            if circuit_breaker is not None:
+                circuit_breaker.record_failure()
+            raise
+        if circuit_breaker is not None:
+            circuit_breaker.record_result(response.status_code, time.time() - start)
+        return response
+
+    @refresh_session
+    def send(self, request):
+        auth = None
+
+        if request.username or request.password:
+            auth = (request.username, request.password)
+
+        response = self.session.request(HttpMethodEnum.to_string(request.http_method),
+                                        request.query_url,
+                                        headers=request.headers,
+                                        params=request.query_parameters,
+                                        data=request.parameters,
+                                        files=request.files,
+                                        auth=auth,
+                                        timeout=self.get_timeout(request.http_method))
+
+        return self.convert_response(response, False)
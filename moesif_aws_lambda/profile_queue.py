@@ -0,0 +1,142 @@
+from moesifapi.api_helper import APIHelper
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+# Fields which change on every update without changing the profile, left out of the content hash
+VOLATILE_FIELDS = ('modified_time',)
+
+
+def to_profile_dict(profile):
+    """Function to get a user or company profile as a dict, from a dict, a model or a JSON string"""
+    if isinstance(profile, dict):
+        return profile
+    if isinstance(profile, str):
+        return APIHelper.json_deserialize(profile)
+    # Serialized and parsed back, so that the fields are JSON types, such as the dates
+    return json.loads(APIHelper.json_serialize(profile))
+
+
+def is_serializable(profile):
+    """Function to check that a profile can be sent as JSON, such as without datetime or Decimal values"""
+    try:
+        json.dumps(profile, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def merge_profiles(profile, update):
+    """Function to merge an update into a profile, the fields of the update win and the metadata is merged key by key"""
+    merged = dict(profile)
+    for name, value in update.items():
+        if name == 'metadata' and isinstance(value, dict) and isinstance(merged.get('metadata'), dict):
+            metadata = dict(merged['metadata'])
+            metadata.update(value)
+            merged['metadata'] = metadata
+        elif value is not None:
+            merged[name] = value
+    return merged
+
+
+def profile_hash(profile):
+    content = dict((name, value) for name, value in profile.items() if name not in VOLATILE_FIELDS)
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).digest()
+
+
+class ProfileQueue:
+    """Buffers the updates of user or company profiles across warm invocations, to send them in batches.
+
+    The updates of the same profile within the window are coalesced into one, and a profile which is
+    unchanged since it was last sent is not sent again, based on a hash of its content kept for the
+    `dedupe_cache_size` most recently sent profiles. A flush is due once `batch_size` profiles are
+    pending, or when the oldest pending update has waited more than `window_seconds`.
+    """
+
+    def __init__(self, id_field, path, batch_size=100, window_seconds=5, dedupe_cache_size=10000):
+        self.id_field = id_field
+        self.path = path
+        self.batch_size = batch_size
+        self.window_seconds = window_seconds
+        self.dedupe_cache_size = dedupe_cache_size
+        self.pending = OrderedDict()
+        self.oldest_update_time = None
+        self.sent_hashes = OrderedDict()
+        # The queue may be flushed by the Lambda extension thread
+        self.lock = threading.Lock()
+
+        # Counters
+        self.coalesced_count = 0
+        self.deduplicated_count = 0
+        self.sent_count = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, profile):
+        """Function to buffer the update of a profile, returns False if it has no id"""
+        profile_id = profile.get(self.id_field)
+        if profile_id is None:
+            return False
+        with self.lock:
+            if not self.pending:
+                self.oldest_update_time = time.time()
+            pending_profile = self.pending.get(profile_id)
+            if pending_profile is not None:
+                self.pending[profile_id] = merge_profiles(pending_profile, profile)
+                self.coalesced_count += 1
+            else:
+                self.pending[profile_id] = profile
+        return True
+
+    def should_flush(self):
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.batch_size or time.time() - self.oldest_update_time >= self.window_seconds
+
+    def drain(self):
+        """Function to empty the queue, returns the changed profiles split into batches of `batch_size`"""
+        with self.lock:
+            profiles = list(self.pending.values())
+            self.pending = OrderedDict()
+            self.oldest_update_time = None
+
+        changed = []
+        for profile in profiles:
+            if self.sent_hashes.get(profile[self.id_field]) == profile_hash(profile):
+                self.deduplicated_count += 1
+            else:
+                changed.append(profile)
+        return [changed[index:index + self.batch_size] for index in range(0, len(changed), self.batch_size)]
+
+    def mark_sent(self, batch):
+        """Function to remember the content of the sent profiles, so that they are not sent again unchanged"""
+        with self.lock:
+            for profile in batch:
+                profile_id = profile[self.id_field]
+                self.sent_hashes.pop(profile_id, None)
+                self.sent_hashes[profile_id] = profile_hash(profile)
+            while len(self.sent_hashes) > self.dedupe_cache_size:
+                self.sent_hashes.popitem(last=False)
+            self.sent_count += len(batch)
+
+    def requeue(self, batch):
+        """Function to buffer the profiles of a batch which failed to be sent again, under the updates made since"""
+        with self.lock:
+            if not self.pending:
+                self.oldest_update_time = time.time()
+            for profile in batch:
+                profile_id = profile[self.id_field]
+                pending_profile = self.pending.get(profile_id)
+                self.pending[profile_id] = merge_profiles(profile, pending_profile) \
+                    if pending_profile is not None else profile
+
+    def stats(self):
+        return {
+            'pending_count': len(self.pending),
+            'coalesced_count': self.coalesced_count,
+            'deduplicated_count': self.deduplicated_count,
+            'sent_count': self.sent_count,
+        }
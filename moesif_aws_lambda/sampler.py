@@ -0,0 +1,216 @@
+from collections import OrderedDict
+import hashlib
+import math
+import random
+import threading
+import time
+
+# Fields of the event the sampling decision or the rate limit can be keyed on
+SAMPLING_KEYS = ('user_id', 'company_id', 'request_id')
+
+
+def hash_percentage(value):
+    """Function to map a key to a stable percentage in [0, 100), the same on every container"""
+    digest = hashlib.md5(str(value).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / float(1 << 64) * 100
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `burst` events"""
+    __slots__ = ('rate', 'burst', 'tokens', 'last_time')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = now
+
+    def try_acquire(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdaptiveRateLimiter:
+    """Caps the events per second a container sends, by keeping a share of the sampled events.
+
+    The rate of the sampled events is measured over windows of `window_seconds` and smoothed. When it
+    exceeds `max_events_per_second`, each event is kept with the probability of the ceiling over the
+    rate, which the weight of the kept events makes up for. The share goes back up with the traffic.
+    """
+
+    def __init__(self, max_events_per_second, window_seconds=1):
+        self.max_events_per_second = max_events_per_second
+        self.window_seconds = window_seconds
+        self.window_start_time = time.time()
+        self.window_offered_count = 0
+        self.window_kept_count = 0
+        self.offered_rate = 0.0
+        self.kept_rate = 0.0
+        self.keep_fraction = 1.0
+        self.lock = threading.Lock()
+
+    def roll_window(self, now):
+        elapsed = now - self.window_start_time
+        if elapsed < self.window_seconds:
+            return
+        offered_rate = self.window_offered_count / elapsed
+        kept_rate = self.window_kept_count / elapsed
+        # Smoothed over consecutive windows, a container frozen in between starts over
+        if elapsed < 2 * self.window_seconds:
+            offered_rate = (self.offered_rate + offered_rate) / 2
+            kept_rate = (self.kept_rate + kept_rate) / 2
+        self.offered_rate = offered_rate
+        self.kept_rate = kept_rate
+        self.window_start_time = now
+        self.window_offered_count = 0
+        self.window_kept_count = 0
+
+    def admit(self):
+        """Function to count a sampled event, returns the share of the events it is kept at, or None if it is dropped"""
+        with self.lock:
+            self.roll_window(time.time())
+            self.window_offered_count += 1
+            # The events of the current window already bound the rate from below, so spikes are seen at once
+            offered_rate = max(self.offered_rate, self.window_offered_count / float(self.window_seconds))
+            self.keep_fraction = min(1.0, self.max_events_per_second / offered_rate)
+            if self.keep_fraction < 1.0 and random.random() >= self.keep_fraction:
+                return None
+            self.window_kept_count += 1
+            return self.keep_fraction
+
+    def stats(self):
+        with self.lock:
+            self.roll_window(time.time())
+            return {
+                'offered_events_per_second': self.offered_rate,
+                'sent_events_per_second': self.kept_rate,
+                'keep_fraction': self.keep_fraction,
+            }
+
+
+class Sampler:
+    """Decides which events are sent to Moesif, from the sampling percentage of the app config.
+
+    With a sampling `key`, the decision is a hash of the user id, company id or request id of the
+    event instead of a random draw, so the events of the same user or trace are kept or dropped
+    together, on any container. The kept events are then limited to `rate_limit` events per second,
+    per value of `rate_limit_key` or for the whole container, with a token bucket for each of the
+    `max_keys` most recent values. Tail rules keep every response with a status of at least
+    `keep_status` or slower than `keep_slow_ms`, regardless of the sampling and the rate limit.
+    With `max_events_per_second`, an `AdaptiveRateLimiter` lowers the effective sampling percentage
+    of the container during traffic spikes.
+
+    Subclass it and pass an instance as the SAMPLER option to plug in another policy.
+    """
+
+    def __init__(self, key=None, rate_limit=None, rate_limit_burst=None, rate_limit_key=None, keep_status=None,
+                 keep_slow_ms=None, max_keys=10000, max_events_per_second=None, rate_window_seconds=1):
+        if key is not None and key not in SAMPLING_KEYS:
+            print('[moesif] Unknown SAMPLING_KEY ' + str(key) + ', sampling at random instead')
+            key = None
+        if rate_limit_key is not None and rate_limit_key not in SAMPLING_KEYS:
+            print('[moesif] Unknown SAMPLING_RATE_LIMIT_KEY ' + str(rate_limit_key) + ', limiting the container instead')
+            rate_limit_key = None
+        self.key = key
+        self.rate_limit = rate_limit
+        self.rate_limit_burst = rate_limit_burst or max(rate_limit or 1, 1)
+        self.rate_limit_key = rate_limit_key
+        self.keep_status = keep_status
+        self.keep_slow_ms = keep_slow_ms
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.adaptive_limiter = AdaptiveRateLimiter(max_events_per_second, rate_window_seconds) \
+            if max_events_per_second else None
+        # Sampling percentage of the last event kept, with the share of the adaptive rate limit
+        self.effective_sampling_percentage = None
+        # Events may be sampled from the threads of an async handler's executor
+        self.lock = threading.Lock()
+
+        # Counters
+        self.rate_limited_count = 0
+        self.tail_kept_count = 0
+
+    @classmethod
+    def from_options(cls, moesif_options):
+        """Function to get the sampler of the SAMPLER option, or to build one from the sampling options"""
+        sampler = moesif_options.get('SAMPLER')
+        if sampler is not None:
+            return sampler
+        return cls(key=moesif_options.get('SAMPLING_KEY'),
+                   rate_limit=moesif_options.get('SAMPLING_RATE_LIMIT'),
+                   rate_limit_burst=moesif_options.get('SAMPLING_RATE_LIMIT_BURST'),
+                   rate_limit_key=moesif_options.get('SAMPLING_RATE_LIMIT_KEY'),
+                   keep_status=moesif_options.get('SAMPLING_KEEP_STATUS'),
+                   keep_slow_ms=moesif_options.get('SAMPLING_KEEP_SLOW_MS'),
+                   max_events_per_second=moesif_options.get('MAX_EVENTS_PER_SECOND'),
+                   rate_window_seconds=moesif_options.get('RATE_LIMIT_WINDOW_SECONDS', 1))
+
+    @property
+    def has_tail_rules(self):
+        return self.keep_status is not None or self.keep_slow_ms is not None
+
+    def is_sampled(self, sampling_percentage, key_value=None):
+        """Function to decide if an event is kept at the sampling percentage, from its key value when there is one"""
+        if sampling_percentage >= 100:
+            return True
+        if key_value is None:
+            return sampling_percentage >= random.random() * 100
+        return hash_percentage(key_value) < sampling_percentage
+
+    def allow(self, key_value=None):
+        """Function to take a token of the rate limit of the key value, returns False if the event is rate limited"""
+        if self.rate_limit is None:
+            return True
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(key_value)
+            if bucket is None:
+                bucket = self.buckets[key_value] = TokenBucket(self.rate_limit, self.rate_limit_burst, now)
+                while len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key_value)
+            if bucket.try_acquire(now):
+                return True
+            self.rate_limited_count += 1
+            return False
+
+    def admit(self, sampling_percentage):
+        """Function to apply the adaptive rate limit to a sampled event, returns the share it is kept at, or None if it is dropped"""
+        keep_fraction = self.adaptive_limiter.admit() if self.adaptive_limiter is not None else 1.0
+        if keep_fraction is not None:
+            self.effective_sampling_percentage = sampling_percentage * keep_fraction
+        return keep_fraction
+
+    def get_weight(self, sampling_percentage, keep_fraction=1.0):
+        """Function to get the number of events a kept event stands for"""
+        if sampling_percentage == 0:
+            return 1
+        if keep_fraction >= 1.0:
+            return math.floor(100 / sampling_percentage)
+        weight = 100.0 / (sampling_percentage * keep_fraction)
+        # Rounded at random, so that the weights add up to the number of events on average
+        return int(weight) + (1 if random.random() < weight - int(weight) else 0)
+
+    def keeps_response(self, status, duration_ms=None):
+        """Function to check if a tail rule keeps the response, whatever the sampling decision"""
+        kept = (self.keep_status is not None and status is not None and int(status) >= self.keep_status) or \
+               (self.keep_slow_ms is not None and duration_ms is not None and duration_ms >= self.keep_slow_ms)
+        if kept:
+            self.tail_kept_count += 1
+        return kept
+
+    def stats(self):
+        stats = {
+            'rate_limited_count': self.rate_limited_count,
+            'tail_kept_count': self.tail_kept_count,
+            'rate_limit_keys': len(self.buckets),
+        }
+        if self.adaptive_limiter is not None:
+            stats.update(self.adaptive_limiter.stats())
+            stats['effective_sampling_percentage'] = self.effective_sampling_percentage
+        return stats
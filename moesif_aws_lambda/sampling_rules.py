@@ -0,0 +1,127 @@
+import json
+import re
+
+ROUTE_REGEX = re.compile(r"http[s]*://[^/]+(/[^?]+)")
+
+
+class SamplingRules:
+    """Sampling rules of the app config, parsed once per config with the regex conditions precompiled.
+
+    Mirrors `AppConfig.get_sampling_percentage`: the first matching regex rule wins, then the user
+    sample rate, then the company sample rate, then the default sample rate.
+    """
+
+    def __init__(self, config_body=None):
+        config_body = config_body or {}
+        self.default_sample_rate = config_body.get('sample_rate', 100)
+        self.user_sample_rate = config_body.get('user_sample_rate') or {}
+        self.company_sample_rate = config_body.get('company_sample_rate') or {}
+
+        self.regex_rules = []
+        # Request fields the regex rules depend on
+        self.request_paths = set()
+        for regex_rule in config_body.get('regex_config') or []:
+            # Conditions on the same path override each other, as in AppConfig
+            condition_table = {}
+            for condition in regex_rule['conditions']:
+                condition_table[condition['path']] = condition['value']
+            conditions = [(path, re.compile(str(value))) for path, value in condition_table.items()]
+            self.regex_rules.append((regex_rule['sample_rate'], conditions))
+            self.request_paths.update(path for path in condition_table if path.startswith('request.'))
+
+    @classmethod
+    def from_config(cls, config):
+        """Function to build the rules from the app config response, the default rules are used if it can't be parsed"""
+        if config is None:
+            return cls()
+        try:
+            return cls(json.loads(config.raw_body))
+        except Exception as e:
+            print('[moesif] Error while parsing the app config sampling rules, using the default sample rate', e)
+            return cls()
+
+    @classmethod
+    def prepare_request_mapping(cls, verb, uri=None, ip_address=None):
+        """Function to map the request rule paths to the values of the request"""
+        config_mapping = {}
+        if verb:
+            config_mapping['request.verb'] = verb
+        if uri:
+            extracted = ROUTE_REGEX.match(uri)
+            config_mapping['request.route'] = extracted.group(1) if extracted is not None else '/'
+        if ip_address:
+            config_mapping['request.ip_address'] = ip_address
+        return config_mapping
+
+    @classmethod
+    def prepare_config_mapping(cls, event_model):
+        """Function to map the rule paths to the values of the event"""
+        request = event_model.request
+        config_mapping = cls.prepare_request_mapping(request.verb, request.uri, request.ip_address)
+        if event_model.response is not None and event_model.response.status:
+            config_mapping['response.status'] = event_model.response.status
+        return config_mapping
+
+    def fetch_regex_sample_rate(self, config_mapping, response_known=True):
+        """Function to get the sample rate of the first matching regex rule.
+
+        When `response_known` is False, raises `LookupError` if the first rule that can still match
+        depends on the response.
+        """
+        for sample_rate, conditions in self.regex_rules:
+            regex_matched = False
+            depends_on_response = False
+            for path, regex in conditions:
+                if not response_known and path.startswith('response.'):
+                    depends_on_response = True
+                    continue
+                regex_matched = self.condition_matches(regex, config_mapping.get(path))
+                if not regex_matched:
+                    break
+            else:
+                if depends_on_response:
+                    raise LookupError('Sampling rule depends on the response')
+            if regex_matched:
+                return sample_rate
+        return None
+
+    @staticmethod
+    def condition_matches(regex, event_value):
+        if not event_value:
+            return False
+        extracted = regex.search(str(event_value))
+        return extracted is not None and bool(extracted.group(0))
+
+    def get_request_sampling_percentage(self, config_mapping):
+        """Function to get the sampling percentage from the request alone, before the event is built.
+
+        Returns None when the decision depends on the response, the user or the company, in which
+        case it is made once the event is built.
+        """
+        if self.regex_rules:
+            try:
+                regex_sample_rate = self.fetch_regex_sample_rate(config_mapping, response_known=False)
+            except LookupError:
+                return None
+            if regex_sample_rate is not None:
+                return regex_sample_rate
+
+        if self.user_sample_rate or self.company_sample_rate:
+            return None
+
+        return self.default_sample_rate
+
+    def get_sampling_percentage(self, event_model, user_id, company_id):
+        """Function to get the sampling percentage of the event"""
+        if self.regex_rules:
+            regex_sample_rate = self.fetch_regex_sample_rate(self.prepare_config_mapping(event_model))
+            if regex_sample_rate is not None:
+                return regex_sample_rate
+
+        if user_id and user_id in self.user_sample_rate:
+            return self.user_sample_rate[user_id]
+
+        if company_id and company_id in self.company_sample_rate:
+            return self.company_sample_rate[company_id]
+
+        return self.default_sample_rate
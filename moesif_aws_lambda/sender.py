@@ -0,0 +1,118 @@
+from collections import deque
+import threading
+import time
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class EventSender:
+    """Daemon thread which sends serialized events from a bounded queue in batches.
+
+    When the queue is full, `overflow_policy` decides which event is dropped:
+    - `drop_oldest`: the oldest queued event is dropped to make room for the new one
+    - `drop_newest`: the new event is dropped
+    - `block`: the caller waits up to `block_timeout` seconds for room, then drops the new event
+    """
+
+    def __init__(self, send_batch, max_queue_size=1000, overflow_policy=DROP_OLDEST, block_timeout=0.05,
+                 batch_size=25, max_batch_bytes=200000, debug=False):
+        if overflow_policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            print('[moesif] Unknown QUEUE_OVERFLOW_POLICY ' + str(overflow_policy) + ', dropping the oldest events instead')
+            overflow_policy = DROP_OLDEST
+        self.send_batch = send_batch
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.debug = debug
+        self.queue = deque()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+        # Counters
+        self.sent_count = 0
+        self.failed_count = 0
+        self.dropped_oldest_count = 0
+        self.dropped_newest_count = 0
+
+    @property
+    def dropped_count(self):
+        return self.dropped_oldest_count + self.dropped_newest_count
+
+    def __len__(self):
+        return len(self.queue)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='moesif-event-sender')
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def put(self, payload):
+        """Function to queue a serialized event, returns False if the event was dropped"""
+        with self.condition:
+            if len(self.queue) >= self.max_queue_size:
+                if self.overflow_policy == DROP_OLDEST:
+                    self.queue.popleft()
+                    self.dropped_oldest_count += 1
+                else:
+                    if self.overflow_policy == BLOCK:
+                        deadline = time.time() + self.block_timeout
+                        while len(self.queue) >= self.max_queue_size and time.time() < deadline:
+                            self.condition.wait(deadline - time.time())
+                    if len(self.queue) >= self.max_queue_size:
+                        self.dropped_newest_count += 1
+                        if self.debug:
+                            print('[moesif] Event queue is full, dropped the event')
+                        return False
+            self.queue.append(payload)
+            self.condition.notify_all()
+            return True
+
+    def take_batch(self):
+        """Function to wait for events and pop a batch within the bounds"""
+        with self.condition:
+            while not self.queue:
+                self.condition.wait()
+            batch = [self.queue.popleft()]
+            batch_bytes = len(batch[0])
+            while self.queue and len(batch) < self.batch_size \
+                    and batch_bytes + len(self.queue[0]) <= self.max_batch_bytes:
+                batch_bytes += len(self.queue[0])
+                batch.append(self.queue.popleft())
+            self.in_flight = len(batch)
+            # Wake up callers blocked on a full queue
+            self.condition.notify_all()
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            try:
+                success = self.send_batch(batch)
+            except Exception as e:
+                print('[moesif] Error while sending events from the background thread', e)
+                success = False
+            with self.condition:
+                if success:
+                    self.sent_count += len(batch)
+                else:
+                    self.failed_count += len(batch)
+                self.in_flight = 0
+                self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Function to wait until every queued event was sent, returns False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.queue or self.in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
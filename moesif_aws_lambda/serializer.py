@@ -0,0 +1,106 @@
+from moesifapi.models.base_model import BaseModel
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class EventRequestRecord(BaseModel):
+    """Request of a captured event, with the attributes of `EventRequestModel`"""
+    __slots__ = ('time', 'uri', 'verb', 'headers', 'api_version', 'ip_address', 'body', 'transfer_encoding')
+
+    def __init__(self, time=None, uri=None, verb=None, headers=None, api_version=None, ip_address=None, body=None,
+                 transfer_encoding=None):
+        self.time = time
+        self.uri = uri
+        self.verb = verb
+        self.headers = headers
+        self.api_version = api_version
+        self.ip_address = ip_address
+        self.body = body
+        self.transfer_encoding = transfer_encoding
+
+
+class EventResponseRecord(BaseModel):
+    """Response of a captured event, with the attributes of `EventResponseModel`"""
+    __slots__ = ('time', 'status', 'headers', 'body', 'ip_address', 'transfer_encoding')
+
+    def __init__(self, time=None, status=None, headers=None, body=None, ip_address=None, transfer_encoding=None):
+        self.time = time
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.ip_address = ip_address
+        self.transfer_encoding = transfer_encoding
+
+
+class EventRecord(BaseModel):
+    """Captured event, with the attributes of `EventModel`.
+
+    The records are lighter to build than the moesifapi models, and remain usable wherever a model is,
+    such as in the MASK_EVENT_MODEL function or with `APIHelper.json_serialize`.
+    """
+    __slots__ = ('request', 'response', 'session_token', 'tags', 'user_id', 'company_id', 'metadata', 'direction',
+                 'weight', 'blocked_by', 'transaction_id')
+
+    def __init__(self, request=None, response=None, session_token=None, tags=None, user_id=None, company_id=None,
+                 metadata=None, direction=None, weight=None, blocked_by=None, transaction_id=None):
+        self.request = request
+        self.response = response
+        self.session_token = session_token
+        self.tags = tags
+        self.user_id = user_id
+        self.company_id = company_id
+        self.metadata = metadata
+        self.direction = direction
+        self.weight = weight
+        self.blocked_by = blocked_by
+        self.transaction_id = transaction_id if transaction_id is not None else str(uuid.uuid4())
+
+
+# Mapping from the record attributes to the API property names, used by `BaseModel.to_dictionary`
+for record_class in (EventRequestRecord, EventResponseRecord, EventRecord):
+    record_class.names = dict((name, name) for name in record_class.__slots__)
+
+REQUEST_FIELDS = EventRequestRecord.__slots__
+RESPONSE_FIELDS = EventResponseRecord.__slots__
+EVENT_FIELDS = tuple(name for name in EventRecord.__slots__ if name not in ('request', 'response'))
+
+
+def fields_to_dict(obj, fields):
+    """Function to map the fields of the record or model which are set"""
+    dictionary = {}
+    for name in fields:
+        value = getattr(obj, name, None)
+        if value is not None:
+            dictionary[name] = value.to_dictionary() if isinstance(value, BaseModel) else value
+    return dictionary
+
+
+def event_to_dict(event_model):
+    """Function to map an event record, or an `EventModel`, to the dictionary sent to Moesif.
+
+    The attributes are read directly rather than through `BaseModel.to_dictionary`, and those which
+    are not set are left out.
+    """
+    event = fields_to_dict(event_model, EVENT_FIELDS)
+    if event_model.request is not None:
+        event['request'] = fields_to_dict(event_model.request, REQUEST_FIELDS)
+    if event_model.response is not None:
+        event['response'] = fields_to_dict(event_model.response, RESPONSE_FIELDS)
+    return event
+
+
+def serialize_event(event_model):
+    """Function to serialize an event record, or an `EventModel`, to JSON bytes"""
+    event = event_to_dict(event_model)
+    if orjson is not None:
+        try:
+            return orjson.dumps(event)
+        except TypeError:
+            # Such as keys which are not strings, which the json module accepts
+            pass
+    return json.dumps(event, separators=(',', ':')).encode('utf-8')
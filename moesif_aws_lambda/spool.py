@@ -0,0 +1,183 @@
+from moesifapi.exceptions.api_exception import APIException
+from .circuit_breaker import CircuitOpenError
+from .overhead_budget import DeadlineExceededError
+import concurrent.futures
+import os
+import random
+import struct
+import sys
+import threading
+import time
+
+RECORD_HEADER = struct.Struct('>I')
+
+
+def is_retryable_error(exception):
+    """Function to check if a failed delivery may succeed later, such as on network errors, 429 or 5xx responses.
+
+    Other errors, such as a payload which can't be serialized, would fail again on every retry.
+    """
+    if isinstance(exception, APIException):
+        return exception.response_code == 429 or exception.response_code >= 500
+    # The requests exceptions are OSErrors, and so are the timeouts from Python 3.10
+    if isinstance(exception, (OSError, CircuitOpenError, DeadlineExceededError, concurrent.futures.TimeoutError)):
+        return True
+    aiohttp = sys.modules.get('aiohttp')
+    return aiohttp is not None and isinstance(exception, aiohttp.ClientError)
+
+
+def parse_records(data):
+    """Function to parse the records of the spool, returns the bodies and the offset where the complete records end"""
+    bodies = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, = RECORD_HEADER.unpack_from(data, offset)
+        if offset + RECORD_HEADER.size + length > len(data):
+            break
+        offset += RECORD_HEADER.size
+        bodies.append(data[offset:offset + length])
+        offset += length
+    return bodies, offset
+
+
+class Spool:
+    """Bounded spool of failed batches in a file, such as in Lambda's /tmp, to retry them later.
+
+    Each batch is appended as a record of its length followed by its body. When appending would grow
+    the file over `max_bytes`, the oldest records are evicted. A record left incomplete by a crash
+    ends the file and is dropped.
+
+    The retries are spaced with an exponential backoff from `backoff_seconds` up to
+    `max_backoff_seconds`, with jitter so that the containers of a function don't retry in step.
+    """
+
+    def __init__(self, path='/tmp/moesif-events.spool', max_bytes=10000000, backoff_seconds=1,
+                 max_backoff_seconds=300):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.attempts = 0
+        self.next_retry_time = 0
+        self.evicted_count = 0
+        # Whether a record left incomplete at the end of the file was looked for
+        self.tail_checked = False
+        self.lock = threading.RLock()
+        # Held while batches are resent, so that two threads don't resend the same ones
+        self.retry_lock = threading.Lock()
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def is_empty(self):
+        return self.size() == 0
+
+    def append(self, body):
+        """Function to spool the body of a batch, evicting the oldest batches over the size cap, returns False if
+        the batch is larger than the cap"""
+        record = RECORD_HEADER.pack(len(body)) + body
+        if len(record) > self.max_bytes:
+            self.evicted_count += 1
+            return False
+        with self.lock:
+            if not self.tail_checked:
+                self.truncate_incomplete_record()
+            size = self.size()
+            if size + len(record) > self.max_bytes:
+                self.evict(size + len(record) - self.max_bytes)
+            try:
+                with open(self.path, 'ab') as f:
+                    f.write(record)
+            except (IOError, OSError):
+                # Such as a full disk, the record may have been written in part
+                self.tail_checked = False
+                raise
+            return True
+
+    def truncate_incomplete_record(self):
+        """Function to drop a record left incomplete at the end of the file, so that the records appended after it
+        can be read"""
+        with self.lock:
+            self.tail_checked = True
+            try:
+                with open(self.path, 'rb+') as f:
+                    data = f.read()
+                    end = parse_records(data)[1]
+                    if end < len(data):
+                        f.truncate(end)
+                        print('[moesif] Dropped an incomplete batch at the end of the event spool')
+            except (IOError, OSError):
+                pass
+
+    def read(self):
+        """Function to read the spooled batch bodies, oldest first"""
+        with self.lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            except (IOError, OSError):
+                return []
+        return parse_records(data)[0]
+
+    def peek(self, max_count=None):
+        """Function to get the oldest spooled batch bodies, without removing them"""
+        bodies = self.read()
+        return bodies if max_count is None else bodies[:max_count]
+
+    def discard(self, bodies):
+        """Function to remove the oldest batches once they are sent, as returned by `peek`.
+
+        Batches may have been evicted since `peek`, so only those of `bodies` still at the head of the
+        spool are removed, rather than a count of batches which would drop newer ones.
+        """
+        if not bodies:
+            return
+        with self.lock:
+            spooled = self.read()
+            sent = list(bodies)
+            while sent and spooled[:len(sent)] != sent:
+                sent.pop(0)
+            if sent:
+                self.rewrite(spooled[len(sent):])
+
+    def evict(self, needed_bytes):
+        """Function to remove the oldest batches until `needed_bytes` are freed"""
+        with self.lock:
+            bodies = self.read()
+            freed = 0
+            evicted = 0
+            while bodies and freed < needed_bytes:
+                freed += RECORD_HEADER.size + len(bodies.pop(0))
+                evicted += 1
+            self.evicted_count += evicted
+            self.rewrite(bodies)
+            print('[moesif] Event spool is full, evicted the ' + str(evicted) + ' oldest batches')
+
+    def rewrite(self, bodies):
+        if not bodies:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for body in bodies:
+                f.write(RECORD_HEADER.pack(len(body)) + body)
+        os.rename(temp_path, self.path)
+
+    def is_retry_due(self):
+        return time.time() >= self.next_retry_time
+
+    def retry_failed(self):
+        """Function to push back the next retry, doubling the backoff after each failure"""
+        self.attempts += 1
+        backoff = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (self.attempts - 1))
+        self.next_retry_time = time.time() + backoff / 2.0 + random.uniform(0, backoff / 2.0)
+
+    def retry_succeeded(self):
+        self.attempts = 0
+        self.next_retry_time = 0
@@ -1,7 +1,43 @@
 import json
 import unittest
 import base64
-from ..middleware import MoesifLogger
+import gzip
+from moesifapi.models import EventModel, EventRequestModel, EventResponseModel
+from ..middleware import MoesifLogger, bulk_update_users, flush_profile_updates, update_companies_batch, \
+    update_company, update_user, update_users_batch
+from ..async_middleware import MoesifAsyncLogger
+from ..event_queue import EventQueue
+from ..extension import LambdaExtension
+from ..fake_extensions_api import FakeExtensionsApi
+from ..sender import EventSender
+from ..pooled_http_client import MoesifHttpClient
+from ..config_cache import ConfigCache
+from ..sampling_rules import SamplingRules
+from ..sampler import AdaptiveRateLimiter, Sampler
+from ..batch_triggers import BatchTrigger, RecordSerializer, build_event, get_batch_source
+from ..compression import Compressor
+from ..client_ip import ClientIp
+from ..headers import get_headers
+from ..spool import Spool, is_retryable_error
+from ..fake_collector import FakeCollector
+from ..circuit_breaker import CircuitBreaker, CircuitOpenError
+from ..overhead_budget import OverheadBudget
+from ..profile_queue import ProfileQueue
+from ..timings import Histogram, Timings, format_emf
+from moesifapi.configuration import Configuration
+from ..serializer import EventRecord, EventRequestRecord, EventResponseRecord, serialize_event
+from moesifapi.api_helper import APIHelper
+from .. import global_variable as gv
+from moesifapi.app_config.app_config import AppConfig
+import threading
+import asyncio
+import os
+import subprocess
+import time
+import sys
+import tempfile
+from datetime import datetime, timedelta
+import random
 
 moesif_options = {
     "LOG_BODY": True,
@@ -122,5 +158,1198 @@ class TestProcessBody(unittest.TestCase):
         self.assertEqual(res_body, "eyJmb28iOiAiYmFyIn0=")
         self.assertEqual(transfer_encoding, "base64")
 
+    def test_body_larger_than_max_body_size(self):
+        """
+        Tests that bodies larger than `MAX_BODY_SIZE` are truncated, with a
+        truncation marker, instead of being parsed.
+        """
+        moesif_middleware = MoesifLogger(dict(moesif_options, MAX_BODY_SIZE=16))(lambda_handler)
+
+        body = json.dumps({"items": list(range(100))})
+        res_body, transfer_encoding = moesif_middleware.process_body({"body": body})
+        self.assertEqual(transfer_encoding, "base64")
+        self.assertEqual(base64.b64decode(res_body).decode("utf-8"),
+                         body[:16] + "...[moesif: body truncated, original length " + str(len(body)) + "]")
+
+        encoded = base64.b64encode(b"0123456789" * 10).decode("utf-8")
+        res_body, transfer_encoding = moesif_middleware.process_body({"body": encoded, "isBase64Encoded": True})
+        self.assertEqual(transfer_encoding, "base64")
+        self.assertTrue(base64.b64decode(res_body).startswith(b"0123456789"))
+        self.assertIn(b"body truncated", base64.b64decode(res_body))
+
+    def test_body_not_parsed_as_json(self):
+        """
+        Tests that binary content types and bodies which don't start like JSON
+        are captured as base64 without being parsed.
+        """
+        moesif_middleware = MoesifLogger(moesif_options)(lambda_handler)
+        cases = [
+            {"body": '{"foo": "bar"}', "headers": {"content-type": "application/octet-stream"}},
+            {"body": "<html></html>", "headers": {"Content-Type": "text/html"}},
+        ]
+        for body_wrapper in cases:
+            res_body, transfer_encoding = moesif_middleware.process_body(body_wrapper)
+            self.assertEqual(transfer_encoding, "base64")
+            self.assertEqual(base64.b64decode(res_body).decode("utf-8"), body_wrapper["body"])
+
+def build_event_model(body=None):
+    return EventModel(
+        request=EventRequestModel(time="2024-01-01T00:00:00.000", uri="https://example.com/path", verb="GET",
+                                  headers={}, body=body),
+        response=EventResponseModel(time="2024-01-01T00:00:00.010", status=200, headers={}),
+        direction="Incoming",
+    )
+
+
+class TestEventQueue(unittest.TestCase):
+    def test_flush_when_batch_size_reached(self):
+        """
+        Tests that the queue is due for a flush once it holds `batch_size` events
+        and drains them in a single batch.
+        """
+        event_queue = EventQueue(batch_size=3, max_batch_bytes=10 ** 6, max_age_seconds=60)
+        for _ in range(2):
+            event_queue.add(build_event_model())
+        self.assertFalse(event_queue.should_flush())
+
+        event_queue.add(build_event_model())
+        self.assertTrue(event_queue.should_flush())
+
+        batches = event_queue.drain()
+        self.assertEqual([len(batch) for batch in batches], [3])
+        self.assertEqual(len(event_queue), 0)
+        self.assertFalse(event_queue.should_flush())
+
+    def test_drain_splits_batches_by_bytes(self):
+        """
+        Tests that the drained batches do not exceed `max_batch_bytes`.
+        """
+        event_queue = EventQueue(batch_size=100, max_batch_bytes=3000, max_age_seconds=60)
+        for _ in range(4):
+            event_queue.add(build_event_model(body={"data": "x" * 800}))
+        self.assertTrue(event_queue.should_flush())
+
+        batches = event_queue.drain()
+        self.assertEqual([len(batch) for batch in batches], [2, 2])
+        for batch in batches:
+            self.assertDictEqual(json.loads(batch[0])["request"]["body"], {"data": "x" * 800})
+
+    def test_flush_when_oldest_event_expired(self):
+        """
+        Tests that the queue is due for a flush once the oldest event is older
+        than `max_age_seconds`.
+        """
+        event_queue = EventQueue(batch_size=100, max_batch_bytes=10 ** 6, max_age_seconds=0)
+        event_queue.add(build_event_model())
+        self.assertTrue(event_queue.should_flush())
+
+
+class TestLambdaExtension(unittest.TestCase):
+    def test_flush_after_invocation_and_on_shutdown(self):
+        """
+        Tests that the extension flushes once the invocation finished, before
+        asking for the next event, and drains on SHUTDOWN.
+        """
+        flushes = []
+        with FakeExtensionsApi() as api:
+            extension = LambdaExtension(lambda: flushes.append(1), runtime_api=api.address,
+                                        events=["INVOKE", "SHUTDOWN"])
+            self.assertTrue(extension.start())
+            self.assertEqual(api.registrations[0]["events"], ["INVOKE", "SHUTDOWN"])
+            self.assertTrue(api.wait_for_next())
+
+            api.invoke()
+            extension.invocation_finished()
+            self.assertTrue(api.wait_for_next())
+            self.assertEqual(len(flushes), 1)
+
+            api.shutdown()
+            extension.thread.join(5)
+            self.assertFalse(extension.is_running)
+            self.assertEqual(len(flushes), 2)
+
+    def test_start_without_runtime_api(self):
+        """
+        Tests that the extension does not start outside of Lambda.
+        """
+        extension = LambdaExtension(lambda: None)
+        extension.runtime_api = None
+        self.assertFalse(extension.start())
+        self.assertFalse(extension.is_running)
+
+
+class TestEventSender(unittest.TestCase):
+    def build_stalled_sender(self, overflow_policy):
+        """Returns a sender whose first batch is stuck in flight until `release` is set."""
+        release = threading.Event()
+        sent = []
+
+        def send_batch(batch):
+            release.wait(5)
+            sent.extend(batch)
+            return True
+
+        sender = EventSender(send_batch, max_queue_size=2, overflow_policy=overflow_policy,
+                             block_timeout=0.01, batch_size=10).start()
+        sender.put("0")
+        # Wait until the first event is in flight, the queue is then empty
+        while sender.in_flight == 0:
+            threading.Event().wait(0.001)
+        return sender, release, sent
+
+    def test_drop_oldest(self):
+        sender, release, sent = self.build_stalled_sender("drop_oldest")
+        for payload in ["1", "2", "3"]:
+            self.assertTrue(sender.put(payload))
+        self.assertEqual(sender.dropped_oldest_count, 1)
+
+        release.set()
+        self.assertTrue(sender.flush(5))
+        self.assertEqual(sent, ["0", "2", "3"])
+        self.assertEqual(sender.sent_count, 3)
+
+    def test_drop_newest(self):
+        sender, release, sent = self.build_stalled_sender("drop_newest")
+        self.assertTrue(sender.put("1"))
+        self.assertTrue(sender.put("2"))
+        self.assertFalse(sender.put("3"))
+        self.assertEqual(sender.dropped_newest_count, 1)
+
+        release.set()
+        self.assertTrue(sender.flush(5))
+        self.assertEqual(sent, ["0", "1", "2"])
+
+    def test_block_times_out(self):
+        sender, release, sent = self.build_stalled_sender("block")
+        self.assertTrue(sender.put("1"))
+        self.assertTrue(sender.put("2"))
+        self.assertFalse(sender.put("3"))
+        self.assertEqual(sender.dropped_count, 1)
+        release.set()
+        self.assertTrue(sender.flush(5))
+
+    def test_unknown_policy_drops_oldest(self):
+        sender = EventSender(lambda batch: True, overflow_policy="drop_random")
+        self.assertEqual(sender.overflow_policy, "drop_oldest")
+
+    def test_failed_batches_are_counted(self):
+        sender = EventSender(lambda batch: False, batch_size=10).start()
+        sender.put("0")
+        self.assertTrue(sender.flush(5))
+        self.assertEqual(sender.failed_count, 1)
+
+
+class RecordingHttpClient:
+    def __init__(self):
+        self.batches = []
+
+    async def send_events_batch(self, payloads):
+        self.batches.append([json.loads(payload) for payload in payloads])
+        return {}
+
+
+class TestMoesifAsyncLogger(unittest.TestCase):
+    def test_async_handler(self):
+        """
+        Tests that an async handler is awaited, that its event is delivered
+        through the async HTTP client, and that the timings are emitted.
+        """
+        async def async_lambda_handler(event, context):
+            await asyncio.sleep(0)
+            return lambda_handler(event, context)
+
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        moesif_middleware = MoesifAsyncLogger(moesif_options)(async_lambda_handler)
+        http_client = RecordingHttpClient()
+        moesif_middleware.http_client = http_client
+        snapshots = []
+        timings = gv.timings
+        gv.timings = Timings(enabled=True, callback=snapshots.append, emf=False, interval_seconds=0)
+        try:
+            response = asyncio.run(moesif_middleware(event_payload, {}))
+        finally:
+            gv.timings = timings
+
+        self.assertDictEqual(response, lambda_handler(event_payload, {}))
+        self.assertEqual(snapshots[0]["after"]["count"], 1)
+        self.assertEqual(len(http_client.batches), 1)
+        sent_event = http_client.batches[0][0]
+        self.assertDictEqual(sent_event["request"]["body"], {"foo": "bar"})
+        self.assertDictEqual(sent_event["response"]["body"], {"msg": "Hello from Lambda!"})
+
+
+    def test_deferred_events_are_sent(self):
+        """
+        Tests that the events deferred by an earlier invocation are sent
+        along with the event of the next one.
+        """
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        moesif_middleware = MoesifAsyncLogger(moesif_options)(lambda event, context: asyncio.sleep(0, {}))
+        http_client = RecordingHttpClient()
+        moesif_middleware.http_client = http_client
+        gv.deferred_queue = EventQueue()
+        gv.deferred_queue.add_payload(b'{"weight":1}')
+        try:
+            asyncio.run(moesif_middleware(event_payload, {}))
+            self.assertEqual(len(gv.deferred_queue), 0)
+            self.assertEqual(len(http_client.batches), 1)
+            self.assertEqual(len(http_client.batches[0]), 2)
+        finally:
+            gv.deferred_queue = None
+
+
+class TestMoesifHttpClient(unittest.TestCase):
+    def test_configure_keeps_pool_unless_changed(self):
+        """
+        Tests that the connection pool survives `configure` unless the pool
+        size or retries changed.
+        """
+        http_client = MoesifHttpClient(pool_size=10)
+        session = http_client.session
+
+        http_client.configure(pool_size=10, connect_timeout=1, read_timeout=3)
+        self.assertIs(http_client.session, session)
+        self.assertEqual((http_client.connect_timeout, http_client.read_timeout), (1, 3))
+
+        http_client.configure(pool_size=4)
+        self.assertIsNot(http_client.session, session)
+        self.assertEqual(http_client.adapter._pool_maxsize, 4)
+        self.assertDictEqual(http_client.connection_stats(),
+                             {"requests": 0, "new_connections": 0, "reused_connections": 0})
+
+
+class BlockingAppConfig:
+    """Stand-in for AppConfig whose fetch blocks until `release` is set."""
+    def __init__(self):
+        self.release = threading.Event()
+        self.fetch_count = 0
+
+    def get_config(self, api_client, debug):
+        self.release.wait(5)
+        self.fetch_count += 1
+        return "config-" + str(self.fetch_count)
+
+
+class TestConfigCache(unittest.TestCase):
+    def test_serves_last_known_config_while_refreshing(self):
+        """
+        Tests that `get` never waits on a fetch, and returns the refreshed
+        config once the background fetch finished.
+        """
+        app_config = BlockingAppConfig()
+        updates = []
+        config_cache = ConfigCache(app_config, max_staleness_seconds=300, on_update=updates.append)
+
+        self.assertIsNone(config_cache.get(api_client=object()))
+        self.assertTrue(config_cache.is_refreshing())
+        # Serving the config while it is fetched doesn't queue another fetch
+        self.assertIsNone(config_cache.get(api_client=object()))
+
+        app_config.release.set()
+        config_cache.refresh_thread.join(5)
+        self.assertEqual(config_cache.get(api_client=object()), "config-1")
+        self.assertEqual(updates, ["config-1"])
+        self.assertEqual(app_config.fetch_count, 1)
+
+    def test_refresh_requested_while_fetching(self):
+        """
+        Tests that an etag change seen while the config is fetched is fetched
+        once the fetch is done, and that the etag is only saved once its
+        config is fetched.
+        """
+        app_config = BlockingAppConfig()
+        config_cache = ConfigCache(app_config)
+        config_cache.refresh(object(), response_etag="etag-1")
+        config_cache.refresh(object(), response_etag="etag-1")
+        config_cache.refresh(object(), response_etag="etag-2")
+        self.assertTrue(config_cache.is_outdated("etag-1"))
+
+        app_config.release.set()
+        config_cache.refresh_thread.join(5)
+        self.assertFalse(config_cache.is_refreshing())
+        self.assertEqual(app_config.fetch_count, 2)
+        self.assertEqual(config_cache.get(), "config-2")
+        self.assertFalse(config_cache.is_outdated("etag-2"))
+
+    def test_refresh_when_stale(self):
+        """
+        Tests that a stale config is still served while a refresh is started.
+        """
+        app_config = BlockingAppConfig()
+        app_config.release.set()
+        config_cache = ConfigCache(app_config, max_staleness_seconds=0)
+        config_cache.fetch(object())
+        app_config.release.clear()
+
+        self.assertEqual(config_cache.get(api_client=object()), "config-1")
+        app_config.release.set()
+        config_cache.refresh_thread.join(5)
+        self.assertEqual(config_cache.get(), "config-2")
+
+
+class TestSamplingRules(unittest.TestCase):
+    config_body = {
+        "sample_rate": 50,
+        "user_sample_rate": {"user-1": 10},
+        "company_sample_rate": {"company-1": 20},
+        "regex_config": [
+            {"sample_rate": 5, "conditions": [{"path": "request.verb", "value": "POST"},
+                                              {"path": "request.route", "value": "^/orders"}]},
+            {"sample_rate": 80, "conditions": [{"path": "response.status", "value": "5[0-9]{2}"}]},
+        ],
+    }
+
+    def build_event(self, verb, uri, status):
+        event_model = build_event_model()
+        event_model.request.verb = verb
+        event_model.request.uri = uri
+        event_model.response.status = status
+        return event_model
+
+    def test_same_sampling_percentage_as_app_config(self):
+        """
+        Tests that the precompiled rules return the same sampling percentage
+        as `AppConfig.get_sampling_percentage`.
+        """
+        sampling_rules = SamplingRules(self.config_body)
+        cases = [
+            (self.build_event("POST", "https://example.com/orders/1?x=1", 200), None, None, 5),
+            (self.build_event("GET", "https://example.com/orders/1", 503), "user-1", None, 80),
+            (self.build_event("GET", "https://example.com/orders/1", 200), "user-1", "company-1", 10),
+            (self.build_event("GET", "https://example.com/", 200), "user-2", "company-1", 20),
+            (self.build_event("GET", "https://example.com/", 200), None, None, 50),
+        ]
+        for event_model, user_id, company_id, expected in cases:
+            self.assertEqual(sampling_rules.get_sampling_percentage(event_model, user_id, company_id), expected)
+            self.assertEqual(AppConfig().get_sampling_percentage(event_model, self.config_body, user_id, company_id),
+                             expected)
+
+    def test_default_rules(self):
+        """
+        Tests that events are sampled at 100% without a config.
+        """
+        self.assertEqual(SamplingRules.from_config(None).get_sampling_percentage(build_event_model(), "a", "b"), 100)
+
+    def test_request_sampling_percentage(self):
+        """
+        Tests that the sampling percentage is decided from the request alone,
+        unless it depends on the response, the user or the company.
+        """
+        sampling_rules = SamplingRules(self.config_body)
+        self.assertEqual(sampling_rules.request_paths, {"request.verb", "request.route"})
+        mapping = SamplingRules.prepare_request_mapping("POST", "https://example.com/orders/1")
+        self.assertEqual(sampling_rules.get_request_sampling_percentage(mapping), 5)
+        # The second rule matches on the response status only
+        mapping = SamplingRules.prepare_request_mapping("GET", "https://example.com/orders/1")
+        self.assertIsNone(sampling_rules.get_request_sampling_percentage(mapping))
+        # No rule depends on the response, but a user could
+        sampling_rules = SamplingRules(dict(self.config_body, regex_config=self.config_body["regex_config"][:1]))
+        self.assertIsNone(sampling_rules.get_request_sampling_percentage(mapping))
+        sampling_rules = SamplingRules({"sample_rate": 30})
+        self.assertEqual(sampling_rules.get_request_sampling_percentage(mapping), 30)
+
+    def test_sampled_out_request_is_not_built(self):
+        """
+        Tests that an invocation sampled out from the request alone skips
+        building the event.
+        """
+        sampling_rules = gv.config_cache.sampling_rules
+        gv.config_cache.sampling_rules = SamplingRules({"sample_rate": 0})
+        try:
+            with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+                event_payload = json.load(event)
+            moesif_middleware = MoesifLogger(moesif_options)(lambda_handler)
+            moesif_middleware.process_body = None
+            moesif_middleware.send_event = None
+            response = moesif_middleware(event_payload, {})
+            self.assertDictEqual(response, lambda_handler(event_payload, {}))
+            self.assertIsNone(moesif_middleware.event_req)
+        finally:
+            gv.config_cache.sampling_rules = sampling_rules
+
+
+class TestSampler(unittest.TestCase):
+    def test_deterministic_sampling_and_rate_limit(self):
+        """
+        Tests that keyed sampling keeps or drops the same users on any
+        sampler at about the sampling percentage, and that the rate limit
+        has a token bucket per key.
+        """
+        users = ["user-%d" % index for index in range(2000)]
+        kept = [user for user in users if Sampler(key="user_id").is_sampled(30, user)]
+        self.assertEqual(kept, [user for user in users if Sampler(key="user_id").is_sampled(30, user)])
+        self.assertAlmostEqual(len(kept) / float(len(users)), 0.3, delta=0.05)
+
+        sampler = Sampler(rate_limit=0.001, rate_limit_burst=2, rate_limit_key="user_id")
+        self.assertEqual([sampler.allow("user-1") for _ in range(3)], [True, True, False])
+        self.assertTrue(sampler.allow("user-2"))
+        self.assertEqual(sampler.stats()["rate_limited_count"], 1)
+
+    def test_adaptive_rate_limit(self):
+        """
+        Tests that a spike above the ceiling lowers the share of the events
+        kept, that their weights make up for it, and that the rates are
+        published as gauges of the timings.
+        """
+        random.seed(1)
+        sampler = Sampler(max_events_per_second=10)
+        fractions = [sampler.admit(100) for _ in range(1000)]
+        kept = [fraction for fraction in fractions if fraction is not None]
+        self.assertTrue(10 <= len(kept) < 100)
+        self.assertAlmostEqual(sampler.adaptive_limiter.keep_fraction, 0.01)
+        self.assertEqual(sampler.get_weight(100, 0.01), 100)
+        self.assertEqual(sampler.get_weight(50), 2)
+        weights = sum(sampler.get_weight(100, fraction) for fraction in kept)
+        self.assertTrue(500 < weights < 2000)
+
+        snapshots = []
+        timings = Timings(enabled=True, callback=snapshots.append, emf=False)
+        timings.add_gauge("keep_fraction", lambda: sampler.stats()["keep_fraction"])
+        timings.emit()
+        self.assertEqual(snapshots, [{"gauges": {"keep_fraction": 0.01}}])
+
+    def test_tail_rule_keeps_errors(self):
+        """
+        Tests that with a sample rate of 0, the responses kept by the tail
+        rules are still captured and sent with a weight of 1.
+        """
+        sampling_rules = gv.config_cache.sampling_rules
+        sampler = gv.sampler
+        gv.config_cache.sampling_rules = SamplingRules({"sample_rate": 0})
+        gv.sampler = Sampler(keep_status=500)
+        try:
+            with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+                event_payload = json.load(event)
+            sent = []
+            for status in (200, 503):
+                handler = lambda event, context, status=status: dict(lambda_handler(event, context), statusCode=status)
+                moesif_middleware = MoesifLogger(moesif_options)(handler)
+                moesif_middleware.send_event = sent.append
+                moesif_middleware(event_payload, {})
+            self.assertEqual([(event_model.response.status, event_model.weight) for event_model in sent], [(503, 1)])
+            self.assertIsNotNone(sent[0].request.uri)
+        finally:
+            gv.config_cache.sampling_rules = sampling_rules
+            gv.sampler = sampler
+
+
+def sqs_event(count):
+    return {"Records": [{
+        "messageId": "message-%d" % index,
+        "body": json.dumps({"order": index}),
+        "attributes": {"ApproximateReceiveCount": "1", "SentTimestamp": "1545082649183"},
+        "eventSource": "aws:sqs",
+        "eventSourceARN": "arn:aws:sqs:us-east-2:123456789012:my-queue",
+    } for index in range(count)]}
+
+
+class TestBatchTriggers(unittest.TestCase):
+    def test_records_with_partial_failures(self):
+        """
+        Tests that an event is captured per SQS message, with the status of
+        the partial batch response, and that the JSON built from the shared
+        fragments matches the serialized event record.
+        """
+        sent = []
+        options = dict(moesif_options, BATCH_CAPTURE_MODE="records")
+        handler = lambda event, context: {"batchItemFailures": [{"itemIdentifier": "message-1"}]}
+        moesif_middleware = MoesifLogger(options)(handler)
+        moesif_middleware.send_payloads = sent.extend
+        response = moesif_middleware(sqs_event(3), {})
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "message-1"}]})
+
+        events = [json.loads(payload) for payload in sent]
+        self.assertEqual([event["response"]["status"] for event in events], [200, 500, 200])
+        self.assertEqual(events[0]["request"]["uri"], "https://sqs.us-east-2.amazonaws.com/123456789012/my-queue")
+        self.assertEqual(events[0]["request"]["time"], "2018-12-17T21:37:29.183")
+        self.assertEqual(json.loads(base64.b64decode(events[2]["request"]["body"])), {"order": 2})
+        self.assertEqual(events[1]["metadata"]["record_id"], "message-1")
+
+        batch = BatchTrigger("sqs", sqs_event(1))
+        fields = next(batch.iter_records())
+        metadata = {"batch_size": 1}
+        fast = json.loads(RecordSerializer("sqs", "2024-01-01T00:00:00.000", metadata).serialize(fields, 200, 2))
+        record = json.loads(serialize_event(build_event("sqs", fields, "2024-01-01T00:00:00.000", 200, 2, metadata)))
+        fast.pop("transaction_id")
+        record.pop("transaction_id")
+        self.assertEqual(fast, record)
+
+    def test_masked_records(self):
+        """
+        Tests that MASK_EVENT_MODEL may set attributes of the event records,
+        and that an event the function fails on is dropped instead of being
+        sent unmasked.
+        """
+        def mask_event_model(event_model):
+            if event_model.metadata["record_id"] == "message-1":
+                raise ValueError("failed")
+            event_model.request.body = None
+            event_model.masked = True
+            return event_model
+        sent = []
+        options = dict(moesif_options, BATCH_CAPTURE_MODE="records", MASK_EVENT_MODEL=mask_event_model)
+        moesif_middleware = MoesifLogger(options)(lambda event, context: None)
+        moesif_middleware.send_payloads = sent.extend
+        moesif_middleware(sqs_event(3), {})
+
+        events = [json.loads(payload) for payload in sent]
+        self.assertEqual([event["metadata"]["record_id"] for event in events], ["message-0", "message-2"])
+        self.assertTrue(all("body" not in event["request"] for event in events))
+
+    def test_summary_when_the_handler_raises(self):
+        """
+        Tests that in summary mode a Kinesis batch is captured as one event,
+        with every record failed when the handler raises, and that the
+        exception is raised again.
+        """
+        kinesis_event = {"Records": [{
+            "kinesis": {"partitionKey": "key", "sequenceNumber": str(index), "data": "eyJhIjoxfQ==",
+                        "approximateArrivalTimestamp": 1545084650.987},
+            "eventSource": "aws:kinesis",
+            "eventSourceARN": "arn:aws:kinesis:us-east-2:123456789012:stream/my-stream",
+        } for index in range(4)]}
+        self.assertEqual(get_batch_source(kinesis_event), "kinesis")
+        self.assertEqual(get_batch_source({"source": "app", "detail-type": "created", "detail": {}}), "eventbridge")
+        self.assertIsNone(get_batch_source({"httpMethod": "GET"}))
+
+        def handler(event, context):
+            raise ValueError("failed")
+        sent = []
+        moesif_middleware = MoesifLogger(dict(moesif_options, BATCH_CAPTURE_MODE="summary"))(handler)
+        moesif_middleware.send_event = sent.append
+        with self.assertRaises(ValueError):
+            moesif_middleware(kinesis_event, {})
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0].response.status, 500)
+        self.assertEqual(sent[0].request.uri, "https://kinesis.us-east-2.amazonaws.com/123456789012/stream/my-stream")
+        self.assertEqual((sent[0].metadata["record_count"], sent[0].metadata["failed_count"]), (4, 4))
+        self.assertEqual(sent[0].request.time, "2018-12-17T22:10:50.987")
+
+
+class TestCompressor(unittest.TestCase):
+    def test_codecs(self):
+        """
+        Tests that bodies are compressed with the configured codec, unless
+        they are smaller than the minimum size.
+        """
+        body = json.dumps([{"foo": "bar"}] * 100).encode("utf-8")
+
+        compressed, content_encoding = Compressor("gzip", level=1, min_size=100).compress(body)
+        self.assertEqual(content_encoding, "gzip")
+        self.assertEqual(gzip.decompress(compressed), body)
+
+        self.assertEqual(Compressor("gzip", min_size=len(body) + 1).compress(body), (body, None))
+        self.assertEqual(Compressor("none").compress(body), (body, None))
+        # An unknown codec falls back to gzip rather than failing the middleware
+        self.assertEqual(Compressor("brotli").codec, "gzip")
+
+
+class TestSerializer(unittest.TestCase):
+    def test_same_event_as_api_helper(self):
+        """
+        Tests that events are serialized to the same JSON as with
+        `APIHelper.json_serialize`, leaving out the fields which are not set,
+        from records as well as from moesifapi models.
+        """
+        def without_none(value):
+            if isinstance(value, dict):
+                return dict((k, without_none(v)) for k, v in value.items() if v is not None)
+            return value
+
+        event_model = build_event_model({"foo": ["bar", 1, None]})
+        event_model.user_id = "user-1"
+        event_model.weight = 4
+        request, response = event_model.request, event_model.response
+        record = EventRecord(
+            request=EventRequestRecord(time=request.time, uri=request.uri, verb=request.verb,
+                                       headers=request.headers, body=request.body),
+            response=EventResponseRecord(time=response.time, status=response.status, headers=response.headers),
+            direction="Incoming", user_id="user-1", weight=4, transaction_id=event_model.transaction_id)
+
+        for event in (event_model, record):
+            self.assertEqual(json.loads(serialize_event(event)),
+                             without_none(json.loads(APIHelper.json_serialize(event))))
+        self.assertEqual(json.loads(serialize_event(record)), json.loads(serialize_event(event_model)))
+
+
+class TestClientIp(unittest.TestCase):
+    def test_get_client_address(self):
+        """
+        Tests that the client ip address is resolved from the headers whatever
+        their case, including IPv6 addresses, falling back to the next header
+        and then to the source ip.
+        """
+        client_ip = ClientIp()
+        cases = [
+            ({"X-Forwarded-For": "unknown, 203.0.113.7:8080, 10.0.0.1"}, "203.0.113.7"),
+            ({"x-forwarded-for": "2001:db8::7, 10.0.0.1"}, "2001:db8::7"),
+            ({"x-forwarded-for": "unknown", "x-real-ip": "198.51.100.2"}, "198.51.100.2"),
+            ({"TRUE-CLIENT-IP": "not an ip", "Forwarded-For": "198.51.100.3"}, "198.51.100.3"),
+            ({"x-client-ip": "256.1.1.1"}, "192.0.2.1"),
+            ({}, "192.0.2.1"),
+            (None, "192.0.2.1"),
+        ]
+        for headers, expected in cases:
+            self.assertEqual(client_ip.get_client_address(headers, "192.0.2.1"), expected)
+        self.assertFalse(client_ip.is_ip(b"192.0.2.1"))
+
+
+class TestHeaders(unittest.TestCase):
+    def test_header_index(self):
+        """
+        Tests that the headers are looked up whatever their case, and that
+        the index is built once per event.
+        """
+        event = {"headers": {"X-Forwarded-Proto": "https", "host": "example.com"}, "rawPath": "/items",
+                 "rawQueryString": "a=1"}
+        request_headers = get_headers(event)
+        self.assertEqual(request_headers.get("x-forwarded-proto"), "https")
+        self.assertEqual(request_headers["HOST"], "example.com")
+        self.assertNotIn("authorization", request_headers)
+        self.assertIs(get_headers(event), request_headers)
+        self.assertEqual(get_headers({"headers": '{"Host": "example.org"}'}).get("host"), "example.org")
+        self.assertEqual(len(get_headers({"headers": None})), 0)
+
+        moesif_middleware = MoesifLogger(moesif_options)(lambda_handler)
+        self.assertEqual(moesif_middleware.build_uri(event, False), "https://example.com/items?a=1")
+
+
+class CollectorTestCase(unittest.TestCase):
+    """Tests which send to a FakeCollector, the BASE_URI and the circuit breaker they change are restored"""
+
+    def setUp(self):
+        self.base_uri = Configuration.BASE_URI
+        self.circuit_breaker = gv.http_client.circuit_breaker
+        # The failures served by the collector must not open the circuit for the other tests
+        gv.http_client.circuit_breaker = None
+
+    def tearDown(self):
+        Configuration.BASE_URI = self.base_uri
+        gv.http_client.circuit_breaker = self.circuit_breaker
+
+
+class TestSpool(CollectorTestCase):
+    def test_append_evict_discard(self):
+        """
+        Tests that batches are spooled in order, that the oldest ones are
+        evicted over the size cap, and that an incomplete record is dropped.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "events.spool")
+            spool = Spool(path, max_bytes=40)
+            for body in (b"[1]" * 3, b"[2]" * 3, b"[3]" * 3):
+                self.assertTrue(spool.append(body))
+            # Each record is 4 bytes of length and 9 bytes of body
+            self.assertEqual(spool.peek(), [b"[1]" * 3, b"[2]" * 3, b"[3]" * 3])
+            spool.append(b"[4]" * 3)
+            self.assertEqual(spool.peek(), [b"[2]" * 3, b"[3]" * 3, b"[4]" * 3])
+            self.assertEqual(spool.evicted_count, 1)
+            self.assertFalse(spool.append(b"x" * 40))
+
+            # A batch evicted between peeking and discarding is not replaced by a newer one
+            sent = spool.peek(2)
+            spool.append(b"[5]" * 3)
+            spool.discard(sent)
+            self.assertEqual(spool.peek(), [b"[4]" * 3, b"[5]" * 3])
+            with open(path, "ab") as f:
+                f.write(b"\x00\x00\x00\x09[6]")
+            self.assertEqual(spool.peek(), [b"[4]" * 3, b"[5]" * 3])
+            spool.discard(spool.peek())
+            self.assertTrue(spool.is_empty())
+
+            # An incomplete record left by a crash is dropped before the next batch is appended after it
+            with open(path, "ab") as f:
+                f.write(b"\x00\x00\x00\x09[6]")
+            spool = Spool(path, max_bytes=40)
+            spool.append(b"[7]" * 3)
+            spool.append(b"[8]" * 3)
+            self.assertEqual(spool.peek(), [b"[7]" * 3, b"[8]" * 3])
+            spool.discard(spool.peek())
+            self.assertTrue(spool.is_empty())
+
+    def test_backoff(self):
+        """
+        Tests that the retry backoff doubles after each failure, with jitter,
+        up to the maximum, and resets on success.
+        """
+        spool = Spool(backoff_seconds=1, max_backoff_seconds=4)
+        self.assertTrue(spool.is_retry_due())
+        for attempt, backoff in enumerate([1, 2, 4, 4]):
+            spool.retry_failed()
+            delay = spool.next_retry_time - time.time()
+            self.assertTrue(backoff / 2.0 - 0.1 <= delay <= backoff, (attempt, delay))
+        self.assertFalse(spool.is_retry_due())
+        spool.retry_succeeded()
+        self.assertTrue(spool.is_retry_due())
+
+    def test_spooled_events_are_resent(self):
+        """
+        Tests that an event which failed to be delivered to the collector is
+        spooled, and resent once the collector recovers.
+        """
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        with FakeCollector() as collector, tempfile.TemporaryDirectory() as directory:
+            Configuration.BASE_URI = collector.base_uri
+            try:
+                options = dict(moesif_options, ENABLE_SPOOL=True, SPOOL_PATH=os.path.join(directory, "events.spool"))
+                moesif_middleware = MoesifLogger(options)(lambda_handler)
+                collector.fail(count=10, status=503)
+                moesif_middleware(event_payload, {})
+                self.assertEqual(collector.events, [])
+                self.assertEqual(len(gv.spool.peek()), 1)
+
+                collector.fail(count=0)
+                gv.spool.next_retry_time = 0
+                moesif_middleware(event_payload, {})
+                self.assertEqual(len(collector.events), 2)
+                self.assertTrue(gv.spool.is_empty())
+            finally:
+                gv.spool = None
+
+
+class TestCircuitBreaker(CollectorTestCase):
+    def test_open_half_open_close(self):
+        """
+        Tests that the circuit opens after consecutive failures or slow calls,
+        rejects calls while open, and closes after a successful probe.
+        """
+        circuit_breaker = CircuitBreaker(failure_threshold=3, slow_call_seconds=1, reset_seconds=0.05)
+        circuit_breaker.record_result(503, 0.1)
+        circuit_breaker.record_failure()
+        circuit_breaker.record_success()
+        self.assertEqual(circuit_breaker.state, "closed")
+
+        circuit_breaker.record_result(200, 2)
+        circuit_breaker.record_result(429, 0.1)
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, "open")
+        self.assertFalse(circuit_breaker.allow_request())
+
+        time.sleep(0.06)
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.state, "half_open")
+        # Only one probe at a time
+        self.assertFalse(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, "open")
+
+        time.sleep(0.06)
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_result(201, 0.1)
+        self.assertEqual(circuit_breaker.state, "closed")
+        self.assertEqual(circuit_breaker.stats()["opened_count"], 2)
+        self.assertEqual(circuit_breaker.stats()["rejected_count"], 2)
+
+    def test_http_client_sheds_calls_while_open(self):
+        """
+        Tests that calls through the HTTP client are not sent while the
+        circuit is open.
+        """
+        http_client = MoesifHttpClient(max_retries=0)
+        http_client.configure_circuit_breaker(failure_threshold=2, reset_seconds=60)
+        with FakeCollector() as collector:
+            collector.fail(count=3, status=500)
+            request = http_client.get(collector.base_uri + "/v1/config")
+            for _ in range(2):
+                # Raised by the retry strategy, once the retries are exhausted
+                with self.assertRaises(Exception) as raised:
+                    http_client.execute_as_string(request)
+                self.assertNotIsInstance(raised.exception, CircuitOpenError)
+            self.assertRaises(CircuitOpenError, http_client.execute_as_string, request)
+            # The third failure was never served
+            self.assertEqual(collector.failures, [500])
+            self.assertEqual(http_client.circuit_breaker.stats()["rejected_count"], 1)
+
+
+    def test_profile_updates_are_not_raised_while_open(self):
+        """
+        Tests that the profile updates which are shed while the circuit is
+        open are dropped, rather than raised to the handler.
+        """
+        gv.http_client.circuit_breaker = CircuitBreaker(failure_threshold=1, reset_seconds=60)
+        gv.http_client.circuit_breaker.record_failure()
+        update_user({"user_id": "user-1"}, moesif_options)
+        update_companies_batch([{"company_id": "company-1"}], moesif_options)
+        self.assertEqual(gv.http_client.circuit_breaker.stats()["rejected_count"], 2)
+
+
+class TestOverheadBudget(CollectorTestCase):
+    def test_deadline(self):
+        """
+        Tests that the deadline is the lower of the overhead left and the
+        fraction of the remaining time, and that the overhead is spent across
+        both phases.
+        """
+        class Context:
+            remaining_time_ms = 1000
+
+            def get_remaining_time_in_millis(self):
+                return self.remaining_time_ms
+
+        context = Context()
+        budget = OverheadBudget(max_overhead_ms=300, remaining_time_fraction=0.5)
+        budget.start_invocation()
+        budget.start_phase(context)
+        self.assertAlmostEqual(budget.remaining_seconds(), 0.3, delta=0.01)
+        budget.spent_seconds = 0.25
+        context.remaining_time_ms = 1000
+        budget.start_phase(context)
+        self.assertAlmostEqual(budget.remaining_seconds(), 0.05, delta=0.01)
+        context.remaining_time_ms = 40
+        budget.start_phase(context)
+        self.assertAlmostEqual(budget.remaining_seconds(), 0.02, delta=0.01)
+        time.sleep(0.03)
+        self.assertFalse(budget.allow_step("the response body"))
+        self.assertEqual(budget.stats()["exceeded_count"], 1)
+        self.assertEqual(budget.stats()["skipped_count"], 1)
+
+        # Without the remaining time, only the overhead bounds the next invocation
+        budget.start_invocation()
+        budget.start_phase({})
+        self.assertAlmostEqual(budget.remaining_seconds(), 0.3, delta=0.01)
+        self.assertTrue(budget.allow_step("the response body"))
+        self.assertIsNone(OverheadBudget(remaining_time_fraction=0.5).remaining_seconds())
+
+    def test_optional_steps_skipped_and_delivery_deferred(self):
+        """
+        Tests that once the budget is exceeded the identify functions are
+        skipped but the event is still masked, and that the deferred event is
+        sent along with the event of the next invocation.
+        """
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        calls = []
+
+        def identify_user(event, context):
+            calls.append("IDENTIFY_USER")
+            return "user"
+
+        def mask_event_model(event_model):
+            calls.append("MASK_EVENT_MODEL")
+            return event_model
+
+        overhead_budget = gv.overhead_budget
+        with FakeCollector() as collector:
+            Configuration.BASE_URI = collector.base_uri
+            try:
+                options = dict(moesif_options, IDENTIFY_USER=identify_user, MASK_EVENT_MODEL=mask_event_model)
+                moesif_middleware = MoesifLogger(options)(lambda_handler)
+                gv.overhead_budget = OverheadBudget(max_overhead_ms=0)
+                moesif_middleware(event_payload, {})
+                self.assertEqual(calls, ["MASK_EVENT_MODEL"])
+                self.assertEqual(len(gv.deferred_queue), 1)
+                self.assertEqual(gv.overhead_budget.stats()["deferred_count"], 1)
+
+                gv.overhead_budget = OverheadBudget()
+                moesif_middleware(event_payload, {})
+                self.assertEqual(calls, ["MASK_EVENT_MODEL", "IDENTIFY_USER", "MASK_EVENT_MODEL"])
+                self.assertEqual(len(collector.events), 2)
+                self.assertEqual(collector.requests[-1][1], "/v1/events/batch")
+                self.assertNotIn("user_id", collector.events[0])
+                self.assertEqual(collector.events[1]["user_id"], "user")
+            finally:
+                gv.overhead_budget = overhead_budget
+                gv.deferred_queue = None
+
+
+    def test_send_timed_out_on_the_deadline_is_deferred(self):
+        """
+        Tests that an event whose request timed out on the deadline of the
+        budget is deferred rather than dropped, without counting as a failure
+        of the circuit breaker, and that it is sent once there is time.
+        """
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        overhead_budget = gv.overhead_budget
+        with FakeCollector(latency=0.2) as collector:
+            Configuration.BASE_URI = collector.base_uri
+            gv.http_client.circuit_breaker = CircuitBreaker(failure_threshold=2)
+            try:
+                moesif_middleware = MoesifLogger(moesif_options)(lambda_handler)
+                gv.overhead_budget = OverheadBudget(max_overhead_ms=60)
+                for _ in range(3):
+                    moesif_middleware(event_payload, {})
+                self.assertEqual(len(gv.deferred_queue), 3)
+                self.assertEqual(gv.http_client.circuit_breaker.stats()["state"], "closed")
+                self.assertEqual(gv.http_client.circuit_breaker.stats()["consecutive_failures"], 0)
+
+                # Too little of the budget is left to try sending it
+                gv.overhead_budget = OverheadBudget(max_overhead_ms=60, min_send_ms=1000)
+                moesif_middleware(event_payload, {})
+                self.assertEqual(len(gv.deferred_queue), 4)
+
+                collector.latency = 0
+                gv.overhead_budget = OverheadBudget()
+                moesif_middleware(event_payload, {})
+                self.assertEqual(len(gv.deferred_queue), 0)
+                self.assertEqual(collector.requests[-1][1], "/v1/events/batch")
+                self.assertEqual(collector.requests[-1][3], 5)
+            finally:
+                gv.overhead_budget = overhead_budget
+                gv.deferred_queue = None
+
+
+class TestTimings(CollectorTestCase):
+    def test_histogram(self):
+        """
+        Tests that the percentiles are estimated by the upper bound of their
+        bucket, capped by the maximum.
+        """
+        histogram = Histogram()
+        for elapsed_ns in [15000] * 90 + [3000000] * 9 + [7000000]:
+            histogram.record(elapsed_ns)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50_ms"], 0.025)
+        self.assertEqual(summary["p90_ms"], 0.025)
+        self.assertEqual(summary["p99_ms"], 5)
+        self.assertEqual(summary["max_ms"], 7)
+        self.assertEqual(summary["min_ms"], 0.015)
+
+    def test_emf(self):
+        """
+        Tests that each phase is formatted as an Embedded Metric Format line
+        with the phase as a dimension.
+        """
+        timings = Timings(enabled=True)
+        timings.record("send", 2000000)
+        line = json.loads(format_emf("Moesif/Middleware", timings.snapshot(), timestamp_ms=1)[0])
+        self.assertEqual(line["_aws"]["CloudWatchMetrics"][0]["Namespace"], "Moesif/Middleware")
+        self.assertEqual(line["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["FunctionName", "Phase"]])
+        self.assertEqual(line["Phase"], "send")
+        self.assertEqual(line["Count"], 1)
+        self.assertEqual(line["P99"], 2)
+
+    def test_middleware_phases(self):
+        """
+        Tests that the phases of an invocation are recorded and passed to the
+        callback once the interval elapsed.
+        """
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        snapshots = []
+        timings = gv.timings
+        with FakeCollector() as collector:
+            Configuration.BASE_URI = collector.base_uri
+            try:
+                moesif_middleware = MoesifLogger(moesif_options)(lambda_handler)
+                gv.timings = Timings(enabled=True, callback=snapshots.append, emf=False, interval_seconds=0)
+                moesif_middleware(event_payload, {})
+                self.assertEqual(len(snapshots), 1)
+                for phase in ("before", "headers", "request_body", "identify_user", "response_body",
+                              "mask_event_model", "serialization", "send", "after"):
+                    self.assertEqual(snapshots[0][phase]["count"], 1, phase)
+                # Recorded both before and after the handler
+                self.assertEqual(snapshots[0]["sampling"]["count"], 2)
+                self.assertEqual(snapshots[0]["model"]["count"], 2)
+                self.assertEqual(gv.timings.snapshot(), {})
+            finally:
+                gv.timings = timings
+
+
+class TestFakeCollector(CollectorTestCase):
+    def test_profiles_config_and_base_uri(self):
+        """
+        Tests that the BASE_URI option points the middleware at the
+        collector, which refetches the config, and that the collector records
+        users and companies and changes the config etag with the config.
+        """
+        with FakeCollector(config={"sample_rate": 100}) as collector:
+            # A refresh which is running would be kept
+            if gv.config_cache.refresh_thread is not None:
+                gv.config_cache.refresh_thread.join(5)
+            options = dict(moesif_options, BASE_URI=collector.base_uri)
+            MoesifLogger(options)
+            self.assertEqual(Configuration.BASE_URI, collector.base_uri)
+            gv.config_cache.refresh_thread.join(5)
+            self.assertIn(("GET", "/v1/config", None, 0), collector.requests)
+
+            update_user({"user_id": "user-1"}, options)
+            update_company({"company_id": "company-1"}, options)
+            self.assertEqual(collector.users[0]["user_id"], "user-1")
+            self.assertEqual(collector.companies[0]["company_id"], "company-1")
+
+            etag = collector.config_etag
+            collector.set_config({"sample_rate": 50})
+            self.assertNotEqual(collector.config_etag, etag)
+            self.assertEqual(gv.api_client.get_app_config().headers["X-Moesif-Config-ETag"],
+                             collector.config_etag)
+
+    def test_config_checked_only_when_due(self):
+        """
+        Tests that a batch sent before the config check is due leaves the
+        time of the last check, so that the checks are not postponed.
+        """
+        with FakeCollector() as collector:
+            Configuration.BASE_URI = collector.base_uri
+            last_updated_time = gv.last_updated_time
+            gv.last_updated_time = datetime.utcnow() - timedelta(seconds=60)
+            try:
+                checked_time = gv.last_updated_time
+                moesif_middleware = MoesifLogger(moesif_options)(lambda_handler)
+                self.assertTrue(moesif_middleware.send_batch([json.dumps({"request": {}})]))
+                self.assertEqual(gv.last_updated_time, checked_time)
+
+                gv.last_updated_time = datetime.utcnow() - timedelta(seconds=gv.refresh_config_time_seconds + 1)
+                self.assertTrue(moesif_middleware.send_batch([json.dumps({"request": {}})]))
+                self.assertGreater(gv.last_updated_time, checked_time)
+            finally:
+                gv.last_updated_time = last_updated_time
+
+    def test_base_uri_set_while_the_config_is_fetched(self):
+        """
+        Tests that when the decorator sets the BASE_URI while the config is
+        still fetched from the previous API, such as the fetch started on
+        import, the config is fetched again from the collector and applied.
+        """
+        with open("moesif_aws_lambda/tests/event_body_json.json") as event:
+            event_payload = json.load(event)
+        config_cache, config = gv.config_cache, gv.config
+        gv.config_cache = ConfigCache(gv.app_config, on_update=gv.set_config)
+        try:
+            with FakeCollector(latency=0.2) as previous_api, FakeCollector(config={"sample_rate": 0}) as collector:
+                Configuration.BASE_URI = previous_api.base_uri
+                gv.config_cache.refresh(gv.api_client)
+                moesif_middleware = MoesifLogger(dict(moesif_options, BASE_URI=collector.base_uri))(lambda_handler)
+                gv.config_cache.refresh_thread.join(5)
+                self.assertEqual([request[1] for request in collector.requests], ["/v1/config"])
+
+                for _ in range(3):
+                    moesif_middleware(event_payload, {})
+                self.assertEqual(collector.events, [])
+        finally:
+            gv.config_cache, gv.config = config_cache, config
+
+
+class TestProfileQueue(CollectorTestCase):
+    def test_coalesce_and_deduplicate(self):
+        """
+        Tests that the updates of the same user are merged, metadata key by
+        key, and that a profile unchanged since it was sent is not sent again.
+        """
+        queue = ProfileQueue("user_id", "/v1/users/batch", batch_size=2, window_seconds=60)
+        queue.add({"user_id": "user-1", "metadata": {"plan": "free"}})
+        queue.add({"user_id": "user-1", "metadata": {"email": "a@example.com"}})
+        queue.add({"user_id": "user-2"})
+        self.assertFalse(queue.add({"metadata": {}}))
+        self.assertTrue(queue.should_flush())
+        batches = queue.drain()
+        self.assertEqual(batches, [[{"user_id": "user-1", "metadata": {"plan": "free", "email": "a@example.com"}},
+                                    {"user_id": "user-2"}]])
+        queue.mark_sent(batches[0])
+
+        queue.add({"user_id": "user-2", "modified_time": "2024-01-01T00:00:00"})
+        queue.add({"user_id": "user-3"})
+        self.assertEqual(queue.drain(), [[{"user_id": "user-3"}]])
+        self.assertEqual(queue.stats(), {"pending_count": 0, "coalesced_count": 1, "deduplicated_count": 1,
+                                         "sent_count": 2})
+
+    def test_batched_updates(self):
+        """
+        Tests that with BATCH_PROFILE_UPDATES, the updates are buffered and
+        sent to the collector in one batch request.
+        """
+        profile_queues = gv.profile_queues
+        gv.profile_queues = {}
+        with FakeCollector() as collector:
+            Configuration.BASE_URI = collector.base_uri
+            try:
+                options = dict(moesif_options, BATCH_PROFILE_UPDATES=True)
+                update_user({"user_id": "user-1", "metadata": {"plan": "free"}}, options)
+                update_users_batch([{"user_id": "user-2"}, {"user_id": "user-1", "metadata": {"seats": 2}}], options)
+                # Can't be serialized, so it is skipped rather than failing the batch
+                update_user({"user_id": "user-3", "metadata": {"signed_up": datetime.now()}}, options)
+                self.assertEqual(collector.requests, [])
+                self.assertEqual(len(gv.profile_queues["user_id"]), 2)
+
+                flush_profile_updates()
+                self.assertEqual([request[1] for request in collector.requests], ["/v1/users/batch"])
+                self.assertEqual(collector.users, [{"user_id": "user-1", "metadata": {"plan": "free", "seats": 2}},
+                                                   {"user_id": "user-2"}])
+                self.assertEqual(len(gv.profile_queues["user_id"]), 0)
+                self.assertFalse(is_retryable_error(TypeError("Object of type datetime is not JSON serializable")))
+                self.assertTrue(is_retryable_error(ConnectionError("Connection refused")))
+            finally:
+                gv.profile_queues = profile_queues
+
+    def test_updates_sent_in_full_after_the_response(self):
+        """
+        Tests that the flush run by the Lambda extension after the response
+        sends the buffered updates which are not due yet, as the extension is
+        not notified of the shutdown of the execution environment.
+        """
+        profile_queues = gv.profile_queues
+        gv.profile_queues = {}
+        with FakeCollector() as collector:
+            Configuration.BASE_URI = collector.base_uri
+            try:
+                options = dict(moesif_options, BATCH_PROFILE_UPDATES=True)
+                moesif_middleware = MoesifLogger(options)(lambda_handler)
+                update_user({"user_id": "user-1"}, options)
+                moesif_middleware.flush_events()
+                self.assertEqual(collector.users, [])
+                moesif_middleware.flush_after_response()
+                self.assertEqual(collector.users, [{"user_id": "user-1"}])
+            finally:
+                gv.profile_queues = profile_queues
+
+
+class TestBulkUpload(CollectorTestCase):
+    def test_chunked_upload(self):
+        """
+        Tests that a JSON Lines file of users is uploaded in chunks of
+        BULK_CHUNK_SIZE, that the profiles without an id are reported, and
+        that a failed chunk keeps its profiles for another upload.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "users.jsonl")
+        with open(path, "w") as f:
+            for index in range(25):
+                f.write(json.dumps({"user_id": "user-%d" % index}) + "\n")
+            f.write(json.dumps({"metadata": {}}) + "\n")
+            f.write("not json\n")
+
+        with FakeCollector() as collector:
+            Configuration.BASE_URI = collector.base_uri
+            options = dict(moesif_options, BULK_CHUNK_SIZE=10, BULK_MAX_WORKERS=2)
+            result = bulk_update_users(path, options)
+            self.assertEqual([chunk.count for chunk in result.chunks], [10, 10, 5])
+            self.assertEqual(result.sent_count, 25)
+            self.assertEqual([index for index, _ in result.invalid], [25, 26])
+            self.assertEqual(sorted(user["user_id"] for user in collector.users),
+                             sorted("user-%d" % index for index in range(25)))
+
+            collector.fail(1, 500)
+            profiles = [{"user_id": "user-0"}, {"user_id": "user-1", "metadata": {"signed_up": datetime.now()}},
+                        {"user_id": "user-2"}, {"user_id": "user-3"}]
+            result = bulk_update_users(iter(profiles), options)
+            self.assertEqual([index for index, _ in result.invalid], [1])
+            self.assertFalse(result.succeeded)
+            self.assertEqual(result.failed_chunks[0].status_code, 500)
+            self.assertEqual(len(result.failed_chunks[0].profiles), 3)
+
+
+class TestLazyInit(unittest.TestCase):
+    def test_import_without_initializing(self):
+        """
+        Tests that with MOESIF_LAZY_INIT, importing the middleware and
+        decorating a handler neither constructs the client nor requires the
+        application id, and that boto3 is not imported.
+        """
+        env = dict(os.environ, MOESIF_LAZY_INIT="true")
+        env.pop("MOESIF_APPLICATION_ID", None)
+        script = (
+            "import sys\n"
+            "from moesif_aws_lambda.middleware import MoesifLogger\n"
+            "from moesif_aws_lambda import global_variable as gv\n"
+            "MoesifLogger({})(lambda event, context: None)\n"
+            "print(gv.api_client is None, 'boto3' in sys.modules)\n"
+        )
+        output = subprocess.check_output([sys.executable, "-c", script], env=env, universal_newlines=True)
+        self.assertEqual(output.strip().splitlines()[-1], "True False")
+
+
 if __name__ == "__main__":
     unittest.main()
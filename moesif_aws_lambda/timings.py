@@ -0,0 +1,185 @@
+from bisect import bisect_left
+import json
+import os
+import threading
+import time
+
+try:
+    from time import perf_counter_ns
+except ImportError:
+    def perf_counter_ns():
+        return int(time.perf_counter() * 1000000000)
+
+# Upper bounds of the histogram buckets in nanoseconds, from 10 microseconds to 10 seconds
+BUCKET_BOUNDS_NS = tuple(int(base * 10 ** exponent) for exponent in range(4, 10) for base in (1, 2.5, 5)) + (10 ** 10,)
+
+# Statistics of the phases published as metrics, with their names in the summaries
+EMF_METRICS = (('P50', 'p50_ms'), ('P90', 'p90_ms'), ('P99', 'p99_ms'), ('Max', 'max_ms'), ('Mean', 'mean_ms'))
+
+
+class Histogram:
+    """Counts of durations in log-scale buckets, so that recording is constant time and memory"""
+    __slots__ = ('counts', 'count', 'total_ns', 'min_ns', 'max_ns')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def record(self, elapsed_ns):
+        self.counts[bisect_left(BUCKET_BOUNDS_NS, elapsed_ns)] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if self.min_ns is None or elapsed_ns < self.min_ns:
+            self.min_ns = elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def percentile(self, quantile):
+        """Function to estimate a percentile, as the upper bound of its bucket capped by the maximum"""
+        rank = quantile * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                if index < len(BUCKET_BOUNDS_NS):
+                    return min(BUCKET_BOUNDS_NS[index], self.max_ns)
+                return self.max_ns
+        return self.max_ns
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum_ms': self.total_ns / 1000000.0,
+            'min_ms': (self.min_ns or 0) / 1000000.0,
+            'max_ms': self.max_ns / 1000000.0,
+            'mean_ms': self.total_ns / 1000000.0 / self.count if self.count else 0,
+            'p50_ms': self.percentile(0.5) / 1000000.0,
+            'p90_ms': self.percentile(0.9) / 1000000.0,
+            'p99_ms': self.percentile(0.99) / 1000000.0,
+        }
+
+
+def format_emf(namespace, snapshot, timestamp_ms=None):
+    """Function to format the summaries of the phases as CloudWatch Embedded Metric Format log lines, one per phase"""
+    timestamp_ms = timestamp_ms if timestamp_ms is not None else int(time.time() * 1000)
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'unknown')
+    metrics = [{'Name': 'Count', 'Unit': 'Count'}] + \
+              [{'Name': name, 'Unit': 'Milliseconds'} for name, _ in EMF_METRICS]
+    lines = []
+    for phase, summary in sorted(snapshot.items()):
+        record = {
+            '_aws': {
+                'Timestamp': timestamp_ms,
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['FunctionName', 'Phase']],
+                    'Metrics': metrics,
+                }],
+            },
+            'FunctionName': function_name,
+            'Phase': phase,
+            'Count': summary['count'],
+        }
+        for name, key in EMF_METRICS:
+            record[name] = round(summary[key], 3)
+        lines.append(json.dumps(record, separators=(',', ':')))
+    return lines
+
+
+def format_emf_gauges(namespace, gauges, timestamp_ms=None):
+    """Function to format the current values of the gauges as a CloudWatch Embedded Metric Format log line"""
+    timestamp_ms = timestamp_ms if timestamp_ms is not None else int(time.time() * 1000)
+    record = {
+        '_aws': {
+            'Timestamp': timestamp_ms,
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': name, 'Unit': 'None'} for name in sorted(gauges)],
+            }],
+        },
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'unknown'),
+    }
+    record.update(gauges)
+    return json.dumps(record, separators=(',', ':'))
+
+
+class Timings:
+    """Histograms of the time spent in each phase of the middleware, such as the hooks or the send.
+
+    Recording costs a bucket lookup, so it may stay on in production. Every `interval_seconds`, the
+    summaries of the phases are passed to `callback` and printed as CloudWatch Embedded Metric
+    Format lines when `emf` is set, then the histograms start over. The current values of the
+    gauges registered with `add_gauge` are published along, under the `gauges` key of the summaries.
+    """
+
+    def __init__(self, enabled=False, callback=None, emf=True, interval_seconds=60, namespace='Moesif/Middleware'):
+        self.enabled = enabled
+        self.callback = callback
+        self.emf = emf
+        self.interval_seconds = interval_seconds
+        self.namespace = namespace
+        self.histograms = {}
+        self.gauges = {}
+        self.last_emit_time = time.time()
+        # Phases may be recorded from the extension thread
+        self.lock = threading.Lock()
+
+    def record(self, phase, elapsed_ns):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.record(elapsed_ns)
+
+    def add_gauge(self, name, function):
+        """Function to register a gauge, `function` returns its current value or None when it has none"""
+        self.gauges[name] = function
+
+    def get_gauges(self):
+        """Function to get the current values of the gauges, by name"""
+        values = {}
+        for name, function in self.gauges.items():
+            try:
+                value = function()
+            except Exception as ex:
+                print('[moesif] Error while reading the gauge ' + name, ex)
+                continue
+            if value is not None:
+                values[name] = value
+        return values
+
+    def snapshot(self, reset=False):
+        """Function to get the summaries of the recorded phases, by phase"""
+        with self.lock:
+            histograms = self.histograms
+            if reset:
+                self.histograms = {}
+        return {phase: histogram.summary() for phase, histogram in histograms.items()}
+
+    def emit_if_due(self):
+        if self.enabled and time.time() - self.last_emit_time >= self.interval_seconds:
+            self.emit()
+
+    def emit(self):
+        """Function to publish the summaries of the phases recorded since the last time, and reset them"""
+        self.last_emit_time = time.time()
+        snapshot = self.snapshot(reset=True)
+        gauges = self.get_gauges()
+        if not snapshot and not gauges:
+            return
+        if self.callback is not None:
+            try:
+                self.callback(dict(snapshot, gauges=gauges) if gauges else snapshot)
+            except Exception as ex:
+                print('[moesif] Error while executing the timings callback', ex)
+        if self.emf:
+            for line in format_emf(self.namespace, snapshot):
+                print(line)
+            if gauges:
+                print(format_emf_gauges(self.namespace, gauges))
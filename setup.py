@@ -93,5 +93,7 @@ setup(
     extras_require={
         'dev': [],
         'test': ['nose'],
+        'async': ['aiohttp'],
+        'fast': ['orjson'],
     },
 )